@@ -96,14 +96,14 @@ if load_casscf_guess:
     N2.load_amo_guess_from_casscf_npy (npyfile, norbs_cmo, norbs_amo)
 elif dr_guess is not None:
     chkname = 'me2n2_sccasdmet_r{:2.0f}'.format (dr_guess*10)
-    me2n2_dmet.load_checkpoint (chkname + '.chk.npy')
+    me2n2_dmet.load_checkpoint (chkname + '.chk.h5')
 else:
     me2n2_dmet.generate_frag_cas_guess (mf.mo_coeff, caslst=CASlist)
 
 # Calculation
 # --------------------------------------------------------------------------------------------------------------------
 energy_result = me2n2_dmet.doselfconsistent ()
-me2n2_dmet.save_checkpoint (my_kwargs['calcname'] + '.chk.npy')
+me2n2_dmet.save_checkpoint (my_kwargs['calcname'] + '.chk.h5')
 print ("----Energy: {:.1f} {:.8f}".format (r_nn, energy_result))
 
 # Save natural-orbital moldens
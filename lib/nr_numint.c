@@ -140,3 +140,68 @@ void VOTdot_ao_mo(double *vv, double *ao, double *mo,
 }
 }
 
+
+/* MRH: second-cumulant part of the on-top pair density [and its gradient] on the grid, i.e.,
+    Pi[0,g] += 1/2 sum_ijkl mo[0,i,g] mo[0,j,g] cas2[ij,kl] mo[0,k,g] mo[0,l,g]
+    Pi[x,g] += 2   sum_ijkl mo[x,i,g] mo[0,j,g] cas2[ij,kl] mo[0,k,g] mo[0,l,g]  (x = 1,2,3)
+   mo has data layout (nderiv,ncas,ngrids) in row-major order, as returned by otpd._grid_ao2mo,
+   and Pi has data layout (nderiv,ngrids). cas2 is the (ncas**2,ncas**2) spin-summed 2-CDM,
+   which must be symmetric under ij <-> kl. nderiv is 1 or 4. Threads work on separate blocks
+   of BLKSIZE grid points, with only two private pair-product buffers of BLKSIZE*ncas**2
+   elements each, instead of (nderiv,ngrids,ncas,ncas) intermediates. */
+void VOTpair_density(double *Pi, double *mo, double *cas2,
+                     int ncas, int ngrids, int nderiv)
+{
+        const int npair = ncas * ncas;
+        const int nblk = (ngrids+BLKSIZE-1) / BLKSIZE;
+        const size_t Ngrids = ngrids;
+
+#pragma omp parallel
+{
+        const char TRANS_N = 'N';
+        const double D0 = 0;
+        const double D1 = 1;
+        int ib, ip, nb, i, j, g, ideriv;
+        double *mo0, *mox, *x_ij, *w_ij, *pPi;
+        double *x = malloc(sizeof(double) * npair * BLKSIZE);
+        double *w = malloc(sizeof(double) * npair * BLKSIZE);
+#pragma omp for schedule(static)
+        for (ib = 0; ib < nblk; ib++) {
+                ip = ib * BLKSIZE;
+                nb = MIN(ngrids-ip, BLKSIZE);
+                mo0 = mo + ip;
+                /* x[ij,g] = mo[0,i,g] * mo[0,j,g] */
+                for (i = 0; i < ncas; i++) {
+                for (j = 0; j < ncas; j++) {
+                        x_ij = x + (i*ncas+j)*nb;
+                        for (g = 0; g < nb; g++) {
+                                x_ij[g] = mo0[i*Ngrids+g] * mo0[j*Ngrids+g];
+                        }
+                } }
+                /* w[kl,g] = sum_ij x[ij,g] * cas2[ij,kl]; column-major (nb,npair) */
+                dgemm_(&TRANS_N, &TRANS_N, &nb, &npair, &npair,
+                       &D1, x, &nb, cas2, &npair, &D0, w, &nb);
+                pPi = Pi + ip;
+                for (i = 0; i < npair; i++) {
+                        x_ij = x + i*nb;
+                        w_ij = w + i*nb;
+                        for (g = 0; g < nb; g++) {
+                                pPi[g] += 0.5 * x_ij[g] * w_ij[g];
+                        }
+                }
+                for (ideriv = 1; ideriv < nderiv; ideriv++) {
+                        mox = mo + ideriv*ncas*Ngrids + ip;
+                        pPi = Pi + ideriv*Ngrids + ip;
+                        for (i = 0; i < ncas; i++) {
+                        for (j = 0; j < ncas; j++) {
+                                w_ij = w + (i*ncas+j)*nb;
+                                for (g = 0; g < nb; g++) {
+                                        pPi[g] += 2 * mox[i*Ngrids+g] * mo0[j*Ngrids+g] * w_ij[g];
+                                }
+                        } }
+                }
+        }
+        free(x);
+        free(w);
+}
+}
@@ -1538,23 +1538,28 @@ class fragment_object:
             return self.get_oneRDM_frag ().flatten (order='F')
 
 
-    def get_rsp_1RDM_elements (self, dmet, rsp_1RDM):
+    def get_rsp_1RDM_basis (self, dmet):
+        ''' Basis in which get_rsp_1RDM_elements represents rsp_1RDM, and whether only the diagonal
+        elements of the represented matrix are kept '''
         self.warn_check_imp_solve ("get_rsp_1RDM_elements")
         if dmet.altcostfunc:
             raise RuntimeError("You shouldn't have gotten in to get_rsp_1RDM_elements if you're using the constrained-optimization cost function!")
         # If the error function is working in the fragment NO basis, then rsp_1RDM will already be in that basis. Otherwise it will be in the local basis
         if dmet.doDET_NO:
-            return np.diag (rsp_1RDM)[self.frag_orb_list]
+            return np.eye (self.norbs_tot)[:,self.frag_orb_list], True
         # Bath-orbital matrix elements needed
         if dmet.incl_bath_errvec:
-            rsp_1RDM_imp = represent_operator_in_basis (rsp_1RDM, self.loc2imp)
-            return rsp_1RDM_imp.flatten (order='F')
+            return self.loc2imp, False
         # Only fragment-orbital matrix elements needed
-        rsp_1RDM_frag = represent_operator_in_basis (rsp_1RDM, self.loc2frag)
-        if dmet.doDET:
-            return np.diag (rsp_1RDM_frag)
+        return self.loc2frag, dmet.doDET
+
+    def get_rsp_1RDM_elements (self, dmet, rsp_1RDM):
+        loc2bas, diag = self.get_rsp_1RDM_basis (dmet)
+        rsp_1RDM_bas = represent_operator_in_basis (rsp_1RDM, loc2bas)
+        if diag:
+            return np.diag (rsp_1RDM_bas)
         else:
-            return rsp_1RDM_frag.flatten (order='F')
+            return rsp_1RDM_bas.flatten (order='F')
 
 
 
@@ -27,9 +27,10 @@ from mrh.my_pyscf.mcscf import lasci
 import warnings
 import numpy as np
 from scipy import optimize, linalg
-import time, ctypes
+import time, ctypes, os, h5py
+from concurrent.futures import ThreadPoolExecutor
 #import tracemalloc
-from pyscf import scf, mcscf
+from pyscf import scf, mcscf, lib
 from pyscf.lo import orth, nao
 from pyscf.lib import logger as pyscf_logger
 from pyscf.gto import mole, same_mol
@@ -50,6 +51,8 @@ from mrh.my_dmet.debug import debug_ofc_oneRDM, debug_Etot, examine_ifrag_olap,
 from functools import reduce
 from itertools import combinations, product
 
+CHECKPOINT_VERSION = 1
+
 class dmet:
 
     def __init__( self, theInts, fragments, calcname='DMET', isTranslationInvariant=False, SCmethod='BFGS', incl_bath_errvec=True, use_constrained_opt=False, 
@@ -58,7 +61,7 @@ class dmet:
                     print_rdm=True, debug_energy=False, debug_reloc=False, oldLASSCF=False,
                     nelec_int_thresh=1e-6, chempot_init=0.0, num_mf_stab_checks=0,
                     corrpot_maxiter=50, orb_maxiter=50, chempot_tol=1e-6, corrpot_mf_moldens=0, do_conv_molden=False,
-                    conv_tol_grad=1e-4 ):
+                    conv_tol_grad=1e-4, nworkers=1 ):
 
 
         if isTranslationInvariant:
@@ -66,7 +69,7 @@ class dmet:
             assert( theInts.TI_OK == True )
             assert( len (fragments) == 1 )
         
-        assert (( SCmethod == 'LSTSQ' ) or ( SCmethod == 'BFGS' ) or ( SCmethod == 'NONE' ))
+        assert (( SCmethod == 'LSTSQ' ) or ( SCmethod == 'BFGS' ) or ( SCmethod == 'LM' ) or ( SCmethod == 'NONE' ))
 
         #tracemalloc.start (10)
 
@@ -106,6 +109,7 @@ class dmet:
         self.oldLASSCF                = oldLASSCF
         self.do_conv_molden           = do_conv_molden
         self.conv_tol_grad            = conv_tol_grad
+        self.nworkers                 = nworkers
 
         self.verbose = self.ints.mol.verbose
         for frag in self.fragments:
@@ -210,77 +214,22 @@ class dmet:
     def makelist_H1( self ):
    
         # OK, this is somehow related to the C code that came with this that does rhf response. 
-        #theH1 = []
-        H1start = []
-        H1row   = []
-        H1col   = []
-        H1start.append( 0 )
-        totalsize = 0
-        def sparsify (list_H1, totalsize, H1start, H1row, H1col):
-            rowco, colco = np.where( list_H1 == 1 )
-            totalsize += len( rowco )
-            H1start.append( totalsize )
-            for count2 in range( len( rowco ) ):
-                H1row.append( rowco[ count2 ] )
-                H1col.append( colco[ count2 ] )
-            return totalsize, H1start, H1row, H1col
-        if ( self.doDET == True ): # Do density embedding theory
-            if ( self.TransInv == True ): # Translational invariance assumed
-                # In this case, it appears that H1 identifies a set of diagonal 1RDM elements that are equivalent by symmetry
-                for row in range( self.fragments[0].norbs_frag ):
-                    H1 = np.zeros( [ self.norbs_tot, self.norbs_tot ], dtype=int )
-                    for jumper in range( self.norbs_tot // self.fragments[0].norbs_frag ):
-                        jumpsquare = self.fragments[0].norbs_frag * jumper
-                        H1[ jumpsquare + row, jumpsquare + row ] = 1
-                    #theH1.append( H1 )
-                    totalsize, H1start, H1row, H1col = sparsify (H1, totalsize, H1start, H1row, H1col)
-            else: # NO translational invariance assumed
-                # Huh? In this case it's a long list of giant matrices with only one nonzero value each
-                jumpsquare = 0
-                for frag in self.fragments:
-                    for row in range( frag.norbs_frag ):
-                        H1 = np.zeros( [ self.norbs_tot, self.norbs_tot ], dtype=int )
-                        H1[ jumpsquare + row, jumpsquare + row ] = 1
-                        #theH1.append( H1 )
-                        totalsize, H1start, H1row, H1col = sparsify (H1, totalsize, H1start, H1row, H1col)
-                    jumpsquare += frag.norbs_frag
-        else: # Do density MATRIX embedding theory
-            # Upper triangular parts of 1RDMs only
-            if ( self.TransInv == True ): # Translational invariance assumed
-                # Same as above
-                for row in range( self.fragments[0].norbs_frag ):
-                    for col in range( row, self.fragments[0].norbs_frag ):
-                        H1 = np.zeros( [ self.norbs_tot, self.norbs_tot ], dtype=int )
-                        for jumper in range( self.norbs_tot // self.fragments[0].norbs_frag ):
-                            jumpsquare = self.fragments[0].norbs_frag * jumper
-                            H1[ jumpsquare + row, jumpsquare + col ] = 1
-                            H1[ jumpsquare + col, jumpsquare + row ] = 1
-                        #theH1.append( H1 )
-                        totalsize, H1start, H1row, H1col = sparsify (H1, totalsize, H1start, H1row, H1col)
-            else: # NO translational invariance assumed
-                # same as above
-                jumpsquare = 0
-                for frag in self.fragments:
-                    for row in range( frag.norbs_frag ):
-                        for col in range( row, frag.norbs_frag ):
-                            H1 = np.zeros( [ self.norbs_tot, self.norbs_tot ], dtype=int )
-                            H1[ jumpsquare + row, jumpsquare + col ] = 1
-                            H1[ jumpsquare + col, jumpsquare + row ] = 1
-                            #theH1.append( H1 )
-                            totalsize, H1start, H1row, H1col = sparsify (H1, totalsize, H1start, H1row, H1col)
-                    jumpsquare += frag.norbs_frag
-        H1start = np.array( H1start, dtype=ctypes.c_int )
-        H1row   = np.array( H1row,   dtype=ctypes.c_int )
-        H1col   = np.array( H1col,   dtype=ctypes.c_int )
-        return ( H1start, H1row, H1col )
+        # One umat parameter per upper-triangular (DMET) or diagonal (DET) fragment-block element, in the CSR layout of the C code
+        if ( self.TransInv == True ): # Translational invariance assumed
+            # In this case, H1 identifies a set of 1RDM elements that are equivalent by symmetry
+            norbs_frag = self.fragments[0].norbs_frag
+            images = np.arange (self.norbs_tot // norbs_frag) * norbs_frag
+            return qcdmethelper.sparse_H1.from_fragments (self.norbs_tot, [norbs_frag], diag=self.doDET, images=images)
+        # NO translational invariance assumed
+        return qcdmethelper.sparse_H1.from_fragments (self.norbs_tot, [frag.norbs_frag for frag in self.fragments], diag=self.doDET)
         
     def doexact( self, chempot_frag=0.0 ):
         oneRDM_loc = self.helper.construct1RDM_loc( self.doSCF, self.umat ) 
         self.energy = 0.0												
         self.spin = 0.0
 
+        self.solve_impurity_problems (chempot_frag)
         for frag in self.fragments:
-            frag.solve_impurity_problem (chempot_frag)
             self.energy += frag.E_frag
             self.spin += frag.S2_frag
 
@@ -346,6 +295,29 @@ class dmet:
         print ("Current sum of fragment spins: {0:.6f}".format (self.spin))
         return Nelectrons
         
+    def solve_impurity_problems (self, chempot_frag=0.0):
+        ''' Call solve_impurity_problem for all fragments. Each fragment already has its own
+        impurity Hamiltonian, so with nworkers > 1 the solves are carried out concurrently by a
+        pool of threads, each with its share of the OMP threads. Each solve only writes to its own
+        fragment object, so the results need no marshalling. '''
+        nworkers = min (self.nworkers or 1, len (self.fragments))
+        if nworkers < 2:
+            for frag in self.fragments:
+                frag.solve_impurity_problem (chempot_frag)
+            return
+        w0, t0 = time.time (), time.clock ()
+        nthreads = max (1, lib.num_threads () // nworkers)
+        def solve (frag):
+            with lib.with_omp_threads (nthreads):
+                frag.solve_impurity_problem (chempot_frag)
+        # Biggest impurities first, so that the small ones fill in the gaps at the end
+        frags = sorted (self.fragments, key=lambda frag: -frag.norbs_imp)
+        with ThreadPoolExecutor (max_workers=nworkers) as executor:
+            for future in [executor.submit (solve, frag) for frag in frags]:
+                future.result ()
+        print ("Time solving {} impurity problems with {} workers: {:.8f} wall, {:.8f} clock".format (len (self.fragments),
+            nworkers, time.time () - w0, time.clock () - t0))
+
     def constructloc2fno( self ):
 
         myloc2fno = np.zeros ((self.norbs_tot, self.norbs_tot))
@@ -418,21 +390,79 @@ class dmet:
         
         self.acceptable_errvec_check ()
         newumatsquare_loc = self.flat2square( newumatflat )
-        # RDMderivs_rot appears to be in the natural-orbital basis if doDET_NO is specified and the local basis otherwise
-        RDMderivs_rot = self.helper.construct1RDM_response( self.doSCF, newumatsquare_loc, self.loc2fno )
-        gradient = []
-        for countgr in range( len( newumatflat ) ):
+        # The response is in the natural-orbital basis if doDET_NO is specified and the local basis otherwise
+        # Only the blocks of it that the fragments' error vectors consume are computed, in batches of umat parameters
+        loc2bas, diag = zip (*[frag.get_rsp_1RDM_basis (self) for frag in self.fragments])
+        if self.doLASSCF:
             # The projection below should do nothing for ordinary DMET, but when a wma space is used it should prevent the derivative from pointing into the wma space
-            rsp_1RDM = RDMderivs_rot[countgr,:,:]
-            if self.doLASSCF:
-                rsp_1RDM = project_operator_into_subspace (RDMderivs_rot[countgr, :, :], self.ints.loc2idem) 
-            errvec = np.concatenate ([frag.get_rsp_1RDM_elements (self, rsp_1RDM) for frag in self.fragments])
-            yield errvec
-#            gradient.append( errvec )
-#        gradient = np.array( gradient ).T
-        
-#        return gradient
-        
+            loc2idem = self.ints.loc2idem
+            loc2bas = [np.dot (loc2idem, np.dot (loc2idem.conjugate ().T, l2b)) for l2b in loc2bas]
+        for rsp_blocks in self.helper.construct1RDM_response_blocks (self.doSCF, newumatsquare_loc, self.loc2fno, loc2bas):
+            for rsp_1RDM_bas in zip (*rsp_blocks):
+                yield np.concatenate ([np.diag (rsp) if d else rsp.flatten (order='F') for rsp, d in zip (rsp_1RDM_bas, diag)])
+
+    def rdm_differences_jacobian( self, newumatflat ):
+        ''' Jacobian of rdm_differences, shape (len (errvec), len (newumatflat)), all at once '''
+        return np.stack (list (self.rdm_differences_derivative (newumatflat)), axis=-1)
+
+    def lm_corrpot( self, umatflat, conv_tol_grad=1e-5, max_cycle=None, max_trials=10 ):
+        ''' Minimize costfunction = |rdm_differences|^2 by Levenberg-Marquardt: steps
+            dx = -(J.T J + lambda D)^-1 J.T r, where D is the diagonal of J.T J, with the damping
+            lambda updated after each trial step from the ratio of the actual to the predicted
+            reduction of the cost function (Nielsen's rule). As lambda -> 0 this is Gauss-Newton.
+            The Jacobian is evaluated once per accepted step and reused for rejected trials,
+            which only cost one 1-RDM build each.
+
+        Args:
+            umatflat: ndarray of shape (nparam,)
+                Initial guess
+
+        Kwargs:
+            conv_tol_grad: float
+                Convergence threshold on the max-norm of the gradient of the cost function
+            max_cycle: int
+                Maximum number of Jacobian evaluations; defaults to corrpot_maxiter
+            max_trials: int
+                Maximum number of consecutive rejected steps before giving up
+
+        Returns:
+            umatflat: ndarray of shape (nparam,)
+            converged: bool
+        '''
+        if max_cycle is None: max_cycle = self.corrpot_maxiter
+        x = np.array (umatflat, copy=True)
+        r = self.rdm_differences (x)
+        f = np.dot (r, r)
+        lam, nu = 1e-3, 2.0
+        converged = False
+        for it in range (max_cycle):
+            jac = self.rdm_differences_jacobian (x)
+            g = np.dot (jac.T, r)
+            A = np.dot (jac.T, jac)
+            gnorm = 2 * np.amax (np.abs (g))
+            print ("LM corrpot iteration {}: cost function = {:.6e}, |gradient| = {:.6e}".format (it, f, gnorm))
+            if gnorm < conv_tol_grad:
+                converged = True
+                break
+            D = np.maximum (np.diag (A), 1e-12 * max (1.0, np.amax (np.diag (A))))
+            for trial in range (max_trials):
+                dx = -linalg.solve (A + lam * np.diag (D), g, assume_a='pos')
+                r_new = self.rdm_differences (x + dx)
+                f_new = np.dot (r_new, r_new)
+                pred = -(2 * np.dot (g, dx) + np.dot (dx, np.dot (A, dx)))
+                rho = (f - f_new) / pred if pred > 0 else -1.0
+                if rho > 0:
+                    x, r, f = x + dx, r_new, f_new
+                    lam *= max (1.0/3.0, 1.0 - (2*rho - 1)**3)
+                    nu = 2.0
+                    break
+                lam *= nu
+                nu *= 2
+            else:
+                print ("LM corrpot: no decrease of the cost function after {} trial steps".format (max_trials))
+                break
+        return x, converged
+
     def verify_gradient( self, umatflat ):
     
         gradient = self.costfunction_derivative( umatflat )
@@ -564,7 +594,7 @@ class dmet:
             loc2wmas = np.concatenate ([frag.loc2amo for frag in self.fragments], axis=1)
             loc2wmcs = get_complementary_states (loc2wmas, symmetry=self.ints.loc2symm, enforce_symmetry=self.enforce_symmetry)
             self.refragmentation (loc2wmas, loc2wmcs, self.ints.oneRDM_loc)
-            if self.verbose: self.save_checkpoint (self.calcname + '.chk.npy')
+            if self.verbose: self.save_checkpoint (self.calcname + '.chk.h5')
         while (u_diff > convergence_threshold):
             u_diff, rdm = self.doselfconsistent_corrpot (rdm, [('corrpot', iteration)])
             iteration += 1 
@@ -628,6 +658,12 @@ class dmet:
         elif ( self.SCmethod == 'LSTSQ' ):
             result = optimize.leastsq( self.rdm_differences, self.square2flat( self.umat ), Dfun=self.rdm_differences_derivative, factor=0.1 )
             self.umat = self.flat2square( result[ 0 ] )
+        elif ( self.SCmethod == 'LM' ):
+            print ("Doing Levenberg-Marquardt for chemical potential.....")
+            lm_start = time.time ()
+            umatflat, converged = self.lm_corrpot( self.square2flat( self.umat ) )
+            self.umat = self.flat2square( umatflat )
+            print ("Levenberg-Marquardt {} after {} seconds".format ('converged' if converged else 'not converged', time.time () - lm_start))
         elif ( self.SCmethod == 'BFGS' ):
             print ("Doing BFGS for chemical potential.....")
             bfgs_start = time.time ()
@@ -674,7 +710,7 @@ class dmet:
         #itersnap.dump ('iter{}end.snpsht'.format (myiter))
 
         if not self.doLASSCF:
-            if self.verbose: self.save_checkpoint (self.calcname + '.chk.npy')
+            if self.verbose: self.save_checkpoint (self.calcname + '.chk.h5')
 
         return u_diff, rdm_new
 
@@ -740,7 +776,7 @@ class dmet:
             oneRDM_loc = sum ([f.oneRDMas_loc for f in self.fragments if f.norbs_as])
             oneRDM_loc += 2 * get_1RDM_from_OEI (self.ints.activeFOCK, self.ints.nelec_idem//2, subspace=loc2wmcs_new)
             e_tot, grads = self.refragmentation (loc2wmas_new, loc2wmcs_new, oneRDM_loc)
-            if self.verbose: self.save_checkpoint (self.calcname + '.chk.npy')
+            if self.verbose: self.save_checkpoint (self.calcname + '.chk.h5')
         try:
             orb_diff = measure_basis_olap (loc2wmas_new, loc2wmcs_old)[0] / max (1,loc2wmas_new.shape[1])
         except:
@@ -1225,30 +1261,112 @@ class dmet:
 
         return
 
+    def _get_checkpoint_keys (self):
+        ''' Names of the checkpoint groups of the fragments: their frag_name if they are all
+        distinct, so that the checkpoint doesn't depend on the order of the fragments, and their
+        positions otherwise '''
+        names = [f.frag_name for f in self.fragments]
+        if len (set (names)) == len (names): return names
+        return ['frag{}'.format (ifrag) for ifrag in range (len (self.fragments))]
+
     def save_checkpoint (self, fname):
-        ''' Data array structure: nao_nr, chempot, 1RDM or umat, norbs_amo in frag 1, loc2amo of frag 1, oneRDM_amo of frag 1, twoCDMimp_amo of frag 1, norbs_amo of frag 2, ... '''
+        ''' Write an HDF5 checkpoint, with the layout
+
+            /                   attrs: format, version, nao, chempot
+            /mat                1RDM (doLASSCF) or umat in the ao basis; attrs: kind
+            /fragments/<name>   attrs: norbs_amo
+                ao2amo, oneRDM_amo, twoCDMimp_amo (attrs: amax)
+
+        where name is given by _get_checkpoint_keys. Datasets are written one at a time, the big
+        ones compressed, into a temporary file which is flushed after each fragment and replaces
+        fname at the end. If fname ends in
+        '.npy', the flat-array format of older versions is written instead:
+            nao_nr, chempot, 1RDM or umat, norbs_amo in frag 1, loc2amo of frag 1, oneRDM_amo of frag 1, twoCDMimp_amo of frag 1, norbs_amo of frag 2, ... '''
         nao = self.ints.mol.nao_nr ()
         if self.doLASSCF:
-            chkdata = self.helper.construct1RDM_loc (self.doSCF, self.umat)
-            chkdata = represent_operator_in_basis (chkdata, self.ints.ao2loc.conjugate ().T).flatten (order='C')
+            mat = self.helper.construct1RDM_loc (self.doSCF, self.umat)
         else:
-            chkdata = represent_operator_in_basis (self.umat, self.ints.ao2loc.conjugate ().T).flatten (order='C')
-        chkdata = np.append (np.asarray ([nao, self.chempot]), chkdata)
-        for f in self.fragments:
-            chkdata = np.append (chkdata, [f.norbs_as])
-            chkdata = np.append (chkdata, np.dot (self.ints.ao2loc, f.loc2amo).flatten (order='C'))
-            chkdata = np.append (chkdata, represent_operator_in_basis (f.oneRDM_loc, f.loc2amo).flatten (order='C'))
-            chkdata = np.append (chkdata, f.twoCDMimp_amo.flatten (order='C'))
-        np.save (fname, chkdata)
+            mat = self.umat
+        mat = represent_operator_in_basis (mat, self.ints.ao2loc.conjugate ().T)
+        if fname.endswith ('.npy'):
+            chkdata = [np.asarray ([nao, self.chempot]), mat.ravel ()]
+            for f in self.fragments:
+                chkdata.append (np.asarray ([f.norbs_as]))
+                chkdata.append (np.dot (self.ints.ao2loc, f.loc2amo).ravel ())
+                chkdata.append (represent_operator_in_basis (f.oneRDM_loc, f.loc2amo).ravel ())
+                chkdata.append (f.twoCDMimp_amo.ravel ())
+            np.save (fname, np.concatenate (chkdata))
+            return
+        tmpname = fname + '.tmp'
+        with h5py.File (tmpname, 'w') as chkfile:
+            chkfile.attrs['format'] = 'mrh.my_dmet checkpoint'
+            chkfile.attrs['version'] = CHECKPOINT_VERSION
+            chkfile.attrs['nao'] = nao
+            chkfile.attrs['chempot'] = self.chempot
+            chkfile['mat'] = mat
+            chkfile['mat'].attrs['kind'] = 'oneRDM' if self.doLASSCF else 'umat'
+            for key, f in zip (self._get_checkpoint_keys (), self.fragments):
+                grp = chkfile.create_group ('fragments/' + key)
+                grp.attrs['norbs_amo'] = f.norbs_as
+                grp.create_dataset ('ao2amo', data=np.dot (self.ints.ao2loc, f.loc2amo), compression='lzf')
+                grp['oneRDM_amo'] = represent_operator_in_basis (f.oneRDM_loc, f.loc2amo)
+                twoCDM = grp.create_dataset ('twoCDMimp_amo', data=f.twoCDMimp_amo, compression='lzf')
+                twoCDM.attrs['amax'] = np.amax (np.abs (f.twoCDMimp_amo)) if f.twoCDMimp_amo.size else 0.0
+                chkfile.flush ()
+        os.replace (tmpname, fname)
         return
 
-    def load_checkpoint (self, fname, prev_mol=None):
-        nelec_amo = sum ((f.active_space[0] for f in self.fragments if f.active_space is not None))
-        norbs_amo = sum ((f.active_space[1] for f in self.fragments if f.active_space is not None))
-        norbs_cmo = (self.ints.mol.nelectron - nelec_amo) // 2
-        norbs_omo = norbs_cmo + norbs_amo
+    def _read_checkpoint_npy (self, fname):
+        ''' Parse a checkpoint in the flat-array format into nao, chempot, mat, and a list of
+        (norbs_amo, ao2amo, oneRDM_amo, twoCDMimp_amo) in the order of the fragments '''
         chkdata = np.load (fname)
-        nao, self.chempot, chkdata = int (round (chkdata[0])), chkdata[1], chkdata[2:] 
+        nao, chempot, chkdata = int (round (chkdata[0])), chkdata[1], chkdata[2:] 
+        mat, chkdata = chkdata[:nao**2].reshape (nao, nao, order='C'), chkdata[nao**2:]
+        frag_data = []
+        for f in self.fragments:
+            namo, chkdata = int (round (chkdata[0])), chkdata[1:]
+            ao2amo = oneRDM_amo = twoCDM = None
+            if namo > 0:
+                ao2amo,     chkdata = chkdata[:nao*namo].reshape (nao, namo, order='C'), chkdata[nao*namo:]
+                oneRDM_amo, chkdata = chkdata[:namo**2].reshape (namo, namo, order='C'), chkdata[namo**2:]
+                twoCDM,     chkdata = chkdata[:namo**4].reshape (namo, namo, namo, namo, order='C'), chkdata[namo**4:]
+            frag_data.append ((namo, ao2amo, oneRDM_amo, twoCDM))
+        assert (chkdata.shape == tuple((0,))), chkdata.shape               
+        return nao, chempot, mat, frag_data
+
+    def load_checkpoint (self, fname, prev_mol=None):
+        ''' Read a checkpoint written by save_checkpoint in either format. From an HDF5 checkpoint,
+        only the groups of the current fragments are read, looked up by name, each one only when
+        _load_checkpoint gets to that fragment, and the 2-CDMs are only read if they are nonzero. '''
+        if not h5py.is_hdf5 (fname):
+            nao, chempot, mat, frag_data = self._read_checkpoint_npy (fname)
+            self._load_checkpoint (nao, chempot, mat, frag_data, prev_mol)
+            return
+        with h5py.File (fname, 'r') as chkfile:
+            version = chkfile.attrs.get ('version', 0)
+            assert (version <= CHECKPOINT_VERSION), "checkpoint version {} is newer than this code ({})".format (
+                version, CHECKPOINT_VERSION)
+            frag_data = []
+            for key, f in zip (self._get_checkpoint_keys (), self.fragments):
+                if 'fragments/' + key not in chkfile:
+                    print ("No data for fragment {} in checkpoint file".format (f.frag_name))
+                    frag_data.append (None)
+                    continue
+                grp = chkfile['fragments/' + key]
+                namo = int (grp.attrs['norbs_amo'])
+                if namo > 0:
+                    # h5py datasets, read by _load_checkpoint
+                    twoCDM = grp['twoCDMimp_amo']
+                    if not twoCDM.attrs['amax'] > 1e-10: twoCDM = np.zeros (twoCDM.shape)
+                    frag_data.append ((namo, grp['ao2amo'], grp['oneRDM_amo'], twoCDM))
+                else:
+                    frag_data.append ((namo, None, None, None))
+            self._load_checkpoint (int (chkfile.attrs['nao']), chkfile.attrs['chempot'], chkfile['mat'][()],
+                frag_data, prev_mol)
+
+    def _load_checkpoint (self, nao, chempot, mat, frag_data, prev_mol):
+        ''' The arrays of frag_data may be h5py datasets, which are read one fragment at a time '''
+        self.chempot = chempot
         print ("{} atomic orbital basis functions reported in checkpoint file, as opposed to {} in integral object".format (nao, self.ints.mol.nao_nr ()))
         assert (prev_mol is not None or nao == self.ints.mol.nao_nr ())
         locSao = np.dot (self.ints.ao_ovlp, self.ints.ao2loc).conjugate ().T
@@ -1263,7 +1381,6 @@ class dmet:
             aoSloc = np.dot (self.ints.ao_ovlp, self.ints.ao2loc)
             locSao = aoSloc.conjugate ().T
 
-        mat, chkdata = chkdata[:nao**2].reshape (nao, nao, order='C'), chkdata[nao**2:]
         mat = represent_operator_in_basis (mat, aoSloc)
         if self.doLASSCF:
             self.ints.oneRDM_loc = mat.copy ()
@@ -1273,16 +1390,15 @@ class dmet:
         else:
             self.umat = mat.copy ()
 
-        for f in self.fragments:
+        for f, data in zip (self.fragments, frag_data):
             if self.doLASSCF: f.oneRDM_loc = self.ints.oneRDM_loc
-            namo, chkdata = int (round (chkdata[0])), chkdata[1:]
+            if data is None: continue
+            namo = data[0]
             print ("{} active orbitals reported in checkpoint file for fragment {}".format (namo, f.frag_name))
             if namo > 0:
-                f.loc2amo,       chkdata = chkdata[:nao*namo].reshape (nao, namo, order='C'), chkdata[nao*namo:]
-                f.oneRDMas_loc,  chkdata = chkdata[:namo**2].reshape (namo, namo, order='C'), chkdata[namo**2:]
+                f.loc2amo, f.oneRDMas_loc, f.twoCDMimp_amo = [x[()] for x in data[1:]]
                 print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
                     f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (f.oneRDMas_loc, fmt='{:6.3f}')))
-                f.twoCDMimp_amo, chkdata = chkdata[:namo**4].reshape (namo, namo, namo, namo, order='C'), chkdata[namo**4:]
                 if prev_mol and same_mol (prev_mol, self.ints.mol, cmp_basis=False): f.loc2amo = project_mo_nr2nr (prev_mol, f.loc2amo, self.ints.mol)
                 f.loc2amo = np.dot (locSao, f.loc2amo)
                 # Normalize
@@ -1302,7 +1418,6 @@ class dmet:
                 if np.amax (np.abs (f.twoCDMimp_amo)) > 1e-10:
                     tei = self.ints.dmet_tei (f.loc2amo)
                     f.E2_cum = np.tensordot (tei, f.twoCDMimp_amo, axes=4) / 2
-        assert (chkdata.shape == tuple((0,))), chkdata.shape               
 
         if self.doLASSCF: self.ints.setup_wm_core_scf (self.fragments, self.calcname)
         
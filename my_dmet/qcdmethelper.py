@@ -23,9 +23,65 @@ from mrh.util.rdm import get_1RDM_from_OEI_in_subspace
 from mrh.util.basis import represent_operator_in_basis, project_operator_into_subspace
 import numpy as np
 import ctypes
+from scipy import linalg, sparse
+from pyscf import lib
 from mrh.lib.helper import load_library
 lib_qcdmet = load_library ('libqcdmet')
 
+class sparse_H1 (object):
+    ''' The map from the flattened umat parameters to the one-body operator sum_k u_k H1_k, where
+    each H1_k is a 0/1 matrix, stored in the CSR layout of the rhf_response C code: the nonzero
+    elements of H1_k are (H1row[e], H1col[e]) for H1start[k] <= e < H1start[k+1]. Iterating over
+    it yields (H1start, H1row, H1col) for backwards compatibility with the tuple it replaces. '''
+
+    def __init__(self, H1start, H1row, H1col, norbs_tot):
+        self.H1start = np.asarray (H1start, dtype=ctypes.c_int)
+        self.H1row   = np.asarray (H1row,   dtype=ctypes.c_int)
+        self.H1col   = np.asarray (H1col,   dtype=ctypes.c_int)
+        self.norbs_tot = norbs_tot
+
+    @classmethod
+    def from_fragments (cls, norbs_tot, norbs_frag, diag=False, images=None):
+        ''' One parameter for each upper-triangular (or, if diag, diagonal) element of each
+        fragment block, with the fragments occupying consecutive orbital ranges in the given order.
+        Each parameter covers the equivalent element of the block displaced by every offset in
+        images (for translational invariance).
+
+        Args:
+            norbs_tot: int
+            norbs_frag: list of int
+
+        Kwargs:
+            diag: bool
+                Diagonal elements only (density embedding)
+            images: list of int
+                Orbital offsets of the translationally-equivalent images of the fragments.
+                Defaults to [0] (no translational invariance)
+        '''
+        images = np.asarray ([0] if images is None else images, dtype=int)
+        offs = np.cumsum ([0] + list (norbs_frag[:-1]))
+        rows, cols = [], []
+        for off, n in zip (offs, norbs_frag):
+            r, c = (np.arange (n), np.arange (n)) if diag else np.triu_indices (n)
+            rows.append (r + off)
+            cols.append (c + off)
+        row, col = np.concatenate (rows), np.concatenate (cols)
+        # Entries (row, col), (col, row) of each image, in the row-major order of np.where
+        H1row = np.stack ([row[:,None] + images, col[:,None] + images], axis=-1)
+        H1col = np.stack ([col[:,None] + images, row[:,None] + images], axis=-1)
+        offdiag = np.broadcast_to ((row != col)[:,None,None], H1row.shape).copy ()
+        offdiag[:,:,0] = True
+        nent = offdiag.sum ((1,2))
+        H1start = np.append (0, np.cumsum (nent))
+        return cls (H1start, H1row[offdiag], H1col[offdiag], norbs_tot)
+
+    def __iter__(self):
+        return iter ((self.H1start, self.H1row, self.H1col))
+
+    @property
+    def Nterms (self):
+        return len (self.H1start) - 1
+
 class qcdmethelper:
 
     def __init__( self, theLocalIntegrals, list_H1, altcf, minFunc ):
@@ -42,30 +98,13 @@ class qcdmethelper:
         
         # Variables for c gradient calculation
         #self.list_H1 = list_H1
-        H1start, H1row, H1col = list_H1#self.convertH1sparse()
+        if not isinstance (list_H1, sparse_H1):
+            list_H1 = sparse_H1 (*list_H1, norbs_tot=self.locints.norbs_tot)
+        H1start, H1row, H1col = list_H1
         self.H1start = H1start
         self.H1row = H1row
         self.H1col = H1col
         self.Nterms = len( self.H1start ) - 1
-        
-    def convertH1sparse( self ):
-    
-        H1start = []
-        H1row   = []
-        H1col   = []
-        H1start.append( 0 )
-        totalsize = 0
-        for count in range( len( self.list_H1 ) ):
-            rowco, colco = np.where( self.list_H1[count] == 1 )
-            totalsize += len( rowco )
-            H1start.append( totalsize )
-            for count2 in range( len( rowco ) ):
-                H1row.append( rowco[ count2 ] )
-                H1col.append( colco[ count2 ] )
-        H1start = np.array( H1start, dtype=ctypes.c_int )
-        H1row   = np.array( H1row,   dtype=ctypes.c_int )
-        H1col   = np.array( H1col,   dtype=ctypes.c_int )
-        return ( H1start, H1row, H1col )
 
     def construct1RDM_loc( self, doSCF, umat_loc ):
         
@@ -97,7 +136,7 @@ class qcdmethelper:
 
         # This part works in the rotated NO basis if NOrotation is specified
         rdm_deriv_rot = np.ones( [ self.locints.norbs_tot * self.locints.norbs_tot * self.Nterms ], dtype=ctypes.c_double )
-        if ( NOrotation != None ):
+        if ( NOrotation is not None ):
             OEI = np.dot( np.dot( NOrotation.T, OEI ), NOrotation )
         OEI = np.array( OEI.reshape( (self.locints.norbs_tot * self.locints.norbs_tot) ), dtype=ctypes.c_double )
         
@@ -112,6 +151,70 @@ class qcdmethelper:
         
         rdm_deriv_rot = rdm_deriv_rot.reshape( (self.Nterms, self.locints.norbs_tot, self.locints.norbs_tot), order='C' )
         return rdm_deriv_rot
+
+    def construct1RDM_response_blocks (self, doSCF, umat_loc, NOrotation, loc2bas_list, max_memory=None):
+        ''' Response of the blocks loc2bas.T . gamma . loc2bas of the mean-field 1-RDM to each umat
+        parameter, for each loc2bas in loc2bas_list. Equivalent to representing each slice of the
+        output of construct1RDM_response in each basis, but the (norbs_tot, norbs_tot) response
+        matrices are never formed. With gamma = 2 OCC . OCC.T,
+
+            loc2bas.T . dgamma/du . loc2bas = Y + Y.T
+            Y = 2 (loc2bas.T . VIRT) . X . (loc2bas.T . OCC).T
+            X[a,i] = - (VIRT.T . H1 . OCC)[a,i] / (eps_a - eps_i)
+
+        which is evaluated for batches of parameters at a time with GEMMs, with the batch size
+        bounded by max_memory.
+
+        Args:
+            doSCF, umat_loc, NOrotation: as in construct1RDM_response
+            loc2bas_list: list of ndarrays of shape (norbs_tot, nbas)
+
+        Kwargs:
+            max_memory: float
+                Memory (MB) available to one batch. Defaults to what is left of the mol's
+                max_memory, but no less than 400 MB
+
+        Yields:
+            rsp_blocks: list of ndarrays of shape (nbatch, nbas, nbas), for a batch of consecutive
+                umat parameters and in the same order as loc2bas_list
+        '''
+        if doSCF:
+            oneRDM = self.locints.get_wm_1RDM_from_scf_on_OEI (self.locints.loc_oei () + umat_loc)
+            OEI    = self.locints.loc_rhf_fock_bis (oneRDM)
+        else:
+            OEI    = self.locints.loc_rhf_fock() + umat_loc
+        if NOrotation is not None:
+            OEI = np.dot( np.dot( NOrotation.T, OEI ), NOrotation )
+        eigvals, eigvecs = linalg.eigh (OEI)
+        nocc = self.numPairs
+        occ, virt = eigvecs[:,:nocc], eigvecs[:,nocc:]
+        nvirt = virt.shape[1]
+        denom = -1.0 / (eigvals[nocc:,None] - eigvals[None,:nocc])
+        bas2virt = [np.dot (loc2bas.T, virt) for loc2bas in loc2bas_list]
+        bas2occ = [np.dot (loc2bas.T, occ) for loc2bas in loc2bas_list]
+
+        if max_memory is None:
+            max_memory = max (400, getattr (self.locints.mol, 'max_memory', 2000) - lib.current_memory ()[0])
+        nent_max = max (1, np.amax (np.diff (self.H1start)))
+        blksize = int (max_memory*1e6/8 / ((nent_max+2)*nvirt*nocc))
+        blksize = max (1, min (self.Nterms, blksize))
+        for d0, d1 in lib.prange (0, self.Nterms, blksize):
+            e0, e1 = self.H1start[d0], self.H1start[d1]
+            # VIRT.T . H1 . OCC = sum over the nonzero elements (row, col) of H1 of VIRT[row] x OCC[col]
+            virt_occ = virt[self.H1row[e0:e1],:,None] * occ[self.H1col[e0:e1],None,:]
+            term2ent = sparse.csr_matrix ((np.ones (e1-e0), np.arange (e1-e0), self.H1start[d0:d1+1]-e0),
+                shape=(d1-d0, e1-e0))
+            x = (term2ent @ virt_occ.reshape (e1-e0, nvirt*nocc)).reshape (d1-d0, nvirt, nocc)
+            virt_occ = None
+            x *= denom[None,:,:]
+            x = np.ascontiguousarray (x.transpose (1,0,2)).reshape (nvirt, (d1-d0)*nocc)
+            rsp_blocks = []
+            for b2v, b2o in zip (bas2virt, bas2occ):
+                nbas = b2v.shape[0]
+                y = np.dot (b2v, x).reshape (nbas*(d1-d0), nocc)
+                y = 2 * np.dot (y, b2o.T).reshape (nbas, d1-d0, nbas).transpose (1,0,2)
+                rsp_blocks.append (y + y.transpose (0,2,1))
+            yield rsp_blocks
         
     def constructbath( self, OneDM, impurityOrbs, numBathOrbs, threshold=1e-13 ):
     
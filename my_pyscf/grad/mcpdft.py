@@ -1,3 +1,4 @@
+from pyscf import lib
 from pyscf.mcscf import newton_casscf
 from pyscf.grad import rks as rks_grad
 from pyscf.dft import gen_grid
@@ -7,6 +8,7 @@ from pyscf.grad import sacasscf
 from pyscf.mcscf.casci import cas_natorb
 from mrh.my_pyscf.mcpdft.otpd import get_ontop_pair_density, _grid_ao2mo
 from mrh.my_pyscf.mcpdft.pdft_veff import _contract_vot_rho, _contract_ao_vao
+from mrh.my_pyscf.mcpdft import grid_cache
 from mrh.util.rdm import get_2CDM_from_2RDM
 from functools import reduce
 from scipy import linalg
@@ -125,8 +127,9 @@ def mcpdft_HellmanFeynman_grad (mc, ot, veff1, veff2, mo_coeff=None, ci=None, at
     t1 = logger.timer (mc, 'PDFT HlFn quadrature setup', *t0)
     for k, ia in enumerate (atmlst):
         full_atmlst[ia] = k
-    for ia, (coords, w0, w1) in enumerate (rks_grad.grids_response_cc (ot.grids)):
-        mask = gen_grid.make_mask (mol, coords)
+    for ia, (coords, w0, w1) in enumerate (grid_cache.grids_response_cc (ot)):
+        non0tab = gen_grid.make_mask (mol, coords)
+        eval_ao = grid_cache.gen_ao_gatherer (ot, coords, deriv=ot.dens_deriv+1, non0tab=non0tab)
         # For the xc potential derivative, I need every grid point in the entire molecule regardless of atmlist. (Because that's about orbitals.)
         # For the grid and weight derivatives, I only need the gridpoints that are in atmlst
         # It is conceivable that I can make this more efficient by only doing cross-combinations of grids and AOs, but I don't know how "mask"
@@ -143,7 +146,8 @@ def mcpdft_HellmanFeynman_grad (mc, ot, veff1, veff2, mo_coeff=None, ci=None, at
         for ip0 in range (0, ngrids, blksize):
             ip1 = min (ngrids, ip0+blksize)
             logger.info (mc, 'PDFT gradient atom {} slice {}-{} of {} total'.format (ia, ip0, ip1, ngrids))
-            ao = ot._numint.eval_ao (mol, coords[ip0:ip1], deriv=ot.dens_deriv+1, non0tab=mask) # Need 1st derivs for LDA, 2nd for GGA, etc.
+            mask = non0tab[ip0//BLKSIZE:]
+            ao = eval_ao (ip0, ip1) # Need 1st derivs for LDA, 2nd for GGA, etc.
             t1 = logger.timer (mc, 'PDFT HlFn quadrature atom {} ao grids'.format (ia), *t1)
             if ot.xctype == 'LDA': # Might confuse the rho and Pi generators if I don't slice this down
                 aoval = ao[:1]
@@ -236,6 +240,21 @@ class Gradients (sacasscf.Gradients):
         if self.state is None and self.nroots == 1:
             self.state = 0
         self.e_mcscf = self.base.e_mcscf
+        self._veff_states = None
+
+    def get_pdft_veff (self, mo, ci, state):
+        ''' Effective potentials of one state. With several roots, those of all states are computed in
+            one batched pass over the grid and kept until mo, ci, or the geometry change, so that
+            looping over the states' gradients visits the grid only once for veff. The cache is keyed
+            on the contents of the arrays, so it is also invalidated by in-place updates '''
+        if self.nroots == 1:
+            return self.base.get_pdft_veff (mo, ci[state], incl_coul=True, paaa_only=True)
+        key = (lib.fp (mo), tuple (lib.fp (c) for c in ci), lib.fp (self.base.mol.atom_coords ()))
+        cached = self._veff_states
+        if cached is None or cached[0] != key:
+            veff1, veff2 = self.base.get_pdft_veff_multi (mo, ci, incl_coul=True, paaa_only=True)
+            cached = self._veff_states = (key, veff1, veff2)
+        return cached[1][state], cached[2][state]
 
     def get_wfn_response (self, atmlst=None, state=None, verbose=None, mo=None, ci=None, veff1=None, veff2=None, **kwargs):
         if state is None: state = self.state
@@ -328,7 +347,7 @@ class Gradients (sacasscf.Gradients):
         ci = kwargs['ci'] if 'ci' in kwargs else self.base.ci
         if isinstance (ci, np.ndarray): ci = [ci] # hack hack hack...
         kwargs['ci'] = ci
-        kwargs['veff1'], kwargs['veff2'] = self.base.get_pdft_veff (mo, ci[state], incl_coul=True, paaa_only=True)
+        kwargs['veff1'], kwargs['veff2'] = self.get_pdft_veff (mo, ci, state)
         return super().kernel (**kwargs)
 
     def project_Aop (self, Aop, ci, state):
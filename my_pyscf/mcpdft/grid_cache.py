@@ -0,0 +1,326 @@
+import numpy as np
+import sys, hashlib, threading
+from pyscf import lib
+from pyscf.lib import logger
+from pyscf.dft.gen_grid import BLKSIZE
+from pyscf.grad import rks as rks_grad
+
+# MRH 05/18/2020 convention (see pdft_veff.py): AO grid-value arrays have shape (nderiv,ngrids,nao)
+# but data layout (nderiv,nao,ngrids). The cache stores them on disk in the data layout, i.e.,
+# as datasets of shape (nderiv,nao,ngrids), so that any batch of grid points is one hyperslab.
+
+def _mol_key (mol):
+    ''' Digest of everything in mol that determines the values of the AOs: geometry and basis '''
+    h = hashlib.sha1 ()
+    for arr in (mol._atm, mol._bas, mol._env):
+        h.update (np.ascontiguousarray (arr).tobytes ())
+    h.update (str (mol.cart).encode ())
+    return h.hexdigest ()
+
+def _grids_key (grids):
+    ''' Digest of the parameters that determine a quadrature grid for a given molecule '''
+    fields = [grids.level, grids.atom_grid, grids.prune, grids.radi_method, grids.becke_scheme,
+        grids.atomic_radii, grids.radii_adjust]
+    fields = [getattr (f, '__name__', f) for f in fields]
+    return hashlib.sha1 (repr (fields).encode ()).hexdigest ()
+
+def _coords_key (coords):
+    return hashlib.sha1 (np.ascontiguousarray (coords).tobytes ()).hexdigest ()
+
+def _match_coords (coords, sub_coords):
+    ''' Index of each row of sub_coords among the rows of coords, or -1 if it is not there '''
+    dt = np.dtype ([('x','f8'), ('y','f8'), ('z','f8')])
+    ref = np.ascontiguousarray (coords, dtype=np.float64).view (dt).ravel ()
+    sub = np.ascontiguousarray (sub_coords, dtype=np.float64).view (dt).ravel ()
+    if not ref.size: return -np.ones (sub.size, dtype=np.int64)
+    order = np.argsort (ref, kind='stable')
+    pos = np.minimum (np.searchsorted (ref[order], sub), ref.size-1)
+    idx = order[pos]
+    idx[ref[idx] != sub] = -1
+    return idx
+
+class GridCache (object):
+    ''' On-disk (HDF5) cache of AO values [and derivatives] on quadrature grid points and of the
+        atom-by-atom grid weight response, shared by the MC-PDFT energy, effective potential, and
+        gradient codes. Attach an instance to an on-top functional (ot.grid_cache = GridCache ()) to
+        turn it on.
+
+        Entries are keyed by the geometry and basis of the molecule and by the grid coordinates.
+        AO values are filled in lazily, one batch of grid points at a time, and stored through the
+        highest derivative order requested so far, so any later pass over the same grid that uses
+        BLKSIZE-aligned batches (all of them in this module) reads them back instead of calling
+        eval_ao. The module-level helpers store AOs on ot.grids through order ot.dens_deriv+1,
+        which is what the nuclear gradient needs; the gradient then gathers the points of each
+        atom-centered grid out of that same entry (see gen_ao_gatherer). Only entries for the most
+        recent molecule are kept, so a geometry optimization does not accumulate stale data on disk.
+
+        The AO screening mask is not part of the key: masks are always generated from the grid
+        coordinates themselves, and AOs on screened blocks are negligible by construction.
+
+        Kwargs:
+            filename : str
+                Name of an HDF5 file in which to keep the cache. If not provided, a temporary
+                file is used which is deleted when the cache is released.
+
+        Attributes:
+            nhit : int
+                Number of BLKSIZE blocks of AO values read back from the cache
+            nmiss : int
+                Number of BLKSIZE blocks of AO values evaluated and written to the cache
+    '''
+
+    def __init__(self, filename=None, verbose=logger.NOTE, stdout=sys.stdout):
+        self.filename = filename
+        self.verbose = verbose
+        self.stdout = stdout
+        self.nhit = 0
+        self.nmiss = 0
+        self._h5 = lib.H5TmpFile (filename)
+        self._lock = threading.RLock ()
+
+    def _mol_group (self, mol):
+        key = _mol_key (mol)
+        with self._lock:
+            for stale in [k for k in self._h5.keys () if k != key]:
+                logger.debug (self, 'GridCache: dropping entries for molecule %s', stale)
+                del self._h5[stale]
+            return self._h5.require_group (key)
+
+    def clear (self):
+        with self._lock:
+            for key in list (self._h5.keys ()):
+                del self._h5[key]
+
+    def _require_ao (self, ni, mol, coords, deriv=0, non0tab=None, deriv_store=None):
+        ''' Get the AO-value dataset for coords, holding at least deriv_store derivative orders, and a
+            function fill (blk0, blk1) that evaluates and stores AOs on the unfilled blocks of
+            coords[blk0*BLKSIZE:blk1*BLKSIZE] '''
+        if deriv_store is None: deriv_store = deriv
+        deriv_store = max (deriv, deriv_store)
+        ngrids = coords.shape[0]
+        nao = mol.nao_nr ()
+        comp = (deriv_store+1)*(deriv_store+2)*(deriv_store+3)//6
+        nblk = (ngrids+BLKSIZE-1)//BLKSIZE
+        grp = self._mol_group (mol)
+        key = _coords_key (coords)
+        with self._lock:
+            grp = grp.require_group ('ao/' + key)
+            if 'val' in grp and grp['val'].attrs['deriv'] < deriv_store:
+                # Need a higher derivative than is stored; start over for this grid
+                del grp['val'], grp['filled']
+            if 'val' not in grp:
+                grp.create_dataset ('val', (comp, nao, ngrids), 'f8', chunks=(comp, nao, min (ngrids, BLKSIZE)))
+                grp['val'].attrs['deriv'] = deriv_store
+                grp.create_dataset ('filled', (nblk,), 'u1', fillvalue=0)
+            ds_val, ds_filled = grp['val'], grp['filled']
+        deriv_stored = ds_val.attrs['deriv']
+        comp_stored = ds_val.shape[0]
+
+        def fill (blk0, blk1):
+            ''' Returns AOs on coords[ip0:ip1] (through deriv_stored) if they had to be evaluated,
+                otherwise None '''
+            ip0, ip1 = blk0*BLKSIZE, min (ngrids, blk1*BLKSIZE)
+            with self._lock:
+                hit = bool (np.all (ds_filled[blk0:blk1]))
+                if hit: self.nhit += blk1 - blk0
+            if hit: return None
+            mask = None if non0tab is None else non0tab[blk0:]
+            ao = ni.eval_ao (mol, coords[ip0:ip1], deriv=deriv_stored, non0tab=mask)
+            ao = ao.reshape (comp_stored, ip1-ip0, nao)
+            with self._lock:
+                ds_val[:,:,ip0:ip1] = ao.transpose (0,2,1)
+                ds_filled[blk0:blk1] = 1
+                self.nmiss += blk1 - blk0
+            return ao
+
+        return ds_val, fill
+
+    def gen_ao_evaluator (self, ni, mol, coords, deriv=0, non0tab=None, deriv_store=None):
+        ''' Get a function which returns AO values [and derivatives] on coords[ip0:ip1]
+
+            Args:
+                ni : instance of pyscf.dft.numint.NumInt
+                mol : instance of pyscf.gto.Mole
+                coords : ndarray of shape (ngrids,3)
+                    All grid points to be visited
+
+            Kwargs:
+                deriv : int
+                    Derivative order of AO values
+                non0tab : ndarray of shape (nblk,nbas)
+                    As in pyscf.dft.gen_grid and pyscf.dft.numint, for all of coords
+                deriv_store : int
+                    Derivative order through which AO values are stored, if higher than deriv
+
+            Returns:
+                eval_ao : callable
+                    eval_ao (ip0, ip1) returns an ndarray of shape (*,ip1-ip0,nao) as
+                    ni.eval_ao (mol, coords[ip0:ip1], deriv=deriv, non0tab=non0tab[ip0//BLKSIZE:]) does.
+                    ip0 must be a multiple of BLKSIZE.
+        '''
+        nao = mol.nao_nr ()
+        comp = (deriv+1)*(deriv+2)*(deriv+3)//6
+        ds_val, fill = self._require_ao (ni, mol, coords, deriv=deriv, non0tab=non0tab, deriv_store=deriv_store)
+
+        def eval_ao (ip0, ip1):
+            assert (ip0 % BLKSIZE == 0), ip0
+            blk0, blk1 = ip0//BLKSIZE, (ip1+BLKSIZE-1)//BLKSIZE
+            ao = fill (blk0, blk1)
+            if ao is None:
+                buf = np.empty ((comp, nao, ip1-ip0))
+                with self._lock:
+                    ds_val.read_direct (buf, np.s_[:comp,:,ip0:ip1])
+                ao = buf.transpose (0,2,1)
+            else:
+                ao = ao[:comp]
+            if deriv == 0: ao = ao[0]
+            return ao
+
+        return eval_ao
+
+    def gen_ao_gatherer (self, ni, mol, coords, sub_coords, deriv=0, non0tab=None, deriv_store=None):
+        ''' Get a function which returns AO values [and derivatives] on sub_coords[ip0:ip1], read
+            out of the entry for coords. Points of sub_coords which are not also points of coords
+            (compared exactly) are evaluated directly.
+
+            Args:
+                ni : instance of pyscf.dft.numint.NumInt
+                mol : instance of pyscf.gto.Mole
+                coords : ndarray of shape (ngrids,3)
+                    Grid of the cache entry, i.e., ot.grids.coords
+                sub_coords : ndarray of shape (nsub,3)
+                    Grid points to be visited, in any order, i.e., one atom-centered grid
+
+            Kwargs:
+                deriv : int
+                    Derivative order of AO values
+                non0tab : ndarray of shape (nblk,nbas)
+                    As in pyscf.dft.gen_grid and pyscf.dft.numint, for all of coords
+                deriv_store : int
+                    Derivative order through which AO values are stored, if higher than deriv
+
+            Returns:
+                eval_ao : callable
+                    eval_ao (ip0, ip1) returns an ndarray of shape (*,ip1-ip0,nao) with the
+                    values of ni.eval_ao (mol, sub_coords[ip0:ip1], deriv=deriv)
+        '''
+        nao = mol.nao_nr ()
+        comp = (deriv+1)*(deriv+2)*(deriv+3)//6
+        ds_val, fill = self._require_ao (ni, mol, coords, deriv=deriv, non0tab=non0tab, deriv_store=deriv_store)
+        idx = _match_coords (coords, sub_coords)
+
+        def eval_ao (ip0, ip1):
+            sel = idx[ip0:ip1]
+            out = np.empty ((comp, nao, ip1-ip0))
+            absent = np.where (sel < 0)[0]
+            if absent.size:
+                ao = ni.eval_ao (mol, sub_coords[ip0:ip1][absent], deriv=deriv)
+                out[:,:,absent] = ao.reshape (comp, absent.size, nao).transpose (0,2,1)
+            present = np.where (sel >= 0)[0]
+            present = present[np.argsort (sel[present], kind='stable')]
+            blk = sel[present] // BLKSIZE
+            bounds = np.where (np.diff (blk))[0] + 1
+            for p in np.split (present, bounds):
+                if not p.size: continue
+                b = sel[p[0]] // BLKSIZE
+                ao = fill (b, b+1)
+                p0 = b*BLKSIZE
+                if ao is None:
+                    with self._lock:
+                        buf = ds_val[:comp,:,p0:min (p0+BLKSIZE, coords.shape[0])]
+                else:
+                    buf = ao[:comp].transpose (0,2,1)
+                out[:,:,p] = buf[:,:,sel[p]-p0]
+            ao = out.transpose (0,2,1)
+            if deriv == 0: ao = ao[0]
+            return ao
+
+        return eval_ao
+
+    def grids_response_cc (self, grids):
+        ''' Cached version of pyscf.grad.rks.grids_response_cc: atom-by-atom grid coordinates,
+            weights, and weight derivatives wrt nuclear displacements '''
+        mol = grids.mol
+        grp = self._mol_group (mol)
+        key = 'grids_response/' + _grids_key (grids)
+        with self._lock:
+            done = key in grp and grp[key].attrs.get ('complete', False)
+        if done:
+            for ia in range (mol.natm):
+                with self._lock:
+                    atm = grp[key][str (ia)]
+                    coords, w0, w1 = atm['coords'][()], atm['w0'][()], atm['w1'][()]
+                yield coords, w0, w1
+            return
+        with self._lock:
+            if key in grp: del grp[key]
+            grp.require_group (key)
+        for ia, (coords, w0, w1) in enumerate (rks_grad.grids_response_cc (grids)):
+            with self._lock:
+                atm = grp[key].create_group (str (ia))
+                atm['coords'] = coords
+                atm['w0'] = w0
+                atm['w1'] = w1
+            yield coords, w0, w1
+        with self._lock:
+            grp[key].attrs['complete'] = True
+
+def gen_ao_evaluator (ot, coords, deriv=0, non0tab=None):
+    ''' Get a function which returns AO values [and derivatives] on coords[ip0:ip1], reading them
+        from ot.grid_cache if it is set. See GridCache.gen_ao_evaluator '''
+    if getattr (ot, 'grid_cache', None) is not None:
+        return ot.grid_cache.gen_ao_evaluator (ot._numint, ot.mol, coords, deriv=deriv, non0tab=non0tab,
+            deriv_store=ot.dens_deriv+1)
+    def eval_ao (ip0, ip1):
+        mask = None if non0tab is None else non0tab[ip0//BLKSIZE:]
+        return ot._numint.eval_ao (ot.mol, coords[ip0:ip1], deriv=deriv, non0tab=mask)
+    return eval_ao
+
+def gen_ao_gatherer (ot, coords, deriv=0, non0tab=None):
+    ''' Get a function which returns AO values [and derivatives] on coords[ip0:ip1], where coords
+        are points of ot.grids in any order (i.e., one atom-centered grid of grids_response_cc).
+        If ot.grid_cache is set, they are read out of the cache entry for ot.grids.coords, so the
+        gradient shares the AO values of the energy and effective-potential passes.
+        See GridCache.gen_ao_gatherer '''
+    if getattr (ot, 'grid_cache', None) is None:
+        return gen_ao_evaluator (ot, coords, deriv=deriv, non0tab=non0tab)
+    mol, grids = ot.mol, ot.grids
+    if grids.coords is None:
+        grids.build (with_non0tab=True)
+    return ot.grid_cache.gen_ao_gatherer (ot._numint, mol, grids.coords, coords, deriv=deriv,
+        non0tab=grids.non0tab, deriv_store=ot.dens_deriv+1)
+
+def block_loop (ot, nao=None, deriv=0, max_memory=2000, blksize=None):
+    ''' Drop-in for ot._numint.block_loop (ot.mol, ot.grids, nao, deriv, max_memory, blksize=blksize)
+        which reads AO values from ot.grid_cache if it is set '''
+    ni, mol, grids = ot._numint, ot.mol, ot.grids
+    if getattr (ot, 'grid_cache', None) is None:
+        for ao, mask, weight, coords in ni.block_loop (mol, grids, nao, deriv, max_memory, blksize=blksize):
+            yield ao, mask, weight, coords
+        return
+    if grids.coords is None:
+        grids.build (with_non0tab=True)
+    if nao is None:
+        nao = mol.nao_nr ()
+    ngrids = grids.coords.shape[0]
+    comp = (deriv+1)*(deriv+2)*(deriv+3)//6
+    if blksize is None:
+        blksize = int (max_memory*1e6/((comp+1)*nao*8*BLKSIZE))
+        blksize = max (4, min (blksize, ngrids//BLKSIZE+1, 1200)) * BLKSIZE
+    assert (blksize % BLKSIZE == 0)
+    non0tab = grids.non0tab
+    if non0tab is None:
+        non0tab = np.empty (((ngrids+BLKSIZE-1)//BLKSIZE, mol.nbas), dtype=np.uint8)
+        non0tab[:] = 0xff
+    eval_ao = ot.grid_cache.gen_ao_evaluator (ni, mol, grids.coords, deriv=deriv, non0tab=non0tab,
+        deriv_store=ot.dens_deriv+1)
+    for ip0 in range (0, ngrids, blksize):
+        ip1 = min (ngrids, ip0+blksize)
+        yield eval_ao (ip0, ip1), non0tab[ip0//BLKSIZE:], grids.weights[ip0:ip1], grids.coords[ip0:ip1]
+
+def grids_response_cc (ot):
+    ''' pyscf.grad.rks.grids_response_cc (ot.grids), read from ot.grid_cache if it is set '''
+    if getattr (ot, 'grid_cache', None) is None:
+        return rks_grad.grids_response_cc (ot.grids)
+    return ot.grid_cache.grids_response_cc (ot.grids)
+
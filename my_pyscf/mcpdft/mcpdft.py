@@ -1,12 +1,15 @@
 import numpy as np
-import time
+import time, gc
 from scipy import linalg
+from concurrent.futures import ThreadPoolExecutor
 from pyscf import gto, dft, ao2mo, fci, mcscf, lib
-from pyscf.lib import logger, temporary_env
+from pyscf.lib import logger, temporary_env, current_memory
+from pyscf.dft.gen_grid import BLKSIZE
 from pyscf.mcscf import mc_ao2mo
 from pyscf.mcscf.addons import StateAverageMCSCFSolver, state_average_mix, state_average_mix_
 from mrh.my_pyscf.grad.mcpdft import Gradients
 from mrh.my_pyscf.mcpdft import pdft_veff
+from mrh.my_pyscf.mcpdft.grid_cache import gen_ao_evaluator
 from mrh.my_pyscf.mcpdft.otpd import get_ontop_pair_density
 from mrh.my_pyscf.mcpdft.otfnal import otfnal, transfnal, ftransfnal
 from mrh.util.rdm import get_2CDM_from_2RDM, get_2CDMs_from_2RDMs
@@ -19,6 +22,8 @@ def kernel (mc, ot, root=-1):
                 Note: this function does not currently run the CASSCF or CASCI calculation itself
                 prior to calculating the MC-PDFT energy. Call mc.kernel () before passing to this function!
             ot : an instance of on-top density functional class - see otfnal.py
+                or a list of them, in which case the energies of all of them are evaluated
+                from the same density matrices in a single pass over the grid
 
         Kwargs:
             root : int
@@ -26,8 +31,12 @@ def kernel (mc, ot, root=-1):
                 Negative number requests state-averaged MC-PDFT results (i.e., using state-averaged density matrices)
 
         Returns:
-            Total MC-PDFT energy including nuclear repulsion energy.
+            Total MC-PDFT energy including nuclear repulsion energy, and E_ot.
+            Both are lists if ot is a list
     '''
+    ot_is_list = isinstance (ot, (list, tuple))
+    ots = list (ot) if ot_is_list else [ot]
+    ot = ots[0]
     t0 = (time.clock (), time.time ())
     amo = mc.mo_coeff[:,mc.ncore:mc.ncore+mc.ncas]
     # make_rdm12s returns (a, b), (aa, ab, bb)
@@ -43,10 +52,10 @@ def kernel (mc, ot, root=-1):
     adm1s = np.stack (mc_1root.fcisolver.make_rdm1s (mc_1root.ci, mc.ncas, mc.nelecas), axis=0)
     adm2 = get_2CDM_from_2RDM (mc_1root.fcisolver.make_rdm12 (mc_1root.ci, mc.ncas, mc.nelecas)[1], adm1s)
     spin = abs(mc.nelecas[0] - mc.nelecas[1])
-    spin = abs(mc.nelecas[0] - mc.nelecas[1])
-    omega, alpha, hyb = ot._numint.rsh_and_hybrid_coeff(ot.otxc, spin=spin)
-    hyb_x, hyb_c = hyb
-    if ot.verbose >= logger.DEBUG or abs (hyb_x) > 1e-10 or abs (hyb_c) > 1e-10:
+    hyb_x, hyb_c = np.asarray ([o._numint.rsh_and_hybrid_coeff (o.otxc, spin=spin)[2] for o in ots]).T
+    is_hyb_x = np.any (np.abs (hyb_x) > 1e-10)
+    is_hyb_c = np.any (np.abs (hyb_c) > 1e-10)
+    if ot.verbose >= logger.DEBUG or is_hyb_x or is_hyb_c:
         adm2s = get_2CDMs_from_2RDMs (mc_1root.fcisolver.make_rdm12s (mc_1root.ci, mc.ncas, mc.nelecas)[1], adm1s)
         adm2s_ss = adm2s[0] + adm2s[2]
         adm2s_os = adm2s[1]
@@ -55,7 +64,7 @@ def kernel (mc, ot, root=-1):
     Vnn = mc._scf.energy_nuc ()
     h = mc._scf.get_hcore ()
     dm1 = dm1s[0] + dm1s[1]
-    if ot.verbose >= logger.DEBUG or abs (hyb_x) > 1e-10:
+    if ot.verbose >= logger.DEBUG or is_hyb_x:
         vj, vk = mc._scf.get_jk (dm=dm1s)
         vj = vj[0] + vj[1]
     else:
@@ -64,7 +73,7 @@ def kernel (mc, ot, root=-1):
     # (vj_a + vj_b) * (dm_a + dm_b)
     E_j = np.tensordot (vj, dm1) / 2  
     # (vk_a * dm_a) + (vk_b * dm_b) Mind the difference!
-    if ot.verbose >= logger.DEBUG or abs (hyb_x) > 1e-10:
+    if ot.verbose >= logger.DEBUG or is_hyb_x:
         E_x = -(np.tensordot (vk[0], dm1s[0]) + np.tensordot (vk[1], dm1s[1])) / 2
     else:
         E_x = 0
@@ -74,7 +83,7 @@ def kernel (mc, ot, root=-1):
     logger.debug (ot, 'E_j = %s', E_j)
     logger.debug (ot, 'E_x = %s', E_x)
     E_c = 0
-    if ot.verbose >= logger.DEBUG or abs (hyb_c) > 1e-10:
+    if ot.verbose >= logger.DEBUG or is_hyb_c:
         # g_pqrs * l_pqrs / 2
         #if ot.verbose >= logger.DEBUG:
         aeri = ao2mo.restore (1, mc.get_h2eff (mc.mo_coeff), mc.ncas)
@@ -89,18 +98,22 @@ def kernel (mc, ot, root=-1):
         if isinstance (mc_1root.e_tot, float):
             e_err = mc_1root.e_tot - (Vnn + Te_Vne + E_j + E_x + E_c)
             assert (abs (e_err) < 1e-8), e_err
-    if abs (hyb_x) > 1e-10 or abs (hyb_c) > 1e-10:
-        logger.debug (ot, 'Adding %s * %s CAS exchange, %s * %s CAS correlation to E_ot', hyb_x, E_x, hyb_c, E_c)
+    for o, hx, hc in zip (ots, hyb_x, hyb_c):
+        if abs (hx) > 1e-10 or abs (hc) > 1e-10:
+            logger.debug (o, 'Adding %s * %s CAS exchange, %s * %s CAS correlation to E_ot', hx, E_x, hc, E_c)
     t0 = logger.timer (ot, 'Vnn, Te, Vne, E_j, E_x', *t0)
 
-    E_ot = get_E_ot (ot, dm1s, adm2, amo)
+    E_ot = get_E_ot_multi (ots, dm1s, adm2, amo, max_memory=mc.max_memory)
     t0 = logger.timer (ot, 'E_ot', *t0)
     e_tot = Vnn + Te_Vne + E_j + (hyb_x * E_x) + (hyb_c * E_c) + E_ot
-    logger.note (ot, 'MC-PDFT E = %s, Eot(%s) = %s', e_tot, ot.otxc, E_ot)
+    for o, e, e_ot in zip (ots, e_tot, E_ot):
+        logger.note (o, 'MC-PDFT E = %s, Eot(%s) = %s', e, o.otxc, e_ot)
 
-    return e_tot, E_ot
+    if not ot_is_list:
+        return e_tot[0], E_ot[0]
+    return list (e_tot), list (E_ot)
 
-def get_E_ot (ot, oneCDMs, twoCDM_amo, ao2amo, max_memory=20000, hermi=1):
+def get_E_ot (ot, oneCDMs, twoCDM_amo, ao2amo, max_memory=20000, hermi=1, nworkers=None):
     ''' E_MCPDFT = h_pq l_pq + 1/2 v_pqrs l_pq l_rs + E_ot[rho,Pi] 
         or, in other terms, 
         E_MCPDFT = T_KS[rho] + E_ext[rho] + E_coul[rho] + E_ot[rho, Pi]
@@ -120,33 +133,130 @@ def get_E_ot (ot, oneCDMs, twoCDM_amo, ao2amo, max_memory=20000, hermi=1):
                 default is 20000
             hermi : int
                 1 if 1CDMs are assumed hermitian, 0 otherwise
+            nworkers : int
+                number of threads among which batches of grid points are divided.
+                Each thread reduces its own partial E_ot; the partial sums are added
+                in grid order at the end. Defaults to ot.nworkers
 
         Returns : float
             The MC-PDFT on-top exchange-correlation energy
 
     '''
-    ni, xctype, dens_deriv = ot._numint, ot.xctype, ot.dens_deriv
-    norbs_ao = ao2amo.shape[0]
+    return get_E_ot_multi ([ot], oneCDMs, twoCDM_amo, ao2amo, max_memory=max_memory, hermi=hermi,
+        nworkers=nworkers)[0]
+
+def get_E_ot_multi (ots, oneCDMs, twoCDM_amo, ao2amo, max_memory=20000, hermi=1, nworkers=None):
+    ''' E_ot[rho,Pi] for several on-top functionals from a single pass over the grid. AO values,
+        rho, and Pi are evaluated once per batch of grid points, through the highest derivative
+        order required by any of the functionals, and handed to each functional's get_E_ot
+
+        Args:
+            ots : list of instances of otfnal class
+                They must share the same molecule and quadrature grid; the grid of ots[0] is used
+            oneCDMs : ndarray of shape (2, nao, nao)
+                containing spin-separated one-body density matrices
+            twoCDM_amo : ndarray of shape (ncas, ncas, ncas, ncas)
+                containing spin-summed two-body cumulant density matrix in an active space
+            ao2amo : ndarray of shape (nao, ncas)
+                containing molecular orbital coefficients for active-space orbitals
+
+        Kwargs:
+            max_memory : int or float
+                maximum cache size in MB
+                default is 20000
+            hermi : int
+                1 if 1CDMs are assumed hermitian, 0 otherwise
+            nworkers : int
+                number of threads among which batches of grid points are divided.
+                Defaults to ots[0].nworkers
 
-    E_ot = 0.0
+        Returns : ndarray of shape (len (ots))
+            The MC-PDFT on-top exchange-correlation energies
+    '''
+    ot = ots[0]
+    # Densities are evaluated for the functional with the highest derivative order
+    # and sliced down for the others
+    ot_max = max (ots, key=lambda o: o.dens_deriv)
+    ni, xctype, dens_deriv = ot._numint, ot_max.xctype, ot_max.dens_deriv
+    norbs_ao, ncas = ao2amo.shape
+    if nworkers is None: nworkers = ot.nworkers
 
     t0 = (time.clock (), time.time ())
-    make_rho = tuple (ni._gen_rho_evaluator (ot.mol, oneCDMs[i,:,:], hermi) for i in range(2))
-    for ao, mask, weight, coords in ni.block_loop (ot.mol, ot.grids, norbs_ao, dens_deriv, max_memory):
-        rho = np.asarray ([m[0] (0, ao, mask, xctype) for m in make_rho])
+    make_rho = ni._gen_rho_evaluator (ot.mol, oneCDMs, hermi)[0]
+    if ot.grids.coords is None:
+        ot.grids.build (with_non0tab=True)
+    ngrids = ot.grids.coords.shape[0]
+    blksize = get_E_ot_blksize (ot_max, norbs_ao, ncas, max_memory, nworkers=nworkers)
+    non0tab = ot.grids.non0tab
+    if non0tab is None:
+        non0tab = np.empty (((ngrids+BLKSIZE-1)//BLKSIZE, ot.mol.nbas), dtype=np.uint8)
+        non0tab[:] = 0xff
+    logger.debug (ot, 'E_ot: {} functionals; {} grid points in batches of {} divided among {} workers'.format (
+        len (ots), ngrids, blksize, nworkers))
+    eval_ao = gen_ao_evaluator (ot, ot.grids.coords, deriv=dens_deriv, non0tab=non0tab)
+
+    def get_E_ot_batch (ip0):
+        t1 = (time.clock (), time.time ())
+        ip1 = min (ngrids, ip0+blksize)
+        mask = non0tab[ip0//BLKSIZE:]
+        weight = ot.grids.weights[ip0:ip1]
+        ao = eval_ao (ip0, ip1)
+        rho = np.asarray ([make_rho (i, ao, mask, xctype) for i in range(2)])
         if ot.verbose > logger.DEBUG and dens_deriv > 0:
             for ideriv in range (1,4):
                 rho_test  = np.einsum ('ijk,aj,ak->ia', oneCDMs, ao[ideriv], ao[0])
                 rho_test += np.einsum ('ijk,ak,aj->ia', oneCDMs, ao[ideriv], ao[0])
                 logger.debug (ot, "Spin-density derivatives, |PySCF-einsum| = %s", linalg.norm (rho[:,ideriv,:]-rho_test))
-        t0 = logger.timer (ot, 'untransformed density', *t0)
-        Pi = get_ontop_pair_density (ot, rho, ao, oneCDMs, twoCDM_amo, ao2amo, dens_deriv, mask) 
-        t0 = logger.timer (ot, 'on-top pair density calculation', *t0) 
-        E_ot += ot.get_E_ot (rho, Pi, weight)
-        t0 = logger.timer (ot, 'on-top exchange-correlation energy calculation', *t0) 
+        t1 = logger.timer (ot, 'untransformed density', *t1)
+        Pi = get_ontop_pair_density (ot_max, rho, ao, oneCDMs, twoCDM_amo, ao2amo, dens_deriv, mask) 
+        t1 = logger.timer (ot, 'on-top pair density calculation', *t1) 
+        E_ot = np.zeros (len (ots))
+        for ix, o in enumerate (ots):
+            rho_o, Pi_o = _slice_dens_deriv (rho, Pi, o.dens_deriv)
+            E_ot[ix] = o.get_E_ot (rho_o, Pi_o, weight)
+        t1 = logger.timer (ot, 'on-top exchange-correlation energy calculation', *t1) 
+        return E_ot
+
+    batches = range (0, ngrids, blksize)
+    if nworkers > 1:
+        # OpenMP threads are a per-thread setting, so split them evenly among the workers
+        nthreads = max (1, lib.num_threads () // nworkers)
+        def worker (ip0):
+            with lib.with_omp_threads (nthreads):
+                return get_E_ot_batch (ip0)
+        with ThreadPoolExecutor (max_workers=nworkers) as executor:
+            # map yields results in submission order so the sum is deterministic
+            E_ot = sum (executor.map (worker, batches))
+    else:
+        E_ot = sum (get_E_ot_batch (ip0) for ip0 in batches)
+    t0 = logger.timer (ot, 'E_ot over {} grid batches'.format (len (batches)), *t0)
 
     return E_ot
 
+def _slice_dens_deriv (rho, Pi, dens_deriv):
+    ''' Views of rho and Pi, evaluated through some derivative order, that contain only what
+        a functional with the given dens_deriv expects '''
+    if rho.ndim == 2:
+        return rho, Pi
+    if dens_deriv == 0:
+        return rho[:,0], Pi[0]
+    nderiv = (1,4,rho.shape[1])[dens_deriv]
+    return rho[:,:nderiv], Pi[:nderiv]
+
+def get_E_ot_blksize (ot, norbs_ao, ncas, max_memory, nworkers=1):
+    ''' Number of grid points per batch in get_E_ot, chosen the same way as pdft_blksize in
+        pdft_veff.kernel except that the available memory is shared by nworkers batches in flight
+        and that there are at least nworkers batches '''
+    gc.collect ()
+    remaining_floats = (max_memory - current_memory ()[0]) * 1e6 / 8 / nworkers
+    nderiv_rho = (1,4,10)[ot.dens_deriv] # ?? for meta-GGA
+    # ao, rho, Pi, grid2amo, gridkern, wrk0
+    ncols = 1 + nderiv_rho * (3 + norbs_ao + ncas + ncas*ncas) + ncas*ncas
+    blksize = int (remaining_floats / (ncols * BLKSIZE)) * BLKSIZE
+    ngrids = ot.grids.coords.shape[0]
+    blksize_share = ((ngrids + nworkers - 1) // nworkers + BLKSIZE - 1) // BLKSIZE * BLKSIZE
+    return max (BLKSIZE, min (blksize, blksize_share, BLKSIZE*1200))
+
 def get_energy_decomposition (mc, ot, mo_coeff=None, ci=None):
     ''' Compute a decomposition of the MC-PDFT energy into nuclear potential, core, Coulomb, exchange,
     and correlation terms. The exchange-correlation energy at the MC-SCF level is also returned.
@@ -188,8 +298,7 @@ def _get_e_decomp (mc, ot, mo_coeff, ci, e_mcscf, e_nuc, h, xfnal, cfnal):
     adm1s = np.stack (mc_1root.fcisolver.make_rdm1s (ci, mc.ncas, mc.nelecas), axis=0)
     adm2 = get_2CDM_from_2RDM (mc_1root.fcisolver.make_rdm12 (mc_1root.ci, mc.ncas, mc.nelecas)[1], adm1s)
     mo_cas = mo_coeff[:,mc.ncore:][:,:mc.ncas]
-    e_otx = get_E_ot (xfnal, dm1s, adm2, mo_cas)
-    e_otc = get_E_ot (cfnal, dm1s, adm2, mo_cas)
+    e_otx, e_otc = get_E_ot_multi ([xfnal, cfnal], dm1s, adm2, mo_cas, max_memory=mc.max_memory)
     e_wfnxc = e_mcscf - e_nuc - e_core - e_coul
     return e_core, e_coul, e_otx, e_otc, e_wfnxc
 
@@ -200,6 +309,45 @@ def sapdft_grad_monkeypatch_(mc):
     if isinstance (mc, StateAverageMCPDFTSolver):
         return mc
     class StateAverageMCPDFT (mc.__class__, StateAverageMCPDFTSolver):
+        def get_pdft_veff_multi (self, mo=None, ci=None, incl_coul=False, paaa_only=False):
+            ''' Get the 1- and 2-body MC-PDFT effective potentials of each of a list of CI vectors in one
+                pass over the grid (see pdft_veff.kernel_multi); i.e., for state-averaged gradients
+
+                Kwargs:
+                    mo : ndarray of shape (nao,nmo)
+                        A full set of molecular orbital coefficients. Taken from self if not provided
+                    ci : list of ndarrays
+                        CI vectors of the states. Taken from self if not provided
+                    incl_coul : logical
+                        As in get_pdft_veff
+                    paaa_only : logical
+                        As in get_pdft_veff
+
+                Returns:
+                    veff1 : ndarray of shape (nstates, nao, nao)
+                        1-body effective potentials in the AO basis
+                    veff2 : list of length nstates of pdft_veff._ERIS instances
+                        Relevant 2-body effective potentials in the MO basis
+            '''
+            t0 = (time.clock (), time.time ())
+            if mo is None: mo = self.mo_coeff
+            if ci is None: ci = self.ci
+            ncore, ncas, nelecas = self.ncore, self.ncas, self.nelecas
+            fcisolver = fci.solver (self._scf.mol, singlet = False, symm = False)
+            adm1s = np.stack ([np.stack (fcisolver.make_rdm1s (c, ncas, nelecas), axis=0) for c in ci], axis=0)
+            adm2 = np.stack ([get_2CDM_from_2RDM (fcisolver.make_rdm12 (c, ncas, nelecas)[1], d)
+                for c, d in zip (ci, adm1s)], axis=0)
+            pdft_veff1, pdft_veff2 = pdft_veff.kernel_multi (self.otfnal, adm1s, adm2, mo, ncore, ncas,
+                max_memory=self.max_memory, paaa_only=paaa_only)
+            if incl_coul:
+                mo_core = mo[:,:ncore]
+                mo_cas = mo[:,ncore:][:,:ncas]
+                dm1 = 2 * (mo_core @ mo_core.T)
+                dm1 = np.stack ([dm1 + mo_cas @ d.sum (0) @ mo_cas.T for d in adm1s], axis=0)
+                pdft_veff1 += self.get_jk (self.mol, dm1)[0]
+            logger.timer (self, 'get_pdft_veff_multi', *t0)
+            return pdft_veff1, pdft_veff2
+
         def nuc_grad_method (self):
             return Gradients (self)
     mc.__class__ = StateAverageMCPDFT
@@ -222,6 +370,7 @@ def get_mcpdft_child_class (mc, ot, **kwargs):
                 self._init_ot_grids (my_ot, grids_level=grids_level)
 
         def _init_ot_grids (self, my_ot, grids_level=None):
+            old_ot = getattr (self, 'otfnal', None)
             if isinstance (my_ot, (str, np.string_)):
                 ks = dft.RKS (self.mol)
                 if my_ot[:1].upper () == 'T':
@@ -234,6 +383,10 @@ def get_mcpdft_child_class (mc, ot, **kwargs):
                     raise NotImplementedError (('On-top pair-density exchange-correlation functional names other than '
                         '"translated" (t) or "fully-translated" (ft). Nonstandard functionals can be specified by passing '
                         'an object of class otfnal in place of a string.'))
+                if old_ot is not None:
+                    # Keep the user's runtime settings when the functional is rebuilt (i.e., in kernel)
+                    self.otfnal.nworkers = old_ot.nworkers
+                    self.otfnal.grid_cache = old_ot.grid_cache
             else:
                 self.otfnal = my_ot
             self.grids = self.otfnal.grids
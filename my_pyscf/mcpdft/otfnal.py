@@ -21,6 +21,12 @@ class otfnal:
             for PySCF's logger system
         otxc: string
             name of on-top pair-density exchange-correlation functional
+        nworkers: integer
+            number of threads among which grid batches are divided when
+            evaluating the on-top energy (see mcpdft.get_E_ot)
+        grid_cache: object of class grid_cache.GridCache
+            on-disk cache of AO values on the grid shared by the energy,
+            effective potential, and gradient codes. None (default) turns it off
     '''
 
     def __init__ (self, mol, **kwargs):
@@ -29,6 +35,8 @@ class otfnal:
         self.stdout = mol.stdout    
 
     Pi_deriv = 0
+    nworkers = 1
+    grid_cache = None
 
     def _init_info (self):
         logger.info (self, 'Building %s functional', self.otxc)
@@ -229,19 +237,17 @@ class transfnal (otfnal):
         zeta[0] = np.sqrt (1.0 - R[0,idx])
 
         # Chain rule!
-        for ideriv in range (1, nderiv_zeta):
-            zeta[ideriv] = -R[ideriv,idx] / zeta[0] / 2
+        if nderiv_zeta > 1:
+            zeta[1:] = R[1:,idx] / zeta[0]
+            zeta[1:] /= -2
     
-        # Chain rule!
-        for ideriv in range (nderiv):
-            w = rho_avg[ideriv,idx] * zeta[0]
-            rho_t[0,ideriv,idx] += w
-            rho_t[1,ideriv,idx] -= w
+        # Chain rule! (all derivatives at once, on the translated points only)
+        w = rho_avg[:,idx] * zeta[None,0,:]
         # Product rule!
-        for ideriv in range (1,nderiv_zeta):
-            w = rho_avg[0,idx] * zeta[ideriv]
-            rho_t[0,ideriv,idx] += w
-            rho_t[1,ideriv,idx] -= w
+        if nderiv_zeta > 1:
+            w[1:nderiv_zeta] += rho_avg[0,idx] * zeta[1:]
+        rho_t[0][:,idx] += w
+        rho_t[1][:,idx] -= w
 
 
         return rho_t
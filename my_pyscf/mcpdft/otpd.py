@@ -1,13 +1,20 @@
 import numpy as np
 import time
 from scipy import linalg
+from pyscf import lib, __config__
 from pyscf.lib import logger
 from pyscf.lib import einsum as einsum_threads
 from pyscf.dft.numint import _dot_ao_dm
 from mrh.util.rdm import get_2CDM_from_2RDM, get_2RDM_from_2CDM
 from mrh.util.basis import represent_operator_in_basis
+from mrh.lib.helper import load_library
 from itertools import product
 from os import path
+import ctypes
+
+libpdft = load_library ('libpdft')
+# Evaluate the second cumulant of Pi [and its gradient] with VOTpair_density in libpdft if it is there
+USE_CLIB = getattr (__config__, 'mcpdft_otpd_USE_CLIB', True)
 
 def _grid_ao2mo (mol, ao, mo_coeff, non0tab=None, shls_slice=None, ao_loc=None):
     ''' ao[deriv,grid,AO].mo_coeff[AO,MO]->mo[deriv,grid,MO]
@@ -24,7 +31,22 @@ def _grid_ao2mo (mol, ao, mo_coeff, non0tab=None, shls_slice=None, ao_loc=None):
     return mo 
 
 
-def get_ontop_pair_density (ot, rho, ao, oneCDMs, twoCDM_amo, ao2amo, deriv=0, non0tab=None):
+def _ontop_cumulant_clib (fn, Pi, grid2amo, twoCDM_amo, deriv):
+    ''' Pi[:nderiv] += second-cumulant part of the on-top pair density [and gradient], in place,
+        using VOTpair_density from libpdft. grid2amo is in data layout (deriv,MO,grid) '''
+    nderiv = (1,4)[deriv]
+    ngrids, ncas = grid2amo.shape[1:]
+    mo = grid2amo[:nderiv].transpose (0,2,1)
+    assert (mo.flags.c_contiguous), 'shape = {} ; strides = {}'.format (mo.shape, mo.strides)
+    assert (Pi.flags.c_contiguous), 'shape = {} ; strides = {}'.format (Pi.shape, Pi.strides)
+    cas2 = np.ascontiguousarray (twoCDM_amo.reshape (ncas*ncas, ncas*ncas))
+    fn (Pi.ctypes.data_as (ctypes.c_void_p),
+        mo.ctypes.data_as (ctypes.c_void_p),
+        cas2.ctypes.data_as (ctypes.c_void_p),
+        ctypes.c_int (ncas), ctypes.c_int (ngrids), ctypes.c_int (nderiv))
+    return Pi
+
+def get_ontop_pair_density (ot, rho, ao, oneCDMs, twoCDM_amo, ao2amo, deriv=0, non0tab=None, use_clib=USE_CLIB):
     r''' Pi(r) = i(r)*j(r)*k(r)*l(r)*g_ijkl / 2
                = rho[0](r)*rho[1](r) + i(r)*j(r)*k(r)*l(r)*l_ijkl / 2
 
@@ -45,6 +67,10 @@ def get_ontop_pair_density (ot, rho, ao, oneCDMs, twoCDM_amo, ao2amo, deriv=0, n
             deriv : derivative order through which to calculate. Default is 0. 
                 deriv > 1 not implemented
             non0tab : as in pyscf.dft.gen_grid and pyscf.dft.numint
+            use_clib : logical
+                If true, evaluate the second cumulant and its gradient in one fused, OpenMP-parallel
+                loop in libpdft (VOTpair_density). Falls back to numpy if the library lacks it,
+                for deriv > 1, and in the debug code paths.
 
         Returns : ndarray of shape (*,ngrids)
             The on-top pair density and its derivatives if requested
@@ -93,6 +119,14 @@ def get_ontop_pair_density (ot, rho, ao, oneCDMs, twoCDM_amo, ao2amo, deriv=0, n
     #grid2amo_ref = np.tensordot (ao, ao2amo, axes=1) #np.einsum ('ijk,kl->ijl', ao, ao2amo)
     grid2amo = _grid_ao2mo (ot.mol, ao, ao2amo, non0tab=non0tab)
     t0 = logger.timer (ot, 'otpd ao2mo', *t0)
+    fn = getattr (libpdft, 'VOTpair_density', None) if use_clib else None
+    if (fn is not None and deriv < 2 and ot.verbose <= logger.DEBUG
+            and grid2amo.dtype == twoCDM_amo.dtype == Pi.dtype == np.double):
+        _ontop_cumulant_clib (fn, Pi, grid2amo, twoCDM_amo, deriv)
+        t0 = logger.timer_debug1 (ot, 'otpd second cumulant (libpdft)', *t0)
+        if Pi.shape[0] == 1:
+            Pi = Pi.reshape (Pi.shape[1])
+        return Pi
     gridkern = np.zeros (grid2amo.shape + (grid2amo.shape[2],), dtype=grid2amo.dtype)
     gridkern[0] = grid2amo[0,:,:,np.newaxis] * grid2amo[0,:,np.newaxis,:]  # r_0ai,  r_0aj  -> r_0aij
     wrk0 = np.tensordot (gridkern[0], twoCDM_amo, axes=2)                  # r_0aij, P_ijkl -> P_0akl
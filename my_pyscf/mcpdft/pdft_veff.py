@@ -4,6 +4,7 @@ from pyscf.lib import einsum as einsum_threads
 from pyscf.dft import numint
 from pyscf.dft.gen_grid import BLKSIZE
 from mrh.my_pyscf.mcpdft.otpd import get_ontop_pair_density, _grid_ao2mo
+from mrh.my_pyscf.mcpdft import grid_cache
 from mrh.lib.helper import load_library
 from scipy import linalg
 from os import path
@@ -25,6 +26,9 @@ import time, gc, ctypes
 # is what it is.
 
 SWITCH_SIZE = getattr(__config__, 'dft_numint_SWITCH_SIZE', 800)
+# Grid points on which no element of the 2-body effective potential can receive a contribution larger
+# than this are dropped before the 2-body contractions; see _screen_2body
+PAIR_SCREEN_THRESH = getattr(__config__, 'mcpdft_pdft_veff_PAIR_SCREEN_THRESH', 1e-14)
 libpdft = load_library('libpdft')
 
 class _ERIS(object):
@@ -75,6 +79,12 @@ class _ERIS(object):
             vhf_a[ncore:nocc,:] = vhf_a[:,ncore:nocc] = 0.0
             self.vhf_c += vhf_a
         # ppaa
+        idx_grid, idx_ao = _screen_2body (ao, mo_cas, weight, [vPi], non0tab, ao_loc,
+            nao_idx=(2,1)[int (self.paaa_only)])
+        if idx_grid is not None and len (idx_grid) == 0: return
+        ao, mo_cas, weight, vPi = _gather_2body (ao, mo_cas, weight, [vPi], idx_grid, idx_ao)
+        vPi = vPi[0]
+        if idx_ao is not None: mo_coeff = mo_coeff[idx_ao,:]
         if self.paaa_only:
             paaa = ot.get_veff_2body (rho, Pi, [ao, mo_cas, mo_cas, mo_cas], weight, aosym='s1', kern=vPi)
             paaa = np.tensordot (mo_coeff.T, paaa, axes=1)
@@ -155,6 +165,123 @@ def kernel (ot, oneCDMs_amo, twoCDM_amo, mo_coeff, ncore, ncas, max_memory=20000
     veff2 = _ERIS (ot.mol, mo_coeff, ncore, ncas, paaa_only=paaa_only, verbose=ot.verbose, stdout=ot.stdout)
 
     t0 = (time.clock (), time.time ())
+    dm_core, dm_cas, dm1s = _get_tagged_dms (oneCDMs_amo, mo_coeff, ncore, ncas)
+    make_rho_c, nset_c, nao_c = ni._gen_rho_evaluator (ot.mol, dm_core, hermi)
+    make_rho_a, nset_a, nao_a = ni._gen_rho_evaluator (ot.mol, dm_cas, hermi)
+    make_rho, nset, nao = ni._gen_rho_evaluator (ot.mol, dm1s, hermi)
+    pdft_blksize = _get_pdft_blksize (ot, norbs_ao, ncas, max_memory, paaa_only)
+    shls_slice = (0, ot.mol.nbas)
+    ao_loc = ot.mol.ao_loc_nr()
+    for ao, mask, weight, coords in grid_cache.block_loop (ot, norbs_ao, dens_deriv, max_memory, blksize=pdft_blksize):
+        rho = np.asarray ([make_rho (i, ao, mask, xctype) for i in range(2)])
+        rho_a = np.asarray ([make_rho_a (i, ao, mask, xctype) for i in range(2)])
+        rho_c = make_rho_c (0, ao, mask, xctype)
+        t0 = logger.timer (ot, 'untransformed densities (core and total)', *t0)
+        Pi = get_ontop_pair_density (ot, rho, ao, dm1s, twoCDM_amo, ao2amo, dens_deriv, mask)
+        t0 = logger.timer (ot, 'on-top pair density calculation', *t0)
+        eot, vrho, vPi = ot.eval_ot (rho, Pi, weights=weight)
+        t0 = logger.timer (ot, 'effective potential kernel calculation', *t0)
+        veff1 += ot.get_veff_1body (rho, Pi, ao, weight, non0tab=mask, shls_slice=shls_slice, ao_loc=ao_loc, hermi=1, kern=vrho)
+        t0 = logger.timer (ot, '1-body effective potential calculation', *t0)
+        #ao[:,:,:] = np.tensordot (ao, mo_coeff, axes=1)
+        #t0 = logger.timer (ot, 'ao2mo grid points', *t0)
+        veff2._accumulate (ot, rho, Pi, ao, weight, rho_c, rho_a, vPi, mask, shls_slice, ao_loc)
+        t0 = logger.timer (ot, '2-body effective potential calculation', *t0)
+    veff2._finalize ()
+    t0 = logger.timer (ot, 'Finalizing 2-body effective potential calculation', *t0)
+    return veff1, veff2
+
+def kernel_multi (ot, oneCDMs_amo, twoCDM_amo, mo_coeff, ncore, ncas, max_memory=20000, hermi=1, paaa_only=False):
+    ''' Get the 1- and 2-body effective potentials from MC-PDFT for several states at once,
+        i.e., for state-averaged gradients. The AO values, core density, and active-orbital values
+        on each batch of grid points are evaluated once for all states, and the 1- and 2-body
+        potentials of all states are accumulated with one matrix multiplication per derivative
+        component in which the state index is folded into the columns.
+
+        Args:
+            ot : an instance of otfnal class
+            oneCDMs_amo : ndarray of shape (nstates, 2, ncas, ncas)
+                containing spin-separated one-body density matrices of each state
+            twoCDM_amo : ndarray of shape (nstates, ncas, ncas, ncas, ncas)
+                containing spin-summed two-body cumulant density matrices of each state
+            mo_coeff : ndarray of shape (nao, nmo)
+                containing molecular orbital coefficients
+            ncore : int
+                number of inactive orbitals
+            ncas : int
+                number of active orbitals
+
+        Kwargs:
+            max_memory : int or float
+                maximum cache size in MB
+                default is 20000
+            hermi : int
+                1 if 1CDMs are assumed hermitian, 0 otherwise
+            paaa_only : logical
+                As in kernel
+
+        Returns:
+            veff1 : ndarray of shape (nstates, nao, nao)
+                1-body effective potential of each state in the AO basis
+            veff2 : list of length nstates of _ERIS
+                2-body effective potential of each state
+    '''
+    nstates = len (oneCDMs_amo)
+    nocc = ncore + ncas
+    ni, xctype, dens_deriv = ot._numint, ot.xctype, ot.dens_deriv
+    norbs_ao = mo_coeff.shape[0]
+    ao2amo = mo_coeff[:,ncore:nocc]
+
+    veff1 = np.zeros ((nstates, norbs_ao, norbs_ao), dtype=oneCDMs_amo.dtype)
+    veff2 = [_ERIS (ot.mol, mo_coeff, ncore, ncas, paaa_only=paaa_only, verbose=ot.verbose, stdout=ot.stdout)
+        for i in range (nstates)]
+
+    t0 = (time.clock (), time.time ())
+    dms = [_get_tagged_dms (d, mo_coeff, ncore, ncas) for d in oneCDMs_amo]
+    dm_core = dms[0][0]
+    dm_cas = tag_array (np.concatenate ([d[1] for d in dms], axis=0),
+        mo_coeff=np.concatenate ([d[1].mo_coeff for d in dms], axis=0),
+        mo_occ=np.concatenate ([d[1].mo_occ for d in dms], axis=0))
+    dm1s = [d[2] for d in dms]
+    dm1s_all = tag_array (np.concatenate (dm1s, axis=0),
+        mo_coeff=np.concatenate ([d.mo_coeff for d in dm1s], axis=0),
+        mo_occ=np.concatenate ([d.mo_occ for d in dm1s], axis=0))
+    make_rho_c = ni._gen_rho_evaluator (ot.mol, dm_core, hermi)[0]
+    make_rho_a = ni._gen_rho_evaluator (ot.mol, dm_cas, hermi)[0]
+    make_rho = ni._gen_rho_evaluator (ot.mol, dm1s_all, hermi)[0]
+    pdft_blksize = _get_pdft_blksize (ot, norbs_ao, ncas, max_memory, paaa_only, nstates=nstates)
+    shls_slice = (0, ot.mol.nbas)
+    ao_loc = ot.mol.ao_loc_nr()
+    for ao, mask, weight, coords in grid_cache.block_loop (ot, norbs_ao, dens_deriv, max_memory, blksize=pdft_blksize):
+        rho = np.asarray ([make_rho (i, ao, mask, xctype) for i in range(2*nstates)])
+        rho = rho.reshape (nstates, 2, *rho.shape[1:])
+        rho_a = np.asarray ([make_rho_a (i, ao, mask, xctype) for i in range(2*nstates)])
+        rho_a = rho_a.reshape (nstates, 2, *rho_a.shape[1:])
+        rho_c = make_rho_c (0, ao, mask, xctype)
+        t0 = logger.timer (ot, 'untransformed densities (core and total)', *t0)
+        Pi = [get_ontop_pair_density (ot, r, ao, d, t, ao2amo, dens_deriv, mask)
+            for r, d, t in zip (rho, dm1s, twoCDM_amo)]
+        t0 = logger.timer (ot, 'on-top pair density calculation', *t0)
+        vrho, vPi = [], []
+        for r, p in zip (rho, Pi):
+            eot, vr, vp = ot.eval_ot (r, p, weights=weight)
+            vrho.append (vr)
+            vPi.append (vp)
+        t0 = logger.timer (ot, 'effective potential kernel calculation', *t0)
+        veff1 += _get_veff_1body_multi (ao, weight, vrho)
+        t0 = logger.timer (ot, '1-body effective potential calculation', *t0)
+        _accumulate_incore_multi (veff2, ao, weight, rho_c, rho_a, vPi, mask)
+        t0 = logger.timer (ot, '2-body effective potential calculation', *t0)
+    for v in veff2: v._finalize ()
+    t0 = logger.timer (ot, 'Finalizing 2-body effective potential calculation', *t0)
+    return veff1, veff2
+
+def _get_tagged_dms (oneCDMs_amo, mo_coeff, ncore, ncas):
+    ''' Core, active, and total spin-density matrices in the AO basis, tagged with the natural
+        orbitals and occupations that _gen_rho_evaluator needs to evaluate them on the grid '''
+    nocc = ncore + ncas
+    mo_core = mo_coeff[:,:ncore]
+    ao2amo = mo_coeff[:,ncore:nocc]
     dm_core = mo_core @ mo_core.T 
     dm_cas = np.dot (ao2amo, np.dot (oneCDMs_amo, ao2amo.T)).transpose (1,0,2)
     dm1s = dm_cas + dm_core[None,:,:] 
@@ -178,15 +305,17 @@ def kernel (ot, oneCDMs_amo, twoCDM_amo, mo_coeff, ncore, ncas, max_memory=20000
     tag_coeff[:,:,ncore:nocc] = amo_coeff 
     dm1s = tag_array (dm1s, mo_coeff=tag_coeff, mo_occ=mo_occ)
     # End tag block
-    make_rho_c, nset_c, nao_c = ni._gen_rho_evaluator (ot.mol, dm_core, hermi)
-    make_rho_a, nset_a, nao_a = ni._gen_rho_evaluator (ot.mol, dm_cas, hermi)
-    make_rho, nset, nao = ni._gen_rho_evaluator (ot.mol, dm1s, hermi)
+    return dm_core, dm_cas, dm1s
+
+def _get_pdft_blksize (ot, norbs_ao, ncas, max_memory, paaa_only, nstates=1):
+    ''' Number of grid points per batch in kernel and kernel_multi, given the memory available '''
+    dens_deriv = ot.dens_deriv
     gc.collect ()
     remaining_floats = (max_memory - current_memory ()[0]) * 1e6 / 8
     nderiv_rho = (1,4,10)[dens_deriv] # ?? for meta-GGA
     nderiv_Pi = (1,4)[ot.Pi_deriv]
     ncols_v2 = norbs_ao*ncas + ncas**2 if paaa_only else 2*norbs_ao*ncas
-    ncols = 1 + nderiv_rho * (5 + norbs_ao*2) + nderiv_Pi * (1 + ncols_v2) 
+    ncols = 1 + nderiv_rho * (5*nstates + norbs_ao*2) + nderiv_Pi * (1 + ncols_v2) * nstates
     pdft_blksize = int (remaining_floats / (ncols * BLKSIZE)) * BLKSIZE # something something indexing
     if ot.grids.coords is None:
         ot.grids.build(with_non0tab=True)
@@ -194,26 +323,183 @@ def kernel (ot, oneCDMs_amo, twoCDM_amo, mo_coeff, ncore, ncas, max_memory=20000
     pdft_blksize = max(BLKSIZE, min(pdft_blksize, ngrids, BLKSIZE*1200))
     logger.debug (ot, '{} MB used of {} available; block size of {} chosen for grid with {} points'.format (
         current_memory ()[0], max_memory, pdft_blksize, ngrids))
-    shls_slice = (0, ot.mol.nbas)
-    ao_loc = ot.mol.ao_loc_nr()
-    for ao, mask, weight, coords in ni.block_loop (ot.mol, ot.grids, norbs_ao, dens_deriv, max_memory, blksize=pdft_blksize):
-        rho = np.asarray ([make_rho (i, ao, mask, xctype) for i in range(2)])
-        rho_a = np.asarray ([make_rho_a (i, ao, mask, xctype) for i in range(2)])
-        rho_c = make_rho_c (0, ao, mask, xctype)
-        t0 = logger.timer (ot, 'untransformed densities (core and total)', *t0)
-        Pi = get_ontop_pair_density (ot, rho, ao, dm1s, twoCDM_amo, ao2amo, dens_deriv, mask)
-        t0 = logger.timer (ot, 'on-top pair density calculation', *t0)
-        eot, vrho, vPi = ot.eval_ot (rho, Pi, weights=weight)
-        t0 = logger.timer (ot, 'effective potential kernel calculation', *t0)
-        veff1 += ot.get_veff_1body (rho, Pi, ao, weight, non0tab=mask, shls_slice=shls_slice, ao_loc=ao_loc, hermi=1, kern=vrho)
-        t0 = logger.timer (ot, '1-body effective potential calculation', *t0)
-        #ao[:,:,:] = np.tensordot (ao, mo_coeff, axes=1)
-        #t0 = logger.timer (ot, 'ao2mo grid points', *t0)
-        veff2._accumulate (ot, rho, Pi, ao, weight, rho_c, rho_a, vPi, mask, shls_slice, ao_loc)
-        t0 = logger.timer (ot, '2-body effective potential calculation', *t0)
-    veff2._finalize ()
-    t0 = logger.timer (ot, 'Finalizing 2-body effective potential calculation', *t0)
-    return veff1, veff2
+    return pdft_blksize
+
+def _accumulate_incore_multi (veff2, ao, weight, rho_c, rho_a, vPi, non0tab):
+    ''' _ERIS._accumulate_incore for several states at once. The active-orbital values on the grid
+        and the (ao x mo_cas) pair products are shared by all states; the state index is carried
+        through the matrix multiplications of the 1- and 2-body terms.
+
+        Args:
+            veff2 : list of length nstates of _ERIS
+                sharing mo_coeff, ncore, ncas, and paaa_only
+            ao : ndarray of shape (*,ngrids,nao)
+                AO values [and derivatives]
+            weight : ndarray of shape (ngrids)
+            rho_c : ndarray of shape (*,ngrids)
+                core density [and derivatives]
+            rho_a : ndarray of shape (nstates,2,*,ngrids)
+                spin-separated active density [and derivatives] of each state
+            vPi : list of length nstates of ndarrays of shape (*,ngrids)
+                derivative of the on-top energy wrt the pair density for each state
+            non0tab : ndarray of shape (nblk,nbas)
+    '''
+    eris0 = veff2[0]
+    mo_coeff = eris0.mo_coeff
+    ncore, ncas, paaa_only = eris0.ncore, eris0.ncas, eris0.paaa_only
+    nocc = ncore + ncas
+    moH = mo_coeff.conjugate ().T
+    mo_cas = _grid_ao2mo (eris0.mol, ao, mo_coeff[:,ncore:nocc], non0tab)
+    # vhf_c
+    vrho_c = [_contract_vot_rho (v, rho_c) for v in vPi]
+    vhf_c = _get_veff_1body_multi (ao, weight, vrho_c)
+    for eris, v in zip (veff2, vhf_c):
+        eris.vhf_c += moH @ v @ mo_coeff
+    if paaa_only:
+        # 1/2 v_aiuv D_ii D_uv = v^ai_uv D_uv -> F_ai, F_ia needs to be in here since it would otherwise be calculated using ppaa and papa
+        vrho_a = [_contract_vot_rho (v, r.sum (0)) for v, r in zip (vPi, rho_a)]
+        vhf_a = _get_veff_1body_multi (ao, weight, vrho_a)
+        for eris, v in zip (veff2, vhf_a):
+            v = moH @ v @ mo_coeff
+            v[ncore:nocc,:] = v[:,ncore:nocc] = 0.0
+            eris.vhf_c += v
+    # ppaa
+    ao_loc = eris0.mol.ao_loc_nr ()
+    idx_grid, idx_ao = _screen_2body (ao, mo_cas, weight, vPi, non0tab, ao_loc,
+        nao_idx=(2,1)[int (paaa_only)])
+    if idx_grid is not None and len (idx_grid) == 0: return
+    ao, mo_cas, weight, vPi = _gather_2body (ao, mo_cas, weight, vPi, idx_grid, idx_ao)
+    if idx_ao is not None: mo_coeff = mo_coeff[idx_ao,:]
+    if paaa_only:
+        paaa = _get_veff_2body_multi ([ao, mo_cas, mo_cas, mo_cas], weight, vPi)
+        for eris, v in zip (veff2, paaa):
+            v = np.tensordot (mo_coeff.T, v, axes=1)
+            eris.papa[:,:,ncore:nocc,:] += v
+            eris.papa[ncore:nocc,:,:,:] += v.transpose (2,3,0,1)
+            eris.papa[ncore:nocc,:,ncore:nocc,:] -= v[ncore:nocc,:,:,:]
+    else:
+        papa = _get_veff_2body_multi ([ao, mo_cas, ao, mo_cas], weight, vPi)
+        for eris, v in zip (veff2, papa):
+            v = np.tensordot (mo_coeff.T, v, axes=1)
+            eris.papa += np.tensordot (mo_coeff.T, v, axes=((1),(2))).transpose (1,2,0,3)
+
+def _screen_2body (ao, mo_cas, weight, kerns, non0tab=None, ao_loc=None, nao_idx=1, thresh=None):
+    ''' Find the grid points and AOs which contribute to the 2-body effective potential on this batch
+        of grid points. A point is dropped if the bound |weight * kern| * max|ao|**nao_idx *
+        max|mo_cas|**(4-nao_idx) on its contribution to any element falls below thresh for all
+        kernels; an AO is dropped if its shell is screened out by non0tab on every BLKSIZE block
+        holding a point that survives.
+
+        Args:
+            ao : ndarray of shape (*,ngrids,nao)
+            mo_cas : ndarray of shape (*,ngrids,ncas)
+            weight : ndarray of shape (ngrids)
+            kerns : list of ndarrays of shape (*,ngrids)
+                The derivatives of the on-top energy wrt the pair density
+
+        Kwargs:
+            non0tab : ndarray of shape (nblk,nbas)
+            ao_loc : ndarray of length nbas+1
+            nao_idx : int
+                Number of AO indices of the 2-body potential (1 for paaa, 2 for papa)
+            thresh : float
+                Defaults to the module-level PAIR_SCREEN_THRESH
+
+        Returns:
+            idx_grid : ndarray of ints or None
+                Surviving grid points; None if all of them survive
+            idx_ao : ndarray of bools or None
+                Surviving AOs; None if all of them survive
+    '''
+    if thresh is None: thresh = PAIR_SCREEN_THRESH
+    ngrids, nao = ao.shape[-2:]
+    nderiv = kerns[0].shape[0]
+    vmax = np.amax ([np.abs (k).sum (0) for k in kerns], axis=0) * np.abs (weight)
+    ao_max = np.abs (ao.reshape (-1, ngrids, nao)[:nderiv]).max ((0,2))
+    mo_max = np.abs (mo_cas.reshape (-1, ngrids, mo_cas.shape[-1])[:nderiv]).max ((0,2))
+    idx_grid = np.where (vmax * (ao_max**nao_idx) * (mo_max**(4-nao_idx)) >= thresh)[0]
+    idx_ao = None
+    if non0tab is not None and ao_loc is not None and len (idx_grid):
+        blks = np.unique (idx_grid // BLKSIZE)
+        idx_ao = np.repeat (non0tab[blks].any (0), np.diff (ao_loc))
+        if idx_ao.all (): idx_ao = None
+    if len (idx_grid) == ngrids: idx_grid = None
+    return idx_grid, idx_ao
+
+def _gather_2body (ao, mo_cas, weight, kerns, idx_grid=None, idx_ao=None):
+    ''' Compress AO, active-orbital, weight and kernel arrays to the grid points and AOs that survive
+        _screen_2body, keeping the (deriv,orb,grid) data layout the 2-body contractions require '''
+    if idx_grid is None and idx_ao is None:
+        return ao, mo_cas, weight, kerns
+    # Index in data layout (deriv,orb,grid) and transpose back
+    ao = ao.transpose (0,2,1)
+    mo_cas = mo_cas.transpose (0,2,1)
+    if idx_ao is not None:
+        ao = ao[:,idx_ao,:]
+    if idx_grid is not None:
+        ao = ao[:,:,idx_grid]
+        mo_cas = mo_cas[:,:,idx_grid]
+        weight = weight[idx_grid]
+        kerns = [k[:,idx_grid] for k in kerns]
+    ao = np.ascontiguousarray (ao).transpose (0,2,1)
+    mo_cas = np.ascontiguousarray (mo_cas).transpose (0,2,1)
+    return ao, mo_cas, weight, kerns
+
+def _get_veff_1body_multi (ao, weight, kerns):
+    ''' get_veff_1body (hermi=1) for several kernels sharing one set of AO values. For each
+        derivative component, the kernel-scaled AO values of all states are laid side by side and
+        contracted with the bra AO values in a single GEMM.
+
+        Args:
+            ao : ndarray of shape (*,ngrids,nao)
+            weight : ndarray of shape (ngrids)
+            kerns : list of length nstates of ndarrays of shape (*,ngrids)
+
+        Returns : ndarray of shape (nstates,nao,nao)
+    '''
+    nstates = len (kerns)
+    ngrids, nao = ao.shape[-2:]
+    vaos = [_contract_vot_ao (k * weight[None,:], ao) for k in kerns]
+    nterm = vaos[0].shape[0]
+    veff = np.zeros ((nao, nstates, nao), dtype=ao.dtype)
+    vao_i = np.empty ((nstates, nao, ngrids), dtype=ao.dtype)
+    for i in range (nterm):
+        for vao_s, vao in zip (vao_i, vaos):
+            vao_s[:,:] = vao[i].T
+        veff += lib.dot (ao[i].T, vao_i.reshape (nstates*nao, ngrids).T).reshape (nao, nstates, nao)
+    return np.ascontiguousarray (veff.transpose (1,0,2))
+
+def _get_veff_2body_multi (ao, weight, kerns):
+    ''' get_veff_2body (aosym='s1') for several kernels sharing one set of orbital values. The
+        products of the i,j orbitals are formed once; for each derivative component, the k,l
+        intermediates of all states are laid side by side and contracted with them in a single GEMM.
+
+        Args:
+            ao : list of 4 ndarrays of shape (*,ngrids,*)
+                As in get_veff_2body
+            weight : ndarray of shape (ngrids)
+            kerns : list of length nstates of ndarrays of shape (*,ngrids)
+
+        Returns : ndarray of shape (nstates,ni,nj,nk,nl)
+    '''
+    nstates = len (kerns)
+    ngrids = weight.shape[0]
+    vaos = [_contract_ao_vao (ao[2], _contract_vot_ao (k * weight[None,:], ao[3])) for k in kerns]
+    nderiv = vaos[0].shape[0]
+    # Put in column-major order so reshape doesn't make a copy (see get_veff_2body)
+    ao2 = _contract_ao1_ao2 (ao[0], ao[1], nderiv).transpose (0,3,2,1)
+    vaos = [v.transpose (0,3,2,1) for v in vaos]
+    ij_shape, kl_shape = list (ao2.shape[1:-1]), list (vaos[0].shape[1:-1])
+    ao2 = ao2.reshape (nderiv, -1, ngrids)
+    nkl = vaos[0][0].size // ngrids
+    vao_d = np.empty ((nstates, nkl, ngrids), dtype=ao2.dtype)
+    veff = 0
+    for d in range (nderiv):
+        for vao_s, vao in zip (vao_d, vaos):
+            vao_s[:,:] = vao[d].reshape (nkl, ngrids)
+        veff = veff + lib.dot (ao2[d], vao_d.reshape (nstates*nkl, ngrids).T)
+    veff = veff.reshape (*ij_shape, nstates, *kl_shape)
+    return np.moveaxis (veff, 2, 0)
 
 def lazy_kernel (ot, oneCDMs, twoCDM_amo, ao2amo, max_memory=20000, hermi=1, veff2_mo=None):
     ''' Get the 1- and 2-body effective potential from MC-PDFT. Eventually I'll be able to specify
@@ -250,7 +536,7 @@ def lazy_kernel (ot, oneCDMs, twoCDM_amo, ao2amo, max_memory=20000, hermi=1, vef
 
     t0 = (time.clock (), time.time ())
     make_rho = tuple (ni._gen_rho_evaluator (ot.mol, oneCDMs[i,:,:], hermi) for i in range(2))
-    for ao, mask, weight, coords in ni.block_loop (ot.mol, ot.grids, norbs_ao, dens_deriv, max_memory):
+    for ao, mask, weight, coords in grid_cache.block_loop (ot, norbs_ao, dens_deriv, max_memory):
         rho = np.asarray ([m[0] (0, ao, mask, xctype) for m in make_rho])
         t0 = logger.timer (ot, 'untransformed density', *t0)
         Pi = get_ontop_pair_density (ot, rho, ao, oneCDMs, twoCDM_amo, ao2amo, dens_deriv, mask)
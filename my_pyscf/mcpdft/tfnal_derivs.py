@@ -38,8 +38,7 @@ def eval_ot (otfnal, rho, Pi, weights=None):
         vxc[1,1:4,:] += rho_t[1,1:4] * vsigma[:,2] * 2 # sigma_dd
 
     eot *= rho_t[:,0,:].sum (0)
-    vrho = otfnal.get_dEot_drho (rho, Pi, vxc=vxc)
-    vot = otfnal.get_dEot_dPi (rho, Pi, vxc=vxc)
+    vrho, vot = get_dEot_drho_dPi (otfnal, rho, Pi, vxc=vxc)
     return eot, vrho, vot
 
 def get_bare_vxc (otfnal, rho, Pi, weights=None):
@@ -108,32 +107,7 @@ def get_dEot_drho (otfnal, rho, Pi, Rmax=1, zeta_deriv=False, vxc=None):
         energy wrt to total density and its derivatives
         The potential must be spin-symmetric in pair-density functional theory
     '''
-    nderiv, ngrid = rho.shape[1:]
-    nderiv_zeta = nderiv if zeta_deriv else 1
-    if vxc is None:
-        vxc = otfnal.get_bare_vxc (rho, Pi)
-    rho_tot = rho.sum (0)
-    R = otfnal.get_ratio (Pi[0:nderiv_zeta,:], rho_tot[0:nderiv_zeta,:]/2)
-
-    # The first term is just the average of the two spin components of vxc; other terms involve the difference
-    vot = vxc.sum (0) / 2
-    vdiff = (vxc[0] - vxc[1]) / 2
-
-    # Be careful with this indexing!!
-    idx = (rho_tot[0] >= 1e-15) & (Pi[0] >= 1e-15) & (Rmax > R[0])
-    zeta = np.empty_like (R[:,idx])
-    zeta[0] = np.sqrt (1.0 - R[0,idx])
-
-    # Zeroth and first derivatives both have a term of vdiff * zeta
-    vot[:,idx] += vdiff[:,idx] * zeta[None,0,:]    
-
-    # Zeroth derivative has a couple additional terms
-    RoZ = R[0,idx] / zeta[0]
-    vot[0,idx] += vdiff[0,idx] * RoZ
-    if nderiv > 1:
-        vot[0,idx] += (vdiff[1:4,idx] * rho_tot[1:4,idx]).sum (0) * RoZ / rho_tot[0,idx]
-
-    return vot
+    return get_dEot_drho_dPi (otfnal, rho, Pi, Rmax=Rmax, zeta_deriv=zeta_deriv, vxc=vxc)[0]
 
         
 def get_dEot_dPi (otfnal, rho, Pi, Rmax=1, zeta_deriv=False, vxc=None):
@@ -168,31 +142,76 @@ def get_dEot_dPi (otfnal, rho, Pi, Rmax=1, zeta_deriv=False, vxc=None):
         The functional derivative of the on-top pair density exchange-correlation
         energy wrt to the on-top pair density and its derivatives
     '''
-    nderiv, ngrid = Pi.shape
-    nderiv_zeta = nderiv if zeta_deriv else 1
+    return get_dEot_drho_dPi (otfnal, rho, Pi, Rmax=Rmax, zeta_deriv=zeta_deriv, vxc=vxc)[1]
+
+def get_dEot_drho_dPi (otfnal, rho, Pi, Rmax=1, zeta_deriv=False, vxc=None):
+    r''' get the functional derivatives dE_ot/drho and dE_ot/dPi together (see get_dEot_drho and
+    get_dEot_dPi for the math). Both share the ratio R, the mask of translated grid points, and zeta,
+    which are computed once here; every term involving zeta is evaluated only on the translated points,
+    which are gathered out of vxc and rho once and then worked on in place.
+
+    Args:
+        rho : ndarray of shape (2,*,ngrids)
+            containing spin-density [and derivatives]
+        Pi : ndarray with shape (*,ngrids)
+            containing on-top pair density [and derivatives]
+
+    Kwargs:
+        Rmax : float
+            For ratios above this value, rho is not translated
+        zeta_deriv : logical
+            If true, propagate derivatives through the zeta intermediate as in
+            ``fully-translated'' PDFT
+        vxc : ndarray of shape (2,*,ngrids)
+            functional derivative of the on-top xc energy wrt translated densities
+
+    Returns:
+        vrho : ndarray of shape (*,ngrids)
+            As returned by get_dEot_drho
+        vot : ndarray of shape (1,ngrids)
+            As returned by get_dEot_dPi
+    '''
+    # vrho carries as many derivatives as rho and vot as many as Pi, which may have fewer
+    nderiv, ngrid = rho.shape[1:]
+    nderiv_Pi = Pi.shape[0]
+    nderiv_zeta = min (nderiv, nderiv_Pi) if zeta_deriv else 1
     if vxc is None:
         vxc = otfnal.get_bare_vxc (rho, Pi)
-    vot = np.zeros ((1,ngrid))
     rho_tot = rho.sum (0)
     R = otfnal.get_ratio (Pi[0:nderiv_zeta,:], rho_tot[0:nderiv_zeta,:]/2)
 
-    # Vot has no term with zero zeta; its terms have a cofactor of vxc_b - vxc_a
-    vdiff = vxc[1] - vxc[0]
-
     # Be careful with this indexing!!
     idx = (rho_tot[0] >= 1e-15) & (Pi[0] >= 1e-15) & (Rmax > R[0])
-    zeta = np.empty_like (R[:,idx])
-    zeta[0] = np.sqrt (1.0 - R[0,idx])
-
-    # Zeroth derivative of rho
-    rhoZinv = np.reciprocal (rho_tot[0,idx] * zeta[0])
-    vot[0,idx] += vdiff[0,idx] * rhoZinv
-
-    # First derivative of rho
+    R = R[0,idx]
+    zeta = np.sqrt (1.0 - R)
+    rho0 = rho_tot[0,idx]
+    # vdiff = vxc_a - vxc_b on translated points only
+    vdiff = vxc[0][:,idx]
+    vdiff -= vxc[1][:,idx]
+
+    # dEot/drho: the first term is just the average of the two spin components of vxc; other terms
+    # involve the half-difference. Zeroth and first derivatives both have a term of vdiff/2 * zeta
+    vrho = vxc.sum (0) / 2
+    vdiff /= 2
+    wrk = vdiff * zeta[None,:]
+    # Zeroth derivative has a couple additional terms
+    RoZ = R / zeta
+    wrk[0] += vdiff[0] * RoZ
     if nderiv > 1:
-        vot[0,idx] += (vdiff[1:4,idx] * rho_tot[1:4,idx]).sum (0) * rhoZinv / rho_tot[0,idx]
+        drho = rho_tot[1:4][:,idx]
+        wrk[0] += (vdiff[1:4] * drho).sum (0) * RoZ / rho0
+    vrho[:,idx] += wrk
+
+    # dEot/dPi: no term with zero zeta; its terms have a cofactor of vxc_b - vxc_a
+    vdiff *= -2
+    vot = np.zeros ((1,ngrid))
+    rhoZinv = np.reciprocal (rho0 * zeta)
+    wrk = vdiff[0] * rhoZinv
+    if nderiv > 1 and nderiv_Pi > 1:
+        wrk += (vdiff[1:4] * drho).sum (0) * rhoZinv / rho0
+    vot[0,idx] = wrk
 
-    return vot
+    return vrho, vot
 
 
 
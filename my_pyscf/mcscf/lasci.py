@@ -9,10 +9,11 @@ from mrh.my_pyscf.scf import hf_as
 from mrh.my_pyscf.df.sparse_df import sparsedf_array
 from mrh.my_pyscf.mcscf.lassi import lassi
 from itertools import combinations, product
+from concurrent.futures import ThreadPoolExecutor
 from scipy.sparse import linalg as sparse_linalg
 from scipy import linalg, special
 import numpy as np
-import time
+import time, os, h5py
 
 # This must be locked to CSF solver for the forseeable future, because I know of no other way to handle spin-breaking potentials while retaining spin constraint
 
@@ -249,10 +250,16 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         for fcibox, no, ne in zip (self.fciboxes, ncas_sub, nelecas_sub):
             self.linkstrl.append (fcibox.states_gen_linkstr (no, ne, True)) 
             self.linkstr.append (fcibox.states_gen_linkstr (no, ne, False))
-        self.hci0 = self.Hci_all (None, self.h1frs_aa, self.eri_cas, ci)
+        # The CI Hamiltonians are fixed within the macrocycle: absorb h1 into h2 once, here,
+        # rather than in ci_response_diag on every matvec
+        self.h2eff_ci = self.absorb_h1e_all (self.h1frs_aa, self.eri_cas)
+        self.hci0 = self.Hci_all_absorbed (None, self.h2eff_ci, ci)
         self.e0 = [[hc.dot (c) for hc, c in zip (hcr, cr)] for hcr, cr in zip (self.hci0, ci)]
         self.hci0 = [[hc - c*e for hc, c, e in zip (hcr, cr, er)] for hcr, cr, er in zip (self.hci0, ci, self.e0)]
 
+        # Kappa- and ci1-independent part of the cumulant decomposition in make_tdm1s2c_sub
+        self.cdm1s = np.einsum ('r,rsqp->spq', self.weights, self.casdm1rs)
+
         # That should be everything!
 
     def _init_df (self):
@@ -261,6 +268,15 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
             if self.bPpj is None: self.bPpj = np.ascontiguousarray (
                 self.las.cderi_ao2mo (self.mo_coeff, self.mo_coeff[:,:self.nocc],
                 compact=False))
+            # Contiguous copies of the slices which get_veff contracts on every matvec
+            ncore, nocc = self.ncore, self.nocc
+            self.bPij = np.ascontiguousarray (self.bPpj[:,:nocc,:])
+            naux, nmo = self.bPpj.shape[:2]
+            mem = naux * (nmo-ncore) * ncore * self.bPpj.itemsize / 1e6
+            if mem + lib.current_memory ()[0] < self.las.max_memory:
+                self.bPbi = np.ascontiguousarray (self.bPpj[:,ncore:,:ncore])
+            else:
+                self.bPbi = self.bPpj[:,ncore:,:ncore]
 
     @property
     def dtype (self):
@@ -270,25 +286,34 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
     def shape (self):
         return ((self.ugg.nvar_tot, self.ugg.nvar_tot))
 
-    def Hci (self, fcibox, no, ne, h0r, h1rs, h2, ci, linkstrl=None):
-        hr = fcibox.states_absorb_h1e (h1rs, h2, no, ne, 0.5)
-        hcr = fcibox.states_contract_2e (hr, ci, no, ne, link_index=linkstrl)
-        hcr = [hc + (h0 * c) for hc, h0, c in zip (hcr, h0r, ci)]
-        return hcr
-
     def Hci_all (self, h0fr, h1frs, h2, ci_sub):
         ''' Assumes h2 is in the active superspace MO basis and h1frs is in the full MO basis '''
-        if h0fr is None: h0fr = [[0.0 for h1r in h1rs] for h1rs in h1frs]
-        hcfr = []
-        for isub, (fcibox, h0, h1rs, ci) in enumerate (zip (self.fciboxes, h0fr, h1frs, ci_sub)):
-            if self.linkstrl is not None: linkstrl = self.linkstrl[isub] 
+        return self.Hci_all_absorbed (h0fr, self.absorb_h1e_all (h1frs, h2), ci_sub)
+
+    def absorb_h1e_all (self, h1frs, h2):
+        ''' Assumes h2 is in the active superspace MO basis and h1frs is in the full MO basis.
+        Returns the list of the fragments' states_absorb_h1e results, for Hci_all_absorbed. '''
+        h2eff_fr = []
+        for isub, (fcibox, h1rs) in enumerate (zip (self.fciboxes, h1frs)):
             ncas = self.ncas_sub[isub]
             nelecas = self.nelecas_sub[isub]
             i = sum (self.ncas_sub[:isub])
             j = i + ncas
             h2_i = h2[i:j,i:j,i:j,i:j]
             h1rs_i = h1rs[:,:,i:j,i:j]
-            hcfr.append (self.Hci (fcibox, ncas, nelecas, h0, h1rs_i, h2_i, ci, linkstrl=linkstrl))
+            h2eff_fr.append (fcibox.states_absorb_h1e (h1rs_i, h2_i, ncas, nelecas, 0.5))
+        return h2eff_fr
+
+    def Hci_all_absorbed (self, h0fr, h2eff_fr, ci_sub):
+        ''' Hci_all with the Hamiltonians already processed by absorb_h1e_all '''
+        if h0fr is None: h0fr = [[0.0 for c in ci] for ci in ci_sub]
+        hcfr = []
+        for isub, (fcibox, h0r, hr, ci) in enumerate (zip (self.fciboxes, h0fr, h2eff_fr, ci_sub)):
+            linkstrl = None if self.linkstrl is None else self.linkstrl[isub]
+            ncas = self.ncas_sub[isub]
+            nelecas = self.nelecas_sub[isub]
+            hcr = fcibox.states_contract_2e (hr, ci, ncas, nelecas, link_index=linkstrl)
+            hcfr.append ([hc + (h0 * c) for hc, h0, c in zip (hcr, h0r, ci)])
         return hcfr
 
     def make_odm1s2c_sub (self, kappa):
@@ -330,7 +355,7 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         # The only rules are 1) the sectors that you think are zero must really be zero, and
         #                    2) you subtract here what you add later
         tdm1s = np.einsum ('r,frspq->spq', self.weights, tdm1frs)
-        cdm1s = np.einsum ('r,rsqp->spq', self.weights, self.casdm1rs)
+        cdm1s = self.cdm1s
         tcm2 -= np.multiply.outer (tdm1s[0] + tdm1s[1], cdm1s[0] + cdm1s[1])
         tcm2 += np.multiply.outer (tdm1s[0], cdm1s[0]).transpose (0,3,2,1)
         tcm2 += np.multiply.outer (tdm1s[1], cdm1s[1]).transpose (0,3,2,1)
@@ -418,13 +443,13 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         t1 = lib.logger.timer (self.las, 'vk_mo vPpj in microcycle', *t1)
         # vk (aa|ii), (uv|xy), (ua|iv), (au|vi)
         vPbj = vPpj[:,ncore:,:] #np.dot (self.bPpq[:,ncore:,ncore:], dm_ai)
-        vk_bj = np.tensordot (vPbj, self.bPpj[:,:nocc,:], axes=((0,2),(0,1)))
+        vk_bj = np.tensordot (vPbj, self.bPij, axes=((0,2),(0,1)))
         t1 = lib.logger.timer (self.las, 'vk_mo (bb|jj) in microcycle', *t1)
         # vk (ai|ai), (ui|av)
         dm_ai = dm1_mo[nocc:,:ncore]
         vPji = vPpj[:,:nocc,:ncore] #np.dot (self.bPpq[:,:nocc, nocc:], dm_ai)
         # I think this works only because there is no dm_ui in this case, so I've eliminated all the dm_uv by choosing this range
-        bPbi = self.bPpj[:,ncore:,:ncore]
+        bPbi = self.bPbi
         vk_bj += np.tensordot (bPbi, vPji, axes=((0,2),(0,2)))
         t1 = lib.logger.timer (self.las, 'vk_mo (bi|aj) in microcycle', *t1)
         # veff
@@ -487,7 +512,9 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         ecm2 = ocm2 + tcm2
         # Evaluate hx = (F2..x) - (F2..x).T + (F1.x) - (F1.x).T
         fock1  = self.h1s[0] @ edm1s[0] + self.h1s[1] @ edm1s[1]
-        fock1 += veff_prime[0] @ self.dm1s[0] + veff_prime[1] @ self.dm1s[1]
+        # dm1s is block-diagonal (core, active, virtual) with zero virtual block
+        fock1[:,:nocc] += (veff_prime[0][:,:nocc] @ self.dm1s[0,:nocc,:nocc]
+                         + veff_prime[1][:,:nocc] @ self.dm1s[1,:nocc,:nocc])
         fock1[ncore:nocc,ncore:nocc] += np.tensordot (self.eri_cas, ecm2, axes=((1,2,3),(1,2,3)))
         fock1 += (np.dot (self.fock1, kappa) - np.dot (kappa, self.fock1)) / 2
         return fock1 - fock1.T
@@ -513,7 +540,7 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         # IMPORTANT: this disagrees with PySCF, but I still think it's right and PySCF is wrong
         ci1HmEci0 = [[c.dot (Hci) for c, Hci in zip (cr, Hcir)] for cr, Hcir in zip (ci1, self.hci0)]
         s01 = [[c1.dot (c0) for c1,c0 in zip (c1r, c0r)] for c1r, c0r in zip (ci1, self.ci)]
-        ci2 = self.Hci_all ([[-e for e in er] for er in self.e0], self.h1frs_aa, self.eri_cas, ci1)
+        ci2 = self.Hci_all_absorbed ([[-e for e in er] for er in self.e0], self.h2eff_ci, ci1)
         ci2 = [[x-(y*z) for x,y,z in zip (xr,yr,zr)] for xr,yr,zr in zip (ci2, self.ci, ci1HmEci0)]
         ci2 = [[x-(y*z) for x,y,z in zip (xr,yr,zr)] for xr,yr,zr in zip (ci2, self.hci0, s01)]
         return [[x*2 for x in xr] for xr in ci2]
@@ -542,7 +569,9 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         Hdiag[np.abs (Hdiag)<1e-8] = 1e-8
         return sparse_linalg.LinearOperator (self.shape, matvec=(lambda x:x/Hdiag), dtype=self.dtype)
 
-    def update_mo_ci_eri (self, x, h2eff_sub):
+    def update_mo_ci_eri (self, x, h2eff_sub, out=None):
+        ''' Take the step x. h2eff_sub is transformed to the new orbitals by rotate_h2eff_sub, into
+            out if given (which may be h2eff_sub itself) and otherwise into a new array '''
         nmo, ncore, ncas, nocc = self.nmo, self.ncore, self.ncas, self.nocc
         kappa, dci = self.ugg.unpack (x)
         umat = linalg.expm (kappa/2)
@@ -569,17 +598,7 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         ucas = umat[ncore:nocc, ncore:nocc]
         bmPu = None
         if hasattr (h2eff_sub, 'bmPu'): bmPu = h2eff_sub.bmPu
-        h2eff_sub = h2eff_sub.reshape (nmo*ncas, ncas*(ncas+1)//2)
-        h2eff_sub = lib.numpy_helper.unpack_tril (h2eff_sub)
-        h2eff_sub = h2eff_sub.reshape (nmo, ncas, ncas, ncas)
-        h2eff_sub = np.tensordot (ucas, h2eff_sub, axes=((0),(1))) # bpaa
-        h2eff_sub = np.tensordot (umat, h2eff_sub, axes=((0),(1))) # qbaa
-        h2eff_sub = np.tensordot (h2eff_sub, ucas, axes=((2),(0))) # qbab
-        h2eff_sub = np.tensordot (h2eff_sub, ucas, axes=((2),(0))) # qbbb
-        ix_i, ix_j = np.tril_indices (ncas)
-        h2eff_sub = h2eff_sub.reshape (nmo, ncas, ncas*ncas)
-        h2eff_sub = h2eff_sub[:,:,(ix_i*ncas)+ix_j]
-        h2eff_sub = h2eff_sub.reshape (nmo, -1)
+        h2eff_sub = rotate_h2eff_sub (self.las, h2eff_sub, umat, out=out)
         if bmPu is not None:
             bmPu = np.dot (bmPu, ucas)
             h2eff_sub = lib.tag_array (h2eff_sub, bmPu = bmPu)
@@ -772,17 +791,130 @@ def h1e_for_cas (las, mo_coeff=None, ncas=None, ncore=None, nelecas=None, ci=Non
     #    for moH, mo, v in zip (moH_cas, mo_cas, veff_sub)]
     #return h1e_sub
 
-def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4, verbose=lib.logger.NOTE):
+class _IncrementalVeff (object):
+    ''' Builds the spin-summed veff of a sequence of LASCI 1-RDMs incrementally. The previous AO
+        density and veff are kept, and J and K are computed only for the change in the density,
+        which the integral prescreening of direct-SCF backends exploits and which is skipped
+        altogether if it is negligible. Every rebuild_cycle builds, veff is instead recomputed from
+        the full density to bound the accumulation of numerical error.
+
+        Args:
+            las : instance of LASCINoSymm
+
+        Kwargs:
+            rebuild_cycle : int
+                Period of the full rebuild. 1 turns the incremental build off.
+            screen_tol : float
+                Density changes smaller than this (max abs element) do not change veff.
+    '''
+
+    def __init__(self, las, rebuild_cycle=None, screen_tol=None):
+        if rebuild_cycle is None: rebuild_cycle = las.veff_rebuild_cycle
+        if screen_tol is None: screen_tol = las.veff_screen_tol
+        self.las = las
+        self.rebuild_cycle = max (1, rebuild_cycle)
+        self.screen_tol = screen_tol
+        self.dm1 = None
+        self.veff = None
+        self.nincr = 0
+
+    def __call__(self, dm1):
+        ''' Returns the spin-summed veff of the spin-summed AO density dm1 '''
+        las = self.las
+        if self.dm1 is None or self.nincr + 1 >= self.rebuild_cycle:
+            veff = las.get_veff (dm1s=dm1)
+            self.nincr = 0
+        else:
+            ddm = dm1 - self.dm1
+            if np.amax (np.abs (ddm)) < self.screen_tol:
+                veff = self.veff.copy ()
+            else:
+                veff = self.veff + las.get_veff (dm1s=ddm)
+            self.nincr += 1
+            if las.verbose > lib.logger.DEBUG:
+                err = linalg.norm (veff - las.get_veff (dm1s=dm1))
+                lib.logger.debug (las, 'incremental veff error: {}'.format (err))
+        self.dm1, self.veff = dm1, veff
+        return veff.copy ()
+
+def dump_chk (las, chkfile, **kwargs):
+    ''' Write (some of) the state of a LASCI calculation to chkfile under the key 'lasci'. Only
+        the items passed as kwargs are (over)written, so the large ones (h2eff_sub) only need to
+        be dumped when they change.
+
+        Args:
+            las : instance of LASCINoSymm
+            chkfile : str
+                Name of HDF5 file
+
+        Kwargs:
+            mo_coeff, ci, h2eff_sub, veff, e_tot, e_states, it, converged
+                As in kernel. veff is the spin-separated (2,nao,nao) veff of the macrocycles.
+    '''
+    mo_coeff = kwargs.get ('mo_coeff', None)
+    if mo_coeff is not None and getattr (mo_coeff, 'orbsym', None) is not None:
+        kwargs['orbsym'] = mo_coeff.orbsym
+    if 'mo_coeff' in kwargs:
+        # The problem definition; checked by load_chk before a restart
+        kwargs['ncas_sub'] = np.asarray (las.ncas_sub)
+        kwargs['nelecas_sub'] = np.asarray (las.nelecas_sub)
+        kwargs['atom_coords'] = las.mol.atom_coords ()
+    for key, val in kwargs.items ():
+        if val is None: continue
+        if isinstance (val, np.ndarray): val = np.asarray (val) # drop tags
+        lib.chkfile.dump (chkfile, 'lasci/' + key, val)
+
+def load_chk (las, chkfile):
+    ''' Read the state of a LASCI calculation written by dump_chk, if chkfile has one for the
+        same molecular geometry, active-space partitioning, and number of MOs as las.
+
+        Returns:
+            chkdata : dict or None
+                Keys mo_coeff, ci, h2eff_sub, veff, and whatever else is in chkfile. None if
+                chkfile holds no compatible LASCI state.
+    '''
+    if chkfile is None or not os.path.isfile (chkfile) or not h5py.is_hdf5 (chkfile):
+        return None
+    with h5py.File (chkfile, 'r') as f:
+        if 'lasci' not in f: return None
+    chkdata = lib.chkfile.load (chkfile, 'lasci')
+    if not all ((key in chkdata) for key in ('mo_coeff', 'ci', 'h2eff_sub', 'veff')):
+        return None
+    if not (np.all (chkdata['ncas_sub'] == np.asarray (las.ncas_sub))
+            and np.all (chkdata['nelecas_sub'] == np.asarray (las.nelecas_sub))
+            and chkdata['mo_coeff'].shape == las.mo_coeff.shape
+            and np.allclose (chkdata['atom_coords'], las.mol.atom_coords ())):
+        lib.logger.warn (las, 'LASCI state in %s does not match this calculation; ignoring it', chkfile)
+        return None
+    if 'orbsym' in chkdata:
+        chkdata['mo_coeff'] = lib.tag_array (chkdata['mo_coeff'], orbsym=chkdata['orbsym'])
+    return chkdata
+
+def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4, verbose=lib.logger.NOTE,
+        chkfile=None, restart=False):
     if mo_coeff is None: mo_coeff = las.mo_coeff
     log = lib.logger.new_logger(las, verbose)
     t0 = (time.clock(), time.time())
     log.debug('Start LASCI')
 
-    h2eff_sub = las.get_h2eff (mo_coeff)
-    t1 = log.timer('integral transformation to LAS space', *t0)
+    chkdata = load_chk (las, chkfile) if restart else None
+    get_veff = _IncrementalVeff (las)
+    if chkdata is not None:
+        # Pick up where the last run stopped: no integral transformation and no initial get_veff
+        log.note ('LASCI restarting from %s (macrocycle %d)', chkfile, chkdata.get ('it', -1) + 1)
+        mo_coeff, ci0, h2eff_sub, veff = [chkdata[key] for key in ('mo_coeff', 'ci', 'h2eff_sub', 'veff')]
+        casdm1s_sub = las.make_casdm1s_sub (ci=ci0)
+        casdm1s_fr = las.states_make_casdm1s_sub (ci=ci0)
+        get_veff.dm1, get_veff.veff = las.make_rdm1 (mo_coeff=mo_coeff, ci=ci0), veff.sum (0)/2
+        t1 = log.timer('LASCI restart', *t0)
+    else:
+        h2eff_sub = las.get_h2eff (mo_coeff, out=las.h2eff_out)
+        t1 = log.timer('integral transformation to LAS space', *t0)
 
     # In the first cycle, I may pass casdm0_fr instead of ci0. Therefore, I need to work out this get_veff call separately.
-    if ci0 is None and casdm0_fr is not None:
+    if chkdata is not None:
+        pass
+    elif ci0 is None and casdm0_fr is not None:
         casdm0_sub = [np.einsum ('rsij,r->sij', dm, las.weights) for dm in casdm0_fr]
         dm1_core = mo_coeff[:,:las.ncore] @ mo_coeff[:,:las.ncore].conjugate ().T
         dm1s_sub = [np.stack ([dm1_core, dm1_core], axis=0)]
@@ -792,18 +924,21 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4, ve
             dm1s_sub.append (np.tensordot (mo, np.dot (casdm1s, moH), axes=((1),(1))).transpose (1,0,2))
         dm1s_sub = np.stack (dm1s_sub, axis=0)
         dm1s = dm1s_sub.sum (0)
-        veff = las.get_veff (dm1s=dm1s.sum (0))
+        veff = get_veff (dm1s.sum (0))
         veff = las.split_veff (veff, h2eff_sub, mo_coeff=mo_coeff, casdm1s_sub=casdm0_sub)
         casdm1s_sub = casdm0_sub
         casdm1s_fr = casdm0_fr
     else:
         if ci0 is None:
             ci0 = get_init_guess_ci (las, mo_coeff, h2eff_sub)
-        veff = las.get_veff (dm1s = las.make_rdm1 (mo_coeff=mo_coeff, ci=ci0))
+        veff = get_veff (las.make_rdm1 (mo_coeff=mo_coeff, ci=ci0))
         casdm1s_sub = las.make_casdm1s_sub (ci=ci0)
         casdm1s_fr = las.states_make_casdm1s_sub (ci=ci0)
         veff = las.split_veff (veff, h2eff_sub, mo_coeff=mo_coeff, ci=ci0, casdm1s_sub=casdm1s_sub)
-    t1 = log.timer('LASCI initial get_veff', *t1)
+    if chkdata is None:
+        t1 = log.timer('LASCI initial get_veff', *t1)
+        if chkfile is not None and ci0 is not None:
+            dump_chk (las, chkfile, mo_coeff=mo_coeff, ci=ci0, h2eff_sub=h2eff_sub, veff=veff, it=-1)
 
     ugg = None
     converged = False
@@ -818,11 +953,12 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4, ve
 
         veff = veff.sum (0)/2
         casdm1s_new = las.make_casdm1s_sub (ci=ci1)
-        if not isinstance (las, _DFLASCI) or las.verbose > lib.logger.DEBUG:
+        if not isinstance (las, _DFLASCI):
             #veff = las.get_veff (mo_coeff=mo_coeff, ci=ci1)
-            veff_new = las.get_veff (dm1s = las.make_rdm1 (mo_coeff=mo_coeff, ci=ci1))
-            if not isinstance (las, _DFLASCI): veff = veff_new
-        if isinstance (las, _DFLASCI):
+            veff = get_veff (las.make_rdm1 (mo_coeff=mo_coeff, ci=ci1))
+        else:
+            if las.verbose > lib.logger.DEBUG:
+                veff_new = las.get_veff (dm1s = las.make_rdm1 (mo_coeff=mo_coeff, ci=ci1))
             dcasdm1s = [dm_new - dm_old for dm_new, dm_old in zip (casdm1s_new, casdm1s_sub)]
             veff += las.fast_veffa (dcasdm1s, h2eff_sub, mo_coeff=mo_coeff, ci=ci1) 
             if las.verbose > lib.logger.DEBUG:
@@ -885,15 +1021,19 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4, ve
         x, info_int = sparse_linalg.cg (H_op, -g_vec, x0=x0, atol=my_tol, maxiter=las.max_cycle_micro,
          callback=my_callback, M=prec_op)
         t1 = log.timer ('LASCI {} microcycles'.format (microit[0]), *t1)
-        mo_coeff, ci1, h2eff_sub = H_op.update_mo_ci_eri (x, h2eff_sub)
+        mo_coeff, ci1, h2eff_sub = H_op.update_mo_ci_eri (x, h2eff_sub, out=las.h2eff_out)
         casdm1s_fr = las.states_make_casdm1s_sub (ci=ci1)
         casdm1s_sub = las.make_casdm1s_sub (ci=ci1)
         t1 = log.timer ('LASCI Hessian update', *t1)
 
         #veff = las.get_veff (mo_coeff=mo_coeff, ci=ci1)
-        veff = las.get_veff (dm1s = las.make_rdm1 (mo_coeff=mo_coeff, ci=ci1))
+        veff = get_veff (las.make_rdm1 (mo_coeff=mo_coeff, ci=ci1))
         veff = las.split_veff (veff, h2eff_sub, mo_coeff=mo_coeff, ci=ci1)
         t1 = log.timer ('LASCI get_veff after secondorder', *t1)
+        if chkfile is not None:
+            dump_chk (las, chkfile, mo_coeff=mo_coeff, ci=ci1, h2eff_sub=h2eff_sub, veff=veff,
+                e_tot=H_op.e_tot, it=it)
+            t1 = log.timer ('LASCI dump_chk', *t1)
 
     t2 = log.timer ('LASCI {} macrocycles'.format (it), *t2)
 
@@ -914,9 +1054,14 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4, ve
     lib.logger.info (las, 'LASCI E = %.15g ; |g_int| = %.15g ; |g_ci| = %.15g ; |g_ext| = %.15g', e_tot, norm_gorb, norm_gci, norm_gx)
     t1 = log.timer ('LASCI wrap-up', *t1)
         
-    mo_coeff, mo_energy, mo_occ, ci1, h2eff_sub = las.canonicalize (mo_coeff, ci1, veff=veff.sa, h2eff_sub=h2eff_sub)
+    mo_coeff, mo_energy, mo_occ, ci1, h2eff_sub = las.canonicalize (mo_coeff, ci1, veff=veff.sa, h2eff_sub=h2eff_sub,
+        h2eff_out=las.h2eff_out)
     t1 = log.timer ('LASCI canonicalization', *t1)
 
+    if chkfile is not None:
+        dump_chk (las, chkfile, mo_coeff=mo_coeff, ci=ci1, h2eff_sub=h2eff_sub, veff=veff.sa,
+            e_tot=e_tot, e_states=e_states, it=it, converged=converged)
+
     t0 = log.timer ('LASCI kernel function', *t0)
 
     return converged, e_tot, e_states, mo_energy, mo_coeff, e_cas, ci1, h2eff_sub, veff
@@ -927,12 +1072,17 @@ def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1s_fr, log, veff_sub_test=None
     t1 = (time.clock(), time.time())
     h1eff_sub = las.get_h1eff (mo, veff=veff, h2eff_sub=h2eff_sub, casdm1s_fr=casdm1s_fr, veff_sub_test=veff_sub_test)
     ncas_cum = np.cumsum ([0] + las.ncas_sub.tolist ()) + las.ncore
-    e_cas = []
-    ci1 = []
+    nfrags = len (las.fciboxes)
+    # The fragment CI problems are independent given h1eff_sub and h2eff_sub; with las.nworkers > 1
+    # they are divided among a pool of threads, each with its share of the OpenMP threads
+    nworkers = max (1, min (getattr (las, 'nworkers', 1) or 1, nfrags))
     e0 = 0.0 
-    for isub, (fcibox, ncas, nelecas, h1e, fcivec) in enumerate (zip (las.fciboxes, las.ncas_sub, las.nelecas_sub, h1eff_sub, ci0)):
+    def solve_frag (isub):
+        t2 = (time.clock(), time.time())
+        fcibox, ncas, nelecas = las.fciboxes[isub], las.ncas_sub[isub], las.nelecas_sub[isub]
+        h1e, fcivec = h1eff_sub[isub], ci0[isub]
         eri_cas = las.get_h2eff_slice (h2eff_sub, isub, compact=8)
-        max_memory = max(400, las.max_memory-lib.current_memory()[0])
+        max_memory = max(400, las.max_memory-lib.current_memory()[0]) / nworkers
         orbsym = getattr (mo, 'orbsym', None)
         if orbsym is not None:
             i = ncas_cum[isub]
@@ -950,9 +1100,21 @@ def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1s_fr, log, veff_sub_test=None
                                       ci0=fcivec, verbose=log,
                                       max_memory=max_memory,
                                       ecore=e0, orbsym=orbsym)
-        e_cas.append (e_sub)
-        ci1.append (fcivec)
-        t1 = log.timer ('FCI box for subspace {}'.format (isub), *t1)
+        log.timer ('FCI box for subspace {}'.format (isub), *t2)
+        return e_sub, fcivec
+    if nworkers > 1:
+        nthreads = max (1, lib.num_threads () // nworkers)
+        def solve_frag_threaded (isub):
+            with lib.with_omp_threads (nthreads):
+                return solve_frag (isub)
+        # executor.map returns results in fragment order regardless of completion order
+        with ThreadPoolExecutor (max_workers=nworkers) as executor:
+            results = list (executor.map (solve_frag_threaded, range (nfrags)))
+        log.timer ('FCI boxes for {} subspaces on {} workers'.format (nfrags, nworkers), *t1)
+    else:
+        results = [solve_frag (isub) for isub in range (nfrags)]
+    e_cas = [r[0] for r in results]
+    ci1 = [r[1] for r in results]
     return e_cas, ci1
 
 def get_fock (las, mo_coeff=None, ci=None, eris=None, casdm1s=None, verbose=None, veff=None, dm1s=None):
@@ -984,7 +1146,62 @@ def get_fock (las, mo_coeff=None, ci=None, eris=None, casdm1s=None, verbose=None
     fock = las.get_hcore () + vj - (vk/2)
     return fock
 
-def canonicalize (las, mo_coeff=None, ci=None, natorb_casdm1=None, veff=None, h2eff_sub=None, orbsym=None):
+def rotate_h2eff_sub (las, h2eff_sub, umat, out=None):
+    ''' Transform h2eff_sub = (pu|vw) (see LASCINoSymm.ao2mo) to the orbitals mo_coeff @ umat, a
+        block of rows and then a block of columns at a time so that the temporaries stay within
+        las.max_memory
+
+        Args:
+            las: LASCI object
+            h2eff_sub: ndarray of shape (nmo, ncas*ncas*(ncas+1)//2)
+            umat: ndarray of shape (nmo, nmo)
+
+        Kwargs:
+            out: ndarray of shape (nmo, ncas*ncas*(ncas+1)//2)
+                Buffer for the result, e.g. las.h2eff_out. It may be h2eff_sub itself, which is
+                then overwritten. By default a new array is allocated.
+
+        Returns:
+            eri: ndarray of shape (nmo, ncas*ncas*(ncas+1)//2)
+    '''
+    nmo, ncore, ncas = umat.shape[0], las.ncore, las.ncas
+    nocc = ncore + ncas
+    npair = ncas*(ncas+1)//2
+    ucas = umat[ncore:nocc,ncore:nocc]
+    dtype = np.result_type (h2eff_sub, umat)
+    if out is None: out = np.empty ((nmo, ncas*npair), dtype=dtype)
+    h2eff_sub = h2eff_sub.reshape (nmo, ncas*npair)
+    eri = out.reshape (nmo, ncas*npair)
+    max_memory = max (400, las.max_memory-lib.current_memory ()[0])
+    itemsize = np.dtype (dtype).itemsize
+    # Active indices, (pu|vw) -> (pu'|v'w'), for a block of rows p; each row is read before it
+    # is written, so eri may be h2eff_sub
+    blksize = int (max_memory*1e6/itemsize / (4*ncas**3))
+    blksize = max (1, min (nmo, blksize))
+    for p0, p1 in lib.prange (0, nmo, blksize):
+        h2 = lib.numpy_helper.unpack_tril (np.asarray (h2eff_sub[p0:p1]).reshape ((p1-p0)*ncas, npair))
+        h2 = h2.reshape (p1-p0, ncas, ncas, ncas)
+        h2 = np.tensordot (h2, ucas, axes=((1),(0))) # pvwu'
+        h2 = np.tensordot (h2, ucas, axes=((1),(0))) # pwu'v'
+        h2 = np.tensordot (h2, ucas, axes=((1),(0))) # pu'v'w'
+        eri[p0:p1] = lib.numpy_helper.pack_tril (h2.reshape ((p1-p0)*ncas, ncas, ncas)).reshape (p1-p0, -1)
+        h2 = None
+    # General index, (pu|vw) -> (p'u|vw), in place for a block of columns
+    blksize = int (max_memory*1e6/itemsize / (2*nmo))
+    blksize = max (1, min (ncas*npair, blksize))
+    for c0, c1 in lib.prange (0, ncas*npair, blksize):
+        eri[:,c0:c1] = np.dot (umat.T, eri[:,c0:c1])
+    return eri
+
+def canonicalize (las, mo_coeff=None, ci=None, natorb_casdm1=None, veff=None, h2eff_sub=None, orbsym=None,
+        h2eff_out=None):
+    ''' Canonicalize the inactive and external orbitals and take natural orbitals within each
+        fragment. If h2eff_sub is given, it is transformed to the new orbitals by
+        rotate_h2eff_sub, into h2eff_out if given (which may be h2eff_sub itself).
+
+        Returns:
+            mo_coeff, mo_energy, mo_occ, ci, h2eff_sub
+    '''
     if mo_coeff is None: mo_coeff = las.mo_coeff
     if ci is None: ci = las.ci
     nao, nmo = mo_coeff.shape
@@ -1064,12 +1281,7 @@ def canonicalize (las, mo_coeff=None, ci=None, natorb_casdm1=None, veff=None, h2
         '''
         mo_coeff = lib.tag_array (mo_coeff, orbsym=orbsym)
     if h2eff_sub is not None:
-        h2eff_sub = lib.numpy_helper.unpack_tril (h2eff_sub.reshape (nmo*las.ncas, -1)).reshape (nmo, las.ncas, las.ncas, las.ncas)
-        h2eff_sub = np.tensordot (umat, h2eff_sub, axes=((0),(0)))
-        h2eff_sub = np.tensordot (ucas, h2eff_sub, axes=((0),(1))).transpose (1,0,2,3)
-        h2eff_sub = np.tensordot (ucas, h2eff_sub, axes=((0),(2))).transpose (1,2,0,3)
-        h2eff_sub = np.tensordot (ucas, h2eff_sub, axes=((0),(3))).transpose (1,2,3,0)
-        h2eff_sub = lib.numpy_helper.pack_tril (h2eff_sub.reshape (nmo*las.ncas, las.ncas, las.ncas)).reshape (nmo, -1)
+        h2eff_sub = rotate_h2eff_sub (las, h2eff_sub, umat, out=h2eff_out)
     return mo_coeff, mo_ene, mo_occ, ci, h2eff_sub
 
 def get_init_guess_ci (las, mo_coeff=None, h2eff_sub=None):
@@ -1160,7 +1372,21 @@ class LASCINoSymm (casci.CASCI):
         self.ah_level_shift = 1e-8
         self.max_cycle_macro = 50
         self.max_cycle_micro = 5
-        keys = set(('e_states', 'fciboxes', 'nroots', 'weights', 'ncas_sub', 'nelecas_sub', 'conv_tol_grad', 'max_cycle_macro', 'max_cycle_micro', 'ah_level_shift'))
+        # Number of fragment CI problems solved concurrently in ci_cycle
+        self.nworkers = 1
+        # veff in the macrocycles is built from density differences, with a full rebuild every
+        # veff_rebuild_cycle builds (1 => always full); see _IncrementalVeff
+        self.veff_rebuild_cycle = 4
+        self.veff_screen_tol = 1e-12
+        # Macrocycle checkpoint file (see dump_chk) and whether to resume from it
+        self.chkfile_las = None
+        self.restart = False
+        # Preallocated buffer (e.g., an np.memmap) which kernel keeps its h2eff_sub in, through
+        # every macrocycle and canonicalize; other ao2mo/get_h2eff callers allocate their own.
+        # With density fitting, the bmPu tag (nao*ncas*naux) is still held in memory.
+        self.h2eff_out = None
+        keys = set(('e_states', 'fciboxes', 'nroots', 'weights', 'ncas_sub', 'nelecas_sub', 'conv_tol_grad', 'max_cycle_macro', 'max_cycle_micro', 'ah_level_shift', 'nworkers',
+            'veff_rebuild_cycle', 'veff_screen_tol', 'chkfile_las', 'restart', 'h2eff_out'))
         self._keys = set(self.__dict__.keys()).union(keys)
         self.fciboxes = []
         for smult, nel in zip (spin_sub, self.nelecas_sub):
@@ -1179,48 +1405,107 @@ class LASCINoSymm (casci.CASCI):
         mo = mo[:,:self.ncas_sub[idx]]
         return mo
 
-    def ao2mo (self, mo_coeff=None):
+    def ao2mo (self, mo_coeff=None, out=None):
+        ''' Two-electron integrals with one general and three active indices, (pu|vw), with
+            the last pair lower-triangle packed
+
+            Kwargs:
+                mo_coeff: ndarray of shape (nao, nmo)
+                out: ndarray of shape (nmo, ncas*ncas*(ncas+1)//2)
+                    Optional buffer for the result, e.g. an np.memmap to keep it off the heap
+
+            Returns:
+                eri: ndarray of shape (nmo, ncas*ncas*(ncas+1)//2)
+                    With density fitting, it is tagged with bmPu, the cderi with one active index
+        '''
         if mo_coeff is None: mo_coeff = self.mo_coeff
         nao, nmo = mo_coeff.shape
         ncore, ncas = self.ncore, self.ncas
         nocc = ncore + ncas
         mo_cas = mo_coeff[:,ncore:nocc]
         mo = [mo_coeff, mo_cas, mo_cas, mo_cas]
+        npair = ncas*(ncas+1)//2
         if getattr (self, 'with_df', None) is not None:
             # Store intermediate with one contracted ao index for faster calculation of exchange corrections!
             bPmn = sparsedf_array (self.with_df._cderi)
             bmuP = bPmn.contract1 (mo_cas)
             buvP = np.tensordot (mo_cas.conjugate (), bmuP, axes=((0),(0)))
-            eri_muxy = np.tensordot (bmuP, buvP, axes=((2),(2)))
-            eri = lib.pack_tril (np.tensordot (mo_coeff.conjugate (), eri_muxy, axes=((0),(0))).reshape (nmo*ncas, ncas, ncas)).reshape (nmo, -1)
+            bPuv = lib.pack_tril (np.ascontiguousarray (buvP.transpose (2,0,1)))
+            buvP = None
+            # (mu,x|uv) is only ever formed for a block of AO rows at a time and accumulated
+            # straight into the packed (p,x|uv) in place
+            naux = bPuv.shape[0]
+            dtype = np.result_type (mo_coeff, bmuP)
+            if out is None: out = np.zeros ((nmo, ncas*npair), dtype=dtype)
+            else: out[:] = 0
+            eri = out.reshape (nmo, ncas*npair)
+            max_memory = max (400, self.max_memory-lib.current_memory ()[0])
+            blksize = int (max_memory*1e6/8 / (2*ncas*npair))
+            blksize = max (1, min (nao, blksize))
+            for m0, m1 in lib.prange (0, nao, blksize):
+                eri_mxuv = np.dot (bmuP[m0:m1].reshape ((m1-m0)*ncas, naux), bPuv)
+                lib.dot (mo_coeff[m0:m1].conjugate ().T, eri_mxuv.reshape (m1-m0, ncas*npair),
+                    c=eri, beta=1)
+                eri_mxuv = None
             eri = lib.tag_array (eri, bmPu=bmuP.transpose (0,2,1))
             if self.verbose > lib.logger.DEBUG:
                 eri_comp = self.with_df.ao2mo (mo, compact=True)
                 lib.logger.debug (self, "CDERI two-step error: {}".format (linalg.norm (eri-eri_comp)))
+            return eri
         elif getattr (self._scf, '_eri', None) is not None:
             eri = ao2mo.incore.general (self._scf._eri, mo, compact=True)
         else:
             eri = ao2mo.outcore.general_iofree (self.mol, mo, compact=True)
-        if eri.shape != (nmo,ncas*ncas*(ncas+1)//2):
+        if eri.shape != (nmo,ncas*npair):
             try:
-                eri = eri.reshape (nmo, ncas*ncas*(ncas+1)//2)
+                eri = eri.reshape (nmo, ncas*npair)
             except ValueError as e:
                 assert (nmo == ncas), str (e)
-                eri = ao2mo.restore ('2kl', eri, nmo).reshape (nmo, ncas*ncas*(ncas+1)//2)
+                eri = ao2mo.restore ('2kl', eri, nmo).reshape (nmo, ncas*npair)
+        if out is not None:
+            out[:] = eri.reshape (out.shape)
+            eri = out
         return eri
 
-    def get_h2eff_slice (self, h2eff, idx, compact=None):
+    def _get_h2eff_slice_idx (self, idx, compact):
+        ''' Row and column addresses, in h2eff[ncore:nocc], of the elements of the active-space
+        ERIs of one fragment in the 1-, 4-, or 8-fold symmetry-packed layout of ao2mo.restore,
+        cached because they depend only on the fragment ranges '''
         ncas_cum = np.cumsum ([0] + self.ncas_sub.tolist ())
-        i = ncas_cum[idx] 
-        j = ncas_cum[idx+1]
+        i, j, ncas = ncas_cum[idx], ncas_cum[idx+1], self.ncas
+        key = (tuple (ncas_cum), idx, compact)
+        if not hasattr (self, '_h2eff_slice_idx'): self._h2eff_slice_idx = {}
+        if key in self._h2eff_slice_idx: return self._h2eff_slice_idx[key]
+        n = j - i
+        if compact in (4, 8):
+            p1, q1 = np.tril_indices (n)
+            npair = len (p1)
+            if compact == 4:
+                ix, jx = np.repeat (np.arange (npair), npair), np.tile (np.arange (npair), npair)
+                shape = (npair, npair)
+            else:
+                ix, jx = np.tril_indices (npair)
+                shape = (npair*(npair+1)//2,)
+            p, q, r, s = p1[ix], q1[ix], p1[jx], q1[jx]
+        else:
+            p, q, r, s = [x.ravel () for x in np.indices ((n,n,n,n))]
+            shape = (n,n,n,n)
+        r, s = np.maximum (r, s) + i, np.minimum (r, s) + i
+        col = (q + i) * (ncas*(ncas+1)//2) + (r*(r+1)//2) + s
+        self._h2eff_slice_idx[key] = (p + i, col, shape)
+        return self._h2eff_slice_idx[key]
+
+    def get_h2eff_slice (self, h2eff, idx, compact=None):
+        ''' Active-space ERIs of fragment idx, read directly from the packed h2eff '''
         ncore = self.ncore
         nocc = ncore + self.ncas
-        eri = h2eff[ncore:nocc,:].reshape (self.ncas*self.ncas, -1)
-        ix_i, ix_j = np.tril_indices (self.ncas)
-        eri = eri[(ix_i*self.ncas)+ix_j,:]
-        eri = ao2mo.restore (1, eri, self.ncas)[i:j,i:j,i:j,i:j]
-        if compact: eri = ao2mo.restore (compact, eri, j-i)
-        return eri
+        if not compact: compact = 1
+        elif compact not in (1, 4, 8):
+            eri = self.get_h2eff_slice (h2eff, idx)
+            return ao2mo.restore (compact, eri, eri.shape[0])
+        row, col, shape = self._get_h2eff_slice_idx (idx, compact)
+        eri = np.asarray (h2eff[ncore:nocc,:])
+        return eri[row,col].reshape (shape)
 
     get_h1eff = get_h1cas = h1e_for_cas = h1e_for_cas
     get_h2eff = ao2mo
@@ -1243,7 +1528,18 @@ class LASCINoSymm (casci.CASCI):
         return self._hop (self, ugg, mo_coeff=mo_coeff, ci=ci, **kwargs)
     canonicalize = canonicalize
 
-    def kernel(self, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=None, verbose=None):
+    def kernel(self, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=None, verbose=None,
+            chkfile=None, restart=None):
+        ''' Kwargs (in addition to the usual):
+                chkfile : str
+                    HDF5 file to which the state of the calculation (MOs, CI vectors, h2eff_sub,
+                    veff, energy) is written after every macrocycle. Defaults to self.chkfile_las.
+                restart : logical
+                    If True, resume from the state in chkfile, if any, rather than starting over.
+                    Defaults to self.restart.
+        '''
+        if chkfile is None: chkfile = self.chkfile_las
+        if restart is None: restart = self.restart
         if mo_coeff is None:
             mo_coeff = self.mo_coeff
         else:
@@ -1265,7 +1561,8 @@ class LASCINoSymm (casci.CASCI):
         self.weights = self.fciboxes[0].weights
 
         self.converged, self.e_tot, self.e_states, self.mo_energy, self.mo_coeff, self.e_cas, self.ci, h2eff_sub, veff = \
-                kernel(self, mo_coeff, ci0=ci0, verbose=verbose, casdm0_fr=casdm0_fr, conv_tol_grad=conv_tol_grad)
+                kernel(self, mo_coeff, ci0=ci0, verbose=verbose, casdm0_fr=casdm0_fr, conv_tol_grad=conv_tol_grad,
+                chkfile=chkfile, restart=restart)
 
         return self.e_tot, self.e_cas, self.ci, self.mo_coeff, self.mo_energy, h2eff_sub, veff
 
@@ -1653,7 +1950,7 @@ class LASCISymm (casci_symm.CASCI, LASCINoSymm):
     def wfnsym (self, ir):
         raise RuntimeError ("Cannot assign the whole-system symmetry of a LASCI wave function. Address fciboxes[ifrag].fcisolvers[istate].wfnsym instead.")
 
-    def kernel(self, mo_coeff=None, ci0=None, casdm0_fr=None, verbose=None):
+    def kernel(self, mo_coeff=None, ci0=None, casdm0_fr=None, verbose=None, chkfile=None, restart=None):
         if mo_coeff is None:
             mo_coeff = self.mo_coeff
         if ci0 is None:
@@ -1662,12 +1959,14 @@ class LASCISymm (casci_symm.CASCI, LASCINoSymm):
         # Initialize/overwrite mo_coeff.orbsym. Don't pass ci0 because it's not the right shape
         lib.logger.info (self, "LASCI lazy hack note: lines below reflect the point-group symmetry of the whole molecule but not of the individual subspaces")
         mo_coeff = self.mo_coeff = self.label_symmetry_(mo_coeff)
-        return LASCINoSymm.kernel(self, mo_coeff=mo_coeff, ci0=ci0, casdm0_fr=casdm0_fr, verbose=verbose)
+        return LASCINoSymm.kernel(self, mo_coeff=mo_coeff, ci0=ci0, casdm0_fr=casdm0_fr, verbose=verbose,
+            chkfile=chkfile, restart=restart)
 
-    def canonicalize (self, mo_coeff=None, ci=None, natorb_casdm1=None, veff=None, h2eff_sub=None):
+    def canonicalize (self, mo_coeff=None, ci=None, natorb_casdm1=None, veff=None, h2eff_sub=None, h2eff_out=None):
         if mo_coeff is None: mo_coeff = self.mo_coeff
         mo_coeff = self.label_symmetry_(mo_coeff)
-        return canonicalize (self, mo_coeff=mo_coeff, ci=ci, natorb_casdm1=natorb_casdm1, h2eff_sub=h2eff_sub, orbsym=mo_coeff.orbsym)
+        return canonicalize (self, mo_coeff=mo_coeff, ci=ci, natorb_casdm1=natorb_casdm1, h2eff_sub=h2eff_sub, orbsym=mo_coeff.orbsym,
+            h2eff_out=h2eff_out)
 
     def label_symmetry_(self, mo_coeff=None):
         if mo_coeff is None: mo_coeff=self.mo_coeff
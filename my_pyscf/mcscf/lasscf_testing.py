@@ -172,10 +172,10 @@ class LASSCF_HessianOperator (lasci.LASCI_HessianOperator):
         f1_prime[nocc:,ncore:nocc] += np.tensordot (self.h2eff_sub[nocc:], ecm2, axes=((1,2,3),(1,2,3)))
         return gorb + (f1_prime - f1_prime.T)
 
-    def update_mo_ci_eri (self, x, h2eff_sub):
+    def update_mo_ci_eri (self, x, h2eff_sub, out=None):
         # mo and ci are fine, but h2eff sub simply has to be replaced
         mo1, ci1 = lasci.LASCI_HessianOperator.update_mo_ci_eri (self, x, h2eff_sub)[:2]
-        return mo1, ci1, self.las.ao2mo (mo1)
+        return mo1, ci1, self.las.ao2mo (mo1, out=out)
 
 class LASSCFNoSymm (lasci.LASCINoSymm):
     _ugg = LASSCF_UnitaryGroupGenerators
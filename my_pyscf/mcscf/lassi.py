@@ -1,5 +1,6 @@
 import numpy as np
-import time
+import time, copy
+import h5py
 from scipy import linalg
 from mrh.my_pyscf.mcscf import lassi_op_o0 as op_o0
 from mrh.my_pyscf.mcscf import lassi_op_o1 as op_o1
@@ -7,6 +8,7 @@ from pyscf import lib, symm
 from pyscf.lib.numpy_helper import tag_array
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from itertools import combinations, product
+from concurrent.futures import ThreadPoolExecutor
 
 op = (op_o0, op_o1)
 
@@ -63,8 +65,134 @@ def las_symm_tuple (las):
 
     return statesym, np.asarray (s2_states)
 
-def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None, opt=1):
-    ''' Diagonalize the state-interaction matrix of LASSCF '''
+def davidson_si (las, sigma, hdiag, odiag, nroots=1, conv_tol=1e-10, max_cycle=100, max_space=None):
+    ''' Block Davidson solver for the lowest roots of the generalized eigenproblem H c = e S c in
+        the basis of LAS states, with H, S**2, and S available only as a sigma function
+
+        Args:
+            las : LASCI object (for logging)
+            sigma : callable
+                sigma (x) returns H x, S**2 x, S x for x of shape (nstates, nvecs)
+            hdiag : ndarray of shape (nstates,)
+                Diagonal of H
+            odiag : ndarray of shape (nstates,)
+                Diagonal of S
+
+        Kwargs:
+            nroots : int
+                Number of lowest roots to find
+            conv_tol : float
+                Convergence threshold for the eigenvalues; the residual norms must fall
+                below its square root
+            max_cycle : int
+                Maximum number of sigma calls
+            max_space : int
+                Maximum size of the trial space before it is collapsed onto the current
+                Ritz vectors
+
+        Returns:
+            conv : bool
+            e : ndarray of shape (nroots,)
+            c : ndarray of shape (nstates, nroots)
+                S-orthonormal eigenvectors
+            s2 : ndarray of shape (nroots,)
+                Expectation values of S**2
+    '''
+    nstates = hdiag.size
+    nroots = min (nroots, nstates)
+    if max_space is None: max_space = max (12, 4*nroots)
+    max_space = max (max_space, 3*nroots)
+    toloose = np.sqrt (conv_tol)
+    log = lib.logger.new_logger (las, las.verbose)
+
+    V = np.zeros ((nstates, 0), dtype=hdiag.dtype)
+    HV, S2V, SV = V.copy (), V.copy (), V.copy ()
+    # Initial guess: LAS states with the lowest diagonal energies
+    W = np.zeros ((nstates, nroots), dtype=hdiag.dtype)
+    W[np.argsort (hdiag / odiag)[:nroots],np.arange (nroots)] = 1.0
+    e = np.zeros (nroots)
+    rnorm = np.ones (nroots)
+    conv = False
+    for it in range (max_cycle):
+        # S-orthonormalize the new vectors against the trial space (twice, for stability) and
+        # against each other; drop the ones which are zero or linearly dependent
+        wnorm = linalg.norm (W, axis=0)
+        W = W[:,wnorm > 1e-14] / wnorm[None,wnorm > 1e-14]
+        for i in range (2): W -= np.dot (V, np.dot (SV.conj ().T, W))
+        W = W[:,linalg.norm (W, axis=0) > 1e-8]
+        if W.shape[1] == 0:
+            # No new directions: the Ritz vectors are as good as they will get
+            conv = np.all (rnorm < toloose)
+            if not conv: log.warn ('LASSI Davidson: trial space exhausted after %d cycles', it)
+            break
+        HW, S2W, SW = sigma (W)
+        ovlp = np.dot (W.conj ().T, SW)
+        evals, evecs = linalg.eigh ((ovlp + ovlp.conj ().T)/2)
+        idx = evals > 1e-14
+        xform = evecs[:,idx] / np.sqrt (evals[idx])
+        V = np.append (V, np.dot (W, xform), axis=1)
+        HV = np.append (HV, np.dot (HW, xform), axis=1)
+        S2V = np.append (S2V, np.dot (S2W, xform), axis=1)
+        SV = np.append (SV, np.dot (SW, xform), axis=1)
+
+        # Rayleigh-Ritz in the trial space
+        h_sub = np.dot (V.conj ().T, HV)
+        s_sub = np.dot (V.conj ().T, SV)
+        e_sub, c_sub = linalg.eigh ((h_sub + h_sub.conj ().T)/2, b=(s_sub + s_sub.conj ().T)/2)
+        e_last, e = e, e_sub[:nroots]
+        c_sub = c_sub[:,:nroots]
+        R = np.dot (HV, c_sub) - np.dot (SV, c_sub) * e[None,:]
+        rnorm = linalg.norm (R, axis=0)
+        de = np.abs (e - e_last)
+        log.debug ('LASSI Davidson cycle %d: nspace = %d ; max|de| = %.3g ; max|r| = %.3g',
+            it, V.shape[1], np.amax (de), np.amax (rnorm))
+        # The Ritz values are exact once the trial space spans the whole space
+        if np.all (rnorm < toloose) and ((it > 0 and np.all (de < conv_tol)) or V.shape[1] == nstates):
+            conv = True
+            break
+
+        # Collapse the trial space if it is getting too big
+        if V.shape[1] + nroots > max_space:
+            V, HV, S2V, SV = [np.dot (M, c_sub) for M in (V, HV, S2V, SV)]
+            c_sub = np.eye (nroots)
+
+        # Preconditioner: diagonal of H - e S
+        W = []
+        for iroot in np.where (rnorm >= toloose)[0]:
+            denom = hdiag - e[iroot] * odiag
+            denom[np.abs (denom) < 1e-8] = 1e-8
+            W.append (R[:,iroot] / denom)
+        if not len (W): W = [R[:,iroot] for iroot in range (nroots)]
+        W = np.stack (W, axis=1)
+    c = np.dot (V, c_sub)
+    s2 = np.einsum ('pi,pi->i', c.conj (), np.dot (S2V, c_sub)).real
+    log.info ('LASSI Davidson %s in %d cycles', ('not converged', 'converged')[int (conv)], it+1)
+    return conv, e, c, s2
+
+def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None, opt=1,
+        davidson_only=False, nroots_si=1, nworkers=None, ints_cache=None):
+    ''' Diagonalize the state-interaction matrix of LASSCF
+
+        Kwargs:
+            davidson_only : bool
+                If True, find only the lowest nroots_si roots of each symmetry block with a
+                Davidson solver which applies the Hamiltonian on the fly (op_o1.ham_sigma)
+                instead of building and diagonalizing the dense ham, s2, and ovlp matrices.
+                The fragment intermediates and connectivity data still take
+                O(nfrags*nroots**2) memory, and every Davidson iteration recomputes all
+                interactions (about the cost of one full ham). si.s2_mat is None in this case.
+            nroots_si : int
+                Number of roots per symmetry block if davidson_only
+            nworkers : int
+                Number of symmetry blocks to solve concurrently. Defaults to las.nworkers.
+            ints_cache : dict
+                If given, the single-fragment intermediates of the opt=1 algorithm are kept in it
+                and reused by later calls given the same dict (e.g., roots_make_rdm12s) for as
+                long as the CI vectors are unchanged; see lassi_op_o1.make_ints. The caller owns
+                it; discard or clear it to release the intermediates.
+    '''
+    if davidson_only and opt == 0:
+        raise RuntimeError ('Matrix-free LASSI requires opt=1')
     if mo_coeff is None: mo_coeff = las.mo_coeff
     if ci is None: ci = las.ci
     if orbsym is None: 
@@ -73,7 +201,13 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
             orbsym = las.label_symmetry_(las.mo_coeff).orbsym
         if orbsym is not None:
             orbsym = orbsym[las.ncore:las.ncore+las.ncas]
+    # Reference (o0) Hamiltonian: full-CI outer products if they fit in memory, otherwise
+    # fragment-factorized sigma vectors in the product-state sectors
     o0_memcheck = op_o0.memcheck (las, ci)
+    ham_o0 = op_o0.ham
+    if not o0_memcheck and (opt == 0 or las.verbose > lib.logger.INFO):
+        o0_memcheck = op_o0.memcheck (las, ci, factorized=True)
+        ham_o0 = op_o0.ham_factorized
     if opt == 0 and o0_memcheck == False:
         raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
 
@@ -83,27 +217,45 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
     # Symmetry tuple: neleca, nelecb, irrep
     statesym, s2_states = las_symm_tuple (las)
 
+    # Each root is stored in the column of si belonging to one of the LAS states of its symmetry
+    # block; with davidson_only, only the first nroots_si such columns of each block are used
+    found = np.ones (las.nroots, dtype=np.bool_)
+    if davidson_only:
+        for rootsym in set (statesym):
+            idx = np.where (np.all (np.array (statesym) == rootsym, axis=1))[0]
+            found[idx[nroots_si:]] = False
+    col = np.cumsum (found) - 1
+    nfound = np.count_nonzero (found)
+
     # Loop over symmetry blocks
-    e_roots = np.zeros (las.nroots, dtype=np.float64)
-    s2_roots = np.zeros (las.nroots, dtype=np.float64)
-    si = np.zeros ((las.nroots, las.nroots), dtype=np.float64)
-    s2_mat = np.zeros ((las.nroots, las.nroots), dtype=np.float64)
-    for rootsym in set (statesym):
+    e_roots = np.zeros (nfound, dtype=np.float64)
+    s2_roots = np.zeros (nfound, dtype=np.float64)
+    si = np.zeros ((las.nroots, nfound), dtype=np.float64)
+    s2_mat = None if davidson_only else np.zeros ((las.nroots, las.nroots), dtype=np.float64)
+    def solve_block (rootsym):
         idx = np.all (np.array (statesym) == rootsym, axis=1)
+        idx_col = col[idx & found]
         lib.logger.debug (las, 'Diagonalizing LAS state symmetry block (neleca, nelecb, irrep) = {}'.format (rootsym))
         if np.count_nonzero (idx) == 1:
             lib.logger.debug (las, 'Only one state in this symmetry block')
-            e_roots[idx] = las.e_states[idx] - e0
-            si[np.ix_(idx,idx)] = 1.0
-            s2_roots[idx] = s2_states[idx]
-            continue
+            return idx, idx_col, las.e_states[idx] - e0, np.ones ((1,1)), s2_states[idx], None
         wfnsym = rootsym[-1]
         ci_blk = [[c for c, ix in zip (cr, idx) if ix] for cr in ci]
         t0 = (time.clock (), time.time ())
+        if davidson_only:
+            sigma_op = op_o1.ham_sigma (las1, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym,
+                ints_cache=ints_cache)
+            hdiag = las.e_states[idx] - e0
+            conv, e, c, s2_blk = davidson_si (las1, sigma_op.sigma, hdiag, sigma_op.get_ovlp_diag (),
+                nroots=idx_col.size)
+            if not conv: lib.logger.warn (las, 'LASSI Davidson not converged for rootsym {}'.format (rootsym))
+            t0 = lib.logger.timer (las, 'LASSI Davidson rootsym {}'.format (rootsym), *t0)
+            return idx, idx_col, e, c, s2_blk, None
         if (las.verbose > lib.logger.INFO) and (o0_memcheck):
-            ham_ref, s2_ref, ovlp_ref = op_o0.ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+            ham_ref, s2_ref, ovlp_ref = ham_o0 (las1, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
             t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {} CI algorithm'.format (rootsym), *t0)
-            ham_blk, s2_blk, ovlp_blk = op_o1.ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+            ham_blk, s2_blk, ovlp_blk = op_o1.ham (las1, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym,
+                ints_cache=ints_cache)
             t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {} TDM algorithm'.format (rootsym), *t0)
             lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: ham o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (ham_blk - ham_ref))) 
             lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: S2 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (s2_blk - s2_ref))) 
@@ -120,7 +272,9 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
                 ovlp_blk = ovlp_ref
         else:
             if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
-            ham_blk, s2_blk, ovlp_blk = op[opt].ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+            ham_opt = ham_o0 if opt == 0 else op_o1.ham
+            ham_blk, s2_blk, ovlp_blk = ham_opt (las1, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym,
+                ints_cache=ints_cache)
             t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {}'.format (rootsym), *t0)
         lib.logger.debug (las, 'Block Hamiltonian - ecore:')
         lib.logger.debug (las, '{}'.format (ham_blk))
@@ -128,7 +282,7 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         lib.logger.debug (las, '{}'.format (s2_blk))
         lib.logger.debug (las, 'Block overlap matrix:')
         lib.logger.debug (las, '{}'.format (ovlp_blk))
-        s2_mat[np.ix_(idx,idx)] = s2_blk
+        s2_mat_blk = s2_blk
         diag_test = np.diag (ham_blk)
         diag_ref = las.e_states[idx] - e0
         lib.logger.debug (las, '{:>13s} {:>13s} {:>13s}'.format ('Diagonal', 'Reference', 'Error'))
@@ -139,9 +293,37 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         s2_blk = c.conj ().T @ s2_blk @ c
         lib.logger.debug (las, 'Block S**2 in adiabat basis:')
         lib.logger.debug (las, '{}'.format (s2_blk))
-        e_roots[idx] = e
-        s2_roots[idx] = np.diag (s2_blk)
-        si[np.ix_(idx,idx)] = c
+        return idx, idx_col, e, c, np.diag (s2_blk), s2_mat_blk
+
+    # The symmetry blocks are independent. With nworkers > 1, they are solved concurrently,
+    # largest first, in a thread pool, sharing the OpenMP threads; the heavy lifting is in numpy,
+    # BLAS, and pyscf C kernels which release the GIL
+    def block_cost (rootsym):
+        nroots_blk = np.count_nonzero (np.all (np.array (statesym) == rootsym, axis=1))
+        return nroots_blk * nroots_blk * las.ncas**4
+    blocks = sorted (set (statesym), key=block_cost, reverse=True)
+    if nworkers is None: nworkers = getattr (las, 'nworkers', 1) or 1
+    nworkers = max (1, min (nworkers, len (blocks)))
+    if nworkers > 1:
+        las1 = copy.copy (las)
+        las1.nworkers = 1
+        nthreads = max (1, lib.num_threads () // nworkers)
+        def solve_block_threaded (rootsym):
+            with lib.with_omp_threads (nthreads):
+                return solve_block (rootsym)
+        t0 = (time.clock (), time.time ())
+        with ThreadPoolExecutor (max_workers=nworkers) as executor:
+            results = list (executor.map (solve_block_threaded, blocks))
+        lib.logger.timer (las, 'LASSI {} symmetry blocks on {} workers'.format (len (blocks), nworkers), *t0)
+    else:
+        las1 = las
+        results = [solve_block (rootsym) for rootsym in blocks]
+    for idx, idx_col, e, c, s2_blk, s2_mat_blk in results:
+        e_roots[idx_col] = e
+        s2_roots[idx_col] = s2_blk
+        si[np.ix_(idx,idx_col)] = c
+        if s2_mat_blk is not None: s2_mat[np.ix_(idx,idx)] = s2_mat_blk
+    statesym = [sym for sym, ix in zip (statesym, found) if ix]
     idx = np.argsort (e_roots)
     rootsym = np.array (statesym)[idx]
     e_roots = e_roots[idx] + e0
@@ -158,7 +340,7 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         lib.logger.info (las, ' {:2d}  {:16.10f}  {:6d}  {:6d}  {:6.3f}  {:>6s}'.format (ix, er, neleca, nelecb, s2r, wfnsym))
     return e_roots, si
 
-def make_stdm12s (las, ci=None, orbsym=None, opt=1):
+def make_stdm12s (las, ci=None, orbsym=None, opt=1, storage='dense', h5file=None, ints_cache=None):
     ''' Evaluate <I|p'q|J> and <I|p'r'sq|J> where |I>, |J> are LAS states.
 
         Args:
@@ -170,12 +352,28 @@ def make_stdm12s (las, ci=None, orbsym=None, opt=1):
             opt: Optimization level, i.e.,  take outer product of
                 0: CI vectors
                 1: TDMs
+            storage: 'dense', 'sparse', or 'h5'
+                'dense': return ndarrays
+                'sparse': return dicts holding only the interacting pairs (requires opt=1)
+                'h5': write the full ndarrays to HDF5 datasets one pair at a time, without
+                    holding them in memory (requires opt=1)
+            h5file: open h5py File or Group
+                Where to create the datasets 'stdm1s' and 'stdm2s'. Required if storage == 'h5'.
+                The caller owns it and must keep it open while the returned datasets are in use.
+            ints_cache: dict
+                Memo of single-fragment intermediates shared between calls; see lassi
 
         Returns:
             stdm1s: ndarray of shape (nroots,2,ncas,ncas,nroots)
+                or dict of ndarrays of shape (2,ncas,ncas) keyed by (I,J)
+                or h5py Dataset of shape (nroots,2,ncas,ncas,nroots)
             stdm2s: ndarray of shape (nroots,2,ncas,ncas,2,ncas,ncas,nroots)
+                or dict of ndarrays of shape (2,ncas,ncas,2,ncas,ncas) keyed by (I,J)
+                or h5py Dataset of shape (nroots,2,ncas,ncas,2,ncas,ncas,nroots)
     '''
     if ci is None: ci = las.ci
+    if storage != 'dense':
+        return _make_stdm12s_sparse (las, ci, opt=opt, storage=storage, h5file=h5file, ints_cache=ints_cache)
     if orbsym is None: 
         orbsym = getattr (las.mo_coeff, 'orbsym', None)
         if orbsym is None and callable (getattr (las, 'label_symmetry_', None)):
@@ -201,7 +399,7 @@ def make_stdm12s (las, ci=None, orbsym=None, opt=1):
         if (las.verbose > lib.logger.INFO) and (o0_memcheck):
             d1s, d2s = op_o0.make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
             t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {} CI algorithm'.format (rootsym), *t0)
-            d1s_test, d2s_test = op_o1.make_stdm12s (las, ci_blk, idx)
+            d1s_test, d2s_test = op_o1.make_stdm12s (las, ci_blk, idx, ints_cache=ints_cache)
             t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {} TDM algorithm'.format (rootsym), *t0)
             lib.logger.debug (las, 'LASSI make_stdm12s rootsym {}: D1 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (d1s_test - d1s))) 
             lib.logger.debug (las, 'LASSI make_stdm12s rootsym {}: D2 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (d2s_test - d2s))) 
@@ -216,7 +414,8 @@ def make_stdm12s (las, ci=None, orbsym=None, opt=1):
                 d2s = d2s_test
         else:
             if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
-            d1s, d2s = op[opt].make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+            d1s, d2s = op[opt].make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym,
+                ints_cache=ints_cache)
             t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {}'.format (rootsym), *t0)
         idx_int = np.where (idx)[0]
         for (i,a), (j,b) in product (enumerate (idx_int), repeat=2):
@@ -224,7 +423,59 @@ def make_stdm12s (las, ci=None, orbsym=None, opt=1):
             stdm2s[a,...,b] = d2s[i,...,j]
     return stdm1s, stdm2s
 
-def roots_make_rdm12s (las, ci, si, orbsym=None, opt=1):
+def _make_stdm12s_sparse (las, ci, opt=1, storage='sparse', h5file=None, ints_cache=None):
+    if opt == 0:
+        raise RuntimeError ('LASSI make_stdm12s storage={} requires opt=1'.format (storage))
+    norb = las.ncas
+    statesym = las_symm_tuple (las)[0]
+    if storage == 'sparse':
+        stdm1s, stdm2s = {}, {}
+    elif storage == 'h5':
+        if not isinstance (h5file, h5py.Group):
+            raise RuntimeError ('LASSI make_stdm12s storage=h5 requires h5file to be an open h5py File or Group')
+        dtype = ci[0][0].dtype
+        for key in ('stdm1s', 'stdm2s'):
+            if key in h5file: del h5file[key]
+        stdm1s = h5file.create_dataset ('stdm1s', (las.nroots,2,norb,norb,las.nroots),
+            dtype=dtype, chunks=(1,2,norb,norb,1), fillvalue=0)
+        stdm2s = h5file.create_dataset ('stdm2s', (las.nroots,2,norb,norb,2,norb,norb,las.nroots),
+            dtype=dtype, chunks=(1,2,norb,norb,2,norb,norb,1), fillvalue=0)
+    else:
+        raise RuntimeError ('Unknown LASSI make_stdm12s storage {}'.format (storage))
+
+    for rootsym in set (statesym):
+        idx = np.all (np.array (statesym) == rootsym, axis=1)
+        idx_int = np.where (idx)[0]
+        ci_blk = [[c for c, ix in zip (cr, idx) if ix] for cr in ci]
+        t0 = (time.clock (), time.time ())
+        if storage == 'h5':
+            op_o1.make_stdm12s_sparse (las, ci_blk, idx, store1=op_o1.H5PairStore (stdm1s, idx_int),
+                store2=op_o1.H5PairStore (stdm2s, idx_int), ints_cache=ints_cache)
+        else:
+            d1s, d2s = op_o1.make_stdm12s_sparse (las, ci_blk, idx, ints_cache=ints_cache)
+            for (i,j), d in d1s.items (): stdm1s[(idx_int[i],idx_int[j])] = d
+            for (i,j), d in d2s.items (): stdm2s[(idx_int[i],idx_int[j])] = d
+        t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {}'.format (rootsym), *t0)
+    return stdm1s, stdm2s
+
+def roots_make_rdm12s (las, ci, si, orbsym=None, opt=1, ints_cache=None):
+    ''' Evaluate the spin-separated 1- and 2-RDMs of the LASSI roots si
+
+        Args:
+            las: LASCI object
+            ci: list of list of ci vectors
+            si: tagged ndarray of shape (nroots, nroots_si), as returned by lassi
+
+        Kwargs:
+            orbsym: None or list of orbital symmetries spanning the whole orbital space
+            opt: Optimization level, as in make_stdm12s
+            ints_cache: dict
+                Memo of single-fragment intermediates shared between calls; see lassi
+
+        Returns:
+            rdm1s: ndarray of shape (nroots_si,2,ncas,ncas)
+            rdm2s: ndarray of shape (nroots_si,2,ncas,ncas,2,ncas,ncas)
+    '''
     if orbsym is None: 
         orbsym = getattr (las.mo_coeff, 'orbsym', None)
         if orbsym is None and callable (getattr (las, 'label_symmetry_', None)):
@@ -238,9 +489,9 @@ def roots_make_rdm12s (las, ci, si, orbsym=None, opt=1):
     # Symmetry tuple: neleca, nelecb, irrep
     norb = las.ncas
     statesym = las_symm_tuple (las)[0]
-    rdm1s = np.zeros ((las.nroots, 2, norb, norb),
+    rdm1s = np.zeros ((si.shape[1], 2, norb, norb),
         dtype=ci[0][0].dtype)
-    rdm2s = np.zeros ((las.nroots, 2, norb, norb, 2, norb, norb),
+    rdm2s = np.zeros ((si.shape[1], 2, norb, norb, 2, norb, norb),
         dtype=ci[0][0].dtype)
     rootsym = [(ne[0], ne[1], wfnsym) for ne, wfnsym in zip (si.nelec, si.wfnsym)]
 
@@ -254,7 +505,7 @@ def roots_make_rdm12s (las, ci, si, orbsym=None, opt=1):
         if (las.verbose > lib.logger.INFO) and (o0_memcheck):
             d1s, d2s = op_o0.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym, wfnsym=wfnsym)
             t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} CI algorithm'.format (sym), *t0)
-            d1s_test, d2s_test = op_o1.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk)
+            d1s_test, d2s_test = op_o1.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, ints_cache=ints_cache)
             t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} TDM algorithm'.format (sym), *t0)
             lib.logger.debug (las, 'LASSI make_rdm12s rootsym {}: D1 o0-o1 algorithm disagreement = {}'.format (sym, linalg.norm (d1s_test - d1s))) 
             lib.logger.debug (las, 'LASSI make_rdm12s rootsym {}: D2 o0-o1 algorithm disagreement = {}'.format (sym, linalg.norm (d2s_test - d2s))) 
@@ -269,7 +520,8 @@ def roots_make_rdm12s (las, ci, si, orbsym=None, opt=1):
                 d2s = d2s_test
         else:
             if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
-            d1s, d2s = op[opt].roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym, wfnsym=wfnsym)
+            d1s, d2s = op[opt].roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym, wfnsym=wfnsym,
+                ints_cache=ints_cache)
             t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {}'.format (sym), *t0)
         idx_int = np.where (idx_si)[0]
         for (i,a) in enumerate (idx_int):
@@ -5,19 +5,26 @@ from pyscf.fci import cistring
 from pyscf import fci, lib
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from pyscf.fci.spin_op import contract_ss
-from itertools import combinations
+from itertools import combinations, product
 
-def memcheck (las, ci):
+def memcheck (las, ci, factorized=False):
     nfrags = len (ci)
     nroots = len (ci[0])
     assert (all ([len (c) == nroots for c in ci]))
-    mem = sum ([np.prod ([c[iroot].size for c in ci]) 
-        * np.amax ([c[iroot].dtype.itemsize for c in ci]) 
-        for iroot in range (nroots)]) / 1e6
+    if factorized:
+        # ham_factorized holds E_pq|ket> for the pq of one intermediate sector at a time
+        nblk = 2*sum ([n*n for n in las.ncas_sub]) + 2*max (las.ncas_sub)**2 + 4
+        mem = max ([np.prod ([c[iroot].size for c in ci]) 
+            * np.amax ([c[iroot].dtype.itemsize for c in ci]) 
+            for iroot in range (nroots)]) * nblk / 1e6
+    else:
+        mem = sum ([np.prod ([c[iroot].size for c in ci]) 
+            * np.amax ([c[iroot].dtype.itemsize for c in ci]) 
+            for iroot in range (nroots)]) / 1e6
     max_memory = las.max_memory - lib.current_memory ()[0]
     lib.logger.debug (las, 
-        "LASSI op_o0 memory check: {} MB needed of {} MB available ({} MB max)".format (mem,\
-        max_memory, las.max_memory))
+        "LASSI op_o0 {}memory check: {} MB needed of {} MB available ({} MB max)".format (
+        ('factorized ' if factorized else ''), mem, max_memory, las.max_memory))
     return mem < max_memory
 
 def addr_outer_product (norb_f, nelec_f):
@@ -62,7 +69,7 @@ def ci_outer_product (ci_fr, norb_f, nelec_fr):
              sum ([ne[1] for ne in nelec_f]))
     return ci_r, nelec
 
-def ham (las, h1, h2, ci_fr, idx_root, orbsym=None, wfnsym=None):
+def ham (las, h1, h2, ci_fr, idx_root, orbsym=None, wfnsym=None, **kwargs):
     mol = las.mol
     norb_f = las.ncas_sub
     nelec_fr = [[_unpack_nelec (fcibox._get_nelec (solver, nelecas)) for solver, ix in zip (fcibox.fcisolvers, idx_root) if ix] for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
@@ -77,7 +84,178 @@ def ham (las, h1, h2, ci_fr, idx_root, orbsym=None, wfnsym=None):
     ovlp_eff = np.array ([[bra.ravel ().dot (ket.ravel ()) for ket in ci] for bra in ci])
     return ham_eff, s2_eff, ovlp_eff
 
-def make_stdm12s (las, ci_fr, idx_root, orbsym=None, wfnsym=None):
+class ProductSpaceOps (object):
+    ''' Second-quantized operators acting on wave functions in the direct-product space of the
+        fragment CI string spaces, for a fixed number of electrons of each spin in each fragment
+        (a "sector"). A wave function in the sector ne = (neleca_0, nelecb_0, neleca_1, ...) is an
+        ndarray with one axis per fragment and spin, in that order, of length
+        cistring.num_strings (norb_f[ifrag], ne[2*ifrag+spin]). Its amplitudes are those of the
+        full-CI vector with the same determinant ordering as ci_outer_product, so no vector of the
+        size of the full determinant space is ever formed.
+
+        Operators act on the trailing axes of arrays with nbatch leading "batch" axes. '''
+
+    def __init__(self, norb_f):
+        self.norb_f = list (norb_f)
+        self.nfrags = len (norb_f)
+        self.orb_ranges = np.append (0, np.cumsum (norb_f))
+        self._des_mats = {}
+
+    def shape (self, ne):
+        return tuple (cistring.num_strings (self.norb_f[ix//2], n) for ix, n in enumerate (ne))
+
+    def get_des_mat (self, ifrag, nelec):
+        ''' ndarray of shape (norb, nstr (nelec-1), nstr (nelec)) of single-fragment annihilators '''
+        norb = self.norb_f[ifrag]
+        key = (norb, nelec)
+        if key not in self._des_mats:
+            mat = np.zeros ((norb, cistring.num_strings (norb, nelec-1),
+                cistring.num_strings (norb, nelec)), dtype=np.float64)
+            des_index = cistring.gen_des_str_index (range (norb), nelec)
+            addr0 = np.repeat (np.arange (des_index.shape[0]), nelec)
+            mat[des_index[:,:,1].ravel (),des_index[:,:,2].ravel (),addr0] = des_index[:,:,3].ravel ()
+            self._des_mats[key] = mat
+        return self._des_mats[key]
+
+    def get_sign (self, ne, ifrag, spin):
+        ''' Sign from the electrons of the same spin in higher fragments and, for beta operators,
+            from all of the alpha electrons (the sign convention of fci.addons.des_b) '''
+        nperms = sum (ne[2*ifrag+2+spin::2])
+        if spin: nperms += sum (ne[0::2])
+        return 1 - 2*(nperms%2)
+
+    def get_op (self, ne, ifrag, spin, dagger):
+        ''' Annihilators (or, if dagger, creators) of one spin in one fragment as a matrix stack,
+            and the sector which they produce, or None, None if they annihilate the sector '''
+        ix = 2*ifrag + spin
+        nelec = ne[ix]
+        if dagger:
+            if nelec == self.norb_f[ifrag]: return None, None
+            mat = self.get_des_mat (ifrag, nelec+1).transpose (0,2,1)
+        else:
+            if nelec == 0: return None, None
+            mat = self.get_des_mat (ifrag, nelec)
+        ne1 = list (ne)
+        ne1[ix] += 1 if dagger else -1
+        return self.get_sign (ne, ifrag, spin) * mat, tuple (ne1)
+
+    def apply_all (self, x, nbatch, ne, ifrag, spin, dagger):
+        ''' [s_p x for p in ifrag], as an ndarray with a new leading axis, and its sector '''
+        mat, ne1 = self.get_op (ne, ifrag, spin, dagger)
+        if mat is None: return None, None
+        axis = nbatch + 2*ifrag + spin
+        y = np.tensordot (mat, x, axes=((2,),(axis,)))
+        return np.moveaxis (y, 1, 1+axis), ne1
+
+    def apply_sum (self, x, nbatch, ne, ifrag, spin, dagger):
+        ''' sum_p s_p x[p] for p in ifrag, where x[p] is the first batch axis, and its sector '''
+        mat, ne1 = self.get_op (ne, ifrag, spin, dagger)
+        if mat is None: return None, None
+        axis = nbatch + 2*ifrag + spin
+        y = np.tensordot (mat, x, axes=((0,2),(0,axis)))
+        return np.moveaxis (y, 0, axis-1), ne1
+
+    def apply_epq (self, x, nbatch, ne, f, g, spin):
+        ''' [[s'_p s_q x for q in g] for p in f], with two new leading axes, and its sector '''
+        y, ne1 = self.apply_all (x, nbatch, ne, g, spin, False)
+        if y is None: return None, None
+        return self.apply_all (y, nbatch+1, ne1, f, spin, True)
+
+    def contract_epq (self, x, nbatch, ne, f, g, spin):
+        ''' sum_pq s'_p s_q x[p,q] for p in f and q in g, and its sector '''
+        y, ne1 = self.apply_sum (np.swapaxes (x, 0, 1), nbatch, ne, g, spin, False)
+        if y is None: return None, None
+        return self.apply_sum (y, nbatch-1, ne1, f, spin, True)
+
+    def get_epq_sector (self, ne, f, g, spin):
+        ne1 = self.get_op (ne, g, spin, False)[1]
+        if ne1 is None: return None
+        return self.get_op (ne1, f, spin, True)[1]
+
+def _ham_sigma_factorized (ops, h1, h2, ket, ne_ket, ne_bras):
+    ''' H|ket> and S**2|ket> projected onto each sector in ne_bras, fragment block by fragment
+        block, with H = sum_pq h1'_pq E_pq + 1/2 sum_pqrs h2_pqrs E_pq E_rs '''
+    nfrags = ops.nfrags
+    rng = [slice (i, j) for i, j in zip (ops.orb_ranges[:-1], ops.orb_ranges[1:])]
+    h1eff = h1 - 0.5 * np.einsum ('prrq->pq', h2)
+    hket = {ne: np.zeros (ops.shape (ne), dtype=ket.dtype) for ne in ne_bras}
+    s2ket = {ne: np.zeros (ops.shape (ne), dtype=ket.dtype) for ne in ne_bras}
+    frag_pairs = list (product (range (nfrags), repeat=2))
+    def _add (sigma, y, ne):
+        if y is not None and ne in sigma: sigma[ne] += y
+
+    # E_rs|ket>, one intermediate sector at a time
+    sectors = {}
+    for spin, (f, g) in product (range (2), frag_pairs):
+        ne = ops.get_epq_sector (ne_ket, f, g, spin)
+        if ne is not None: sectors.setdefault (ne, []).append ((spin, f, g))
+    for ne, terms in sectors.items ():
+        blocks = {}
+        for spin, f, g in terms:
+            y = ops.apply_epq (ket, 0, ne_ket, f, g, spin)[0]
+            blocks[(f,g)] = blocks[(f,g)] + y if (f,g) in blocks else y
+
+        # One-body part
+        if ne in hket:
+            for (f, g), y in blocks.items ():
+                hket[ne] += np.tensordot (h1eff[rng[f],rng[g]], y, axes=2)
+
+        # Two-body part
+        for spin, (f2, g2) in product (range (2), frag_pairs):
+            if ops.get_epq_sector (ne, f2, g2, spin) not in hket: continue
+            x = sum ([np.tensordot (h2[rng[f2],rng[g2],rng[f],rng[g]], y, axes=2)
+                for (f, g), y in blocks.items ()]) * 0.5
+            _add (hket, *ops.contract_epq (x, 2, ne, f2, g2, spin))
+
+    # S**2 = S-S+ + Sz (Sz + 1)
+    sz = 0.5 * (sum (ne_ket[0::2]) - sum (ne_ket[1::2]))
+    if ne_ket in s2ket: s2ket[ne_ket] += sz * (sz + 1) * ket
+    for g in range (nfrags):
+        y, ne1 = ops.apply_all (ket, 0, ne_ket, g, 1, False)
+        if y is None: continue
+        y, ne1 = ops.apply_sum (y, 1, ne1, g, 0, True)
+        if y is None: continue
+        for f in range (nfrags):
+            z, ne2 = ops.apply_all (y, 0, ne1, f, 0, False)
+            if z is None: continue
+            _add (s2ket, *ops.apply_sum (z, 1, ne2, f, 1, True))
+    return hket, s2ket
+
+def ham_factorized (las, h1, h2, ci_fr, idx_root, orbsym=None, wfnsym=None, **kwargs):
+    ''' Same as ham, but with the sigma vectors of the LAS states evaluated from the
+        fragment-factorized Hamiltonian in the direct-product spaces of the fragment CI string
+        spaces (see ProductSpaceOps), without forming any full-CI vector. Exact, and independent
+        of the TDM intermediates of lassi_op_o1, so it is suitable as a reference for them on
+        systems too large for ham.
+
+        Returns:
+            ham_eff, s2_eff, ovlp_eff: ndarrays of shape (nroots, nroots)
+    '''
+    norb_f = las.ncas_sub
+    nelec_fr = [[_unpack_nelec (fcibox._get_nelec (solver, nelecas)) for solver, ix in zip (fcibox.fcisolvers, idx_root) if ix] for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
+    nroots = len (ci_fr[0])
+    ops = ProductSpaceOps (norb_f)
+    ne_r = [tuple (n for nelec_r in nelec_fr for n in nelec_r[iroot]) for iroot in range (nroots)]
+    kets = []
+    for iroot, ne in enumerate (ne_r):
+        ket = ci_fr[0][iroot].reshape (ops.shape (ne)[0:2])
+        for ifrag in range (1, len (norb_f)):
+            ket = np.multiply.outer (ket, ci_fr[ifrag][iroot].reshape (ops.shape (ne)[2*ifrag:2*ifrag+2]))
+        kets.append (ket / linalg.norm (ket))
+    ne_bras = set (ne_r)
+    dtype = kets[0].dtype
+    ham_eff = np.zeros ((nroots, nroots), dtype=dtype)
+    s2_eff = np.zeros ((nroots, nroots), dtype=dtype)
+    ovlp_eff = np.zeros ((nroots, nroots), dtype=dtype)
+    for j, (ket, ne_ket) in enumerate (zip (kets, ne_r)):
+        hket, s2ket = _ham_sigma_factorized (ops, h1, h2, ket, ne_ket, ne_bras)
+        for i, (bra, ne_bra) in enumerate (zip (kets, ne_r)):
+            ham_eff[i,j] = np.vdot (bra, hket[ne_bra])
+            s2_eff[i,j] = np.vdot (bra, s2ket[ne_bra])
+            if ne_bra == ne_ket: ovlp_eff[i,j] = np.vdot (bra, ket)
+    return ham_eff, s2_eff, ovlp_eff
+
+def make_stdm12s (las, ci_fr, idx_root, orbsym=None, wfnsym=None, **kwargs):
     mol = las.mol
     norb_f = las.ncas_sub
     nelec_fr = [[_unpack_nelec (fcibox._get_nelec (solver, nelecas)) for solver, ix in zip (fcibox.fcisolvers, idx_root) if ix] for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
@@ -111,7 +289,7 @@ def make_stdm12s (las, ci_fr, idx_root, orbsym=None, wfnsym=None):
             stdm2s[j,p,:,:,q,:,:,i] = tdm2.transpose (1,0,3,2)
     return stdm1s, stdm2s 
 
-def roots_make_rdm12s (las, ci_fr, idx_root, si, orbsym=None, wfnsym=None):
+def roots_make_rdm12s (las, ci_fr, idx_root, si, orbsym=None, wfnsym=None, **kwargs):
     mol = las.mol
     norb_f = las.ncas_sub
     nelec_fr = [[_unpack_nelec (fcibox._get_nelec (solver, nelecas)) for solver, ix in zip (fcibox.fcisolvers, idx_root) if ix] for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
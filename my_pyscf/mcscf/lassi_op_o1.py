@@ -1,9 +1,11 @@
 import numpy as np
 from pyscf import lib, fci
+from pyscf.fci import cistring
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from pyscf.fci.addons import cre_a, cre_b, des_a, des_b
 from itertools import product, combinations
-import time
+from concurrent.futures import ThreadPoolExecutor
+import time, threading
 
 def fermion_spin_shuffle (na_list, nb_list):
     ''' Compute the sign factor corresponding to the convention
@@ -45,23 +47,24 @@ def fermion_frag_shuffle (nelec_f, frag_list):
 
         Args:
             nelec_f: list of electron numbers per fragment for the
-                whole state
+                whole state, or ndarray of shape (..., nfrags) for
+                several states at once
             frag_list: list of fragments to coalesce
 
         Returns:
-            sgn: +- 1
+            sgn: +- 1 (ndarray of shape (...) if nelec_f is 2d or more)
     '''
 
+    nelec_f = np.asarray (nelec_f)
     frag_list = list (set (frag_list))
     nperms = 0
     nbtwn = 0
     for ix, frag in enumerate (frag_list[1:]):
         lfrag = frag_list[ix]
         if (frag - lfrag) > 1:
-            nbtwn += sum ([nelec_f[jx] for jx in range (lfrag+1,frag)])
-        if nbtwn:
-            nperms += nelec_f[frag] * nbtwn
-    return (1,-1)[nperms%2]
+            nbtwn = nbtwn + nelec_f[...,lfrag+1:frag].sum (-1)
+        nperms = nperms + nelec_f[...,frag] * nbtwn
+    return 1 - 2*(nperms%2)
 
 def fermion_des_shuffle (nelec_f, frag_list, i):
     ''' Compute the sign factor associated with anticommuting a destruction
@@ -70,14 +73,15 @@ def fermion_des_shuffle (nelec_f, frag_list, i):
         ci ... cj' ci' ch' .. |vac> -> ... cj' ci ci' ch' ... |vac>
 
         Args:
-            nelec_f: list of electron numbers per fragment for the whole state
+            nelec_f: list of electron numbers per fragment for the whole state,
+                or ndarray of shape (..., nfrags) for several states at once
             frag_list: list of fragment numbers actually involved in a given
                 transfer; i.e., the argument 'frag_list' of a recent call to
                 fermion_frag_shuffle
             i: fragment of the destruction operator to commute foward
 
         Returns:
-            sgn: +- 1
+            sgn: +- 1 (ndarray of shape (...) if nelec_f is 2d or more)
         
     '''
     assert (i in frag_list)
@@ -85,10 +89,9 @@ def fermion_des_shuffle (nelec_f, frag_list, i):
     # the destruction operator commutes past the high-index field
     # operators first -> reverse the order of frag_list
     frag_list = list (set (frag_list))[::-1]
-    nelec_f = [nelec_f[ix] for ix in frag_list]
     i = frag_list.index (i)
-    nperms = sum (nelec_f[:i]) if i else 0
-    return (1,-1)[nperms%2]
+    nperms = np.asarray (nelec_f)[...,frag_list[:i]].sum (-1) if i else 0
+    return 1 - 2*(nperms%2)
 
 def lst_hopping_index (fciboxes, nlas, nelelas, idx_root):
     ''' Build the LAS state transition hopping index
@@ -126,6 +129,50 @@ def lst_hopping_index (fciboxes, nlas, nelelas, idx_root):
     onep_index = symm_index & (np.abs (hopping_index).sum ((0,1)) == 2)
     return hopping_index, zerop_index, onep_index
 
+def des_all (ci, norb, nelec, spin):
+    ''' Apply all annihilation operators of one spin to one or more CI vectors at once, using the
+        string link table instead of one fci.addons.des_a/des_b call per orbital.
+
+        Args:
+            ci: ndarray of shape (..., na, nb) or (..., na*nb)
+            norb: int
+            nelec: (int, int)
+                Numbers of electrons of ci
+            spin: 0 or 1
+                Annihilate alpha (a_p) or beta (b_p) electrons
+
+        Returns:
+            pci: ndarray of shape (norb, ..., na', nb')
+                pci[p] = a_p|ci> or b_p|ci>, with the sign convention of fci.addons
+    '''
+    neleca, nelecb = nelec
+    na, nb = cistring.num_strings (norb, neleca), cistring.num_strings (norb, nelecb)
+    ci = np.asarray (ci)
+    lead = ci.shape[:-2] if ci.shape[-2:] == (na, nb) else ci.shape[:-1]
+    ci = ci.reshape (-1, na, nb)
+    nlead = ci.shape[0]
+    if spin == 0:
+        na1 = cistring.num_strings (norb, neleca-1) if neleca > 0 else 0
+        pci = np.zeros ((norb, na1, nlead, nb), dtype=ci.dtype)
+        if neleca > 0:
+            des_index = cistring.gen_des_str_index (range (norb), neleca)
+            p, addr, sgn = des_index[:,:,1], des_index[:,:,2], des_index[:,:,3]
+            pci[p,addr] = sgn[:,:,None,None] * ci.transpose (1,0,2)[:,None,:,:]
+        pci = pci.transpose (0,2,1,3)
+        nstr = (na1, nb)
+    else:
+        nb1 = cistring.num_strings (norb, nelecb-1) if nelecb > 0 else 0
+        pci = np.zeros ((norb, nb1, nlead, na), dtype=ci.dtype)
+        if nelecb > 0:
+            des_index = cistring.gen_des_str_index (range (norb), nelecb)
+            p, addr, sgn = des_index[:,:,1], des_index[:,:,2], des_index[:,:,3]
+            # Sign prefactor for the interchange of the beta operator with the alpha electrons
+            if neleca % 2 == 1: sgn = -sgn
+            pci[p,addr] = sgn[:,:,None,None] * ci.transpose (2,0,1)[:,None,:,:]
+        pci = pci.transpose (0,2,3,1)
+        nstr = (na, nb1)
+    return pci.reshape ((norb,) + tuple (lead) + nstr)
+
 class LSTDMint1 (object):
     ''' Quasi-sparse-memory storage for LAS-state transition density matrix 
         single-fragment intermediates. '''
@@ -246,103 +293,95 @@ class LSTDMint1 (object):
             self.set_dm1 (i, j, np.stack (dm1s, axis=0).transpose (0,2,1)) # Based on docstring of direct_spin1.trans_rdm12s
             if zerop_index[i,j]: self.set_dm2 (i, j, dm2s)
 
-        # Cache some b_p|i> beforehand for the sake of the spin-flip intermediate 
+        # Cache some b_p|i> beforehand for the sake of the spin-flip intermediate
         hidx_ket_a = np.where (np.any (hopping_index[0] < 0, axis=0))[0]
         hidx_ket_b = np.where (np.any (hopping_index[1] < 0, axis=0))[0]
         bpvec_list = [None for ket in range (nroots)]
         for ket in hidx_ket_b:
             if np.any (np.all (hopping_index[:,:,ket] == np.array ([1,-1])[:,None], axis=0)):
-                bpvec_list[ket] = np.stack ([des_b (ci[ket], norb, self.nelec_r[ket], p) for p in range (norb)], axis=0)
+                bpvec_list[ket] = des_all (ci[ket], norb, self.nelec_r[ket], 1)
+
+        def get_bras (spin, ket, hop):
+            bras = np.where (hopping_index[spin,:,ket] < 0)[0]
+            return bras[np.all (hopping_index[:,bras,ket] == np.array (hop)[:,None], axis=0)]
+
+        def bra_matrix (bras):
+            return np.stack ([ci[bra].ravel () for bra in bras], axis=0)
+
+        def put_h (ket, pket, nelec, spin, bras):
+            # <j|a_p|i> or <j|b_p|i>, all j at once
+            if not len (bras): return
+            pket_flat = pket.reshape (norb, -1)
+            for bra, h in zip (bras, bra_matrix (bras) @ pket_flat.T):
+                self.set_h (bra, ket, spin, h)
+            # <j|a'_q a_r s_p|i>, <j|b'_q b_r s_p|i> = (a_q|j>)'.a_r s_p|i>, (b_q|j>)'.b_r s_p|i>
+            bras = [bra for bra in bras if onep_index[bra,ket]]
+            if not len (bras): return
+            phh = []
+            for s in (0,1):
+                rpket = des_all (pket, norb, nelec, s).reshape (norb*norb, -1)
+                qbra = np.concatenate ([des_all (ci[bra], norb, self.nelec_r[bra], s).reshape (
+                    norb, -1) for bra in bras], axis=0).conj ()
+                phh.append ((qbra @ rpket.T).reshape (len (bras), norb, norb, norb))
+            for bra, phh_a, phh_b in zip (bras, *phh):
+                self.set_phh (bra, ket, spin, np.stack ([phh_a, phh_b], axis=0))
+
+        def put_hh (ket, pket, nelec, spin_q, bras, s):
+            # <j|s_q s_p|i>, all j at once
+            if not len (bras): return
+            qpket = des_all (pket, norb, nelec, spin_q).reshape (norb*norb, -1)
+            for bra, hh in zip (bras, bra_matrix (bras) @ qpket.T):
+                self.set_hh (bra, ket, s, hh.reshape (norb, norb))
 
         # a_p|i>
         for ket in hidx_ket_a:
             nelec = self.nelec_r[ket]
-            apket = np.stack ([des_a (ci[ket], norb, nelec, p) for p in range (norb)], axis=0)
+            apket = des_all (ci[ket], norb, nelec, 0)
             nelec = (nelec[0]-1, nelec[1])
-            for bra in np.where (hopping_index[0,:,ket] < 0)[0]:
-                bravec = ci[bra].ravel ()
-                # <j|a_p|i>
-                if np.all (hopping_index[:,bra,ket] == [-1,0]):
-                    self.set_h (bra, ket, 0, bravec.dot (apket.reshape (norb,-1).T))
-                    # <j|a'_q a_r a_p|i>, <j|b'_q b_r a_p|i> - how do I tell if I have a consistent sign rule...?
-                    if onep_index[bra,ket]:
-                        solver = self.fcisolvers[bra]
-                        linkstr = self.linkstr[bra]
-                        phh = np.stack ([solver.trans_rdm12s (ketmat, ci[bra], norb,
-                            self.nelec_r[bra], link_index=linkstr)[0] for ketmat in apket],
-                            axis=-1)# Arg order switched based on docstring of direct_spin1.trans_rdm12s
-                        err = np.abs (phh[0] + phh[0].transpose (0,2,1))
-                        assert (np.amax (err) < 1e-8), '{}'.format (np.amax (err)) 
-                        # ^ Passing this assert proves that I have the correct index
-                        # and argument ordering for the call and return of trans_rdm12s
-                        self.set_phh (bra, ket, 0, phh)
-                # <j|b'_q a_p|i> = <j|s-|i>
-                elif np.all (hopping_index[:,bra,ket] == [-1,1]):
-                    bqbra = bpvec_list[bra].reshape (norb, -1).conj ()
-                    self.set_sm (bra, ket, np.dot (bqbra, apket.reshape (norb, -1).T))
-                # <j|b_q a_p|i>
-                elif np.all (hopping_index[:,bra,ket] == [-1,-1]):
-                    hh = np.array ([[np.dot (bravec, des_b (pket, norb, nelec, q).ravel ())
-                        for pket in apket] for q in range (norb)])
-                    self.set_hh (bra, ket, 1, hh)
-                # <j|a_q a_p|i>
-                elif np.all (hopping_index[:,bra,ket] == [-2,0]):
-                    hh_triu = [bravec.dot (des_a (apket[p], norb, nelec, q).ravel ())
-                        for q, p in combinations (range (norb), 2)] 
-                    hh = np.zeros ((norb, norb), dtype = apket.dtype)
-                    hh[np.triu_indices (norb, k=1)] = hh_triu
-                    hh -= hh.T
-                    self.set_hh (bra, ket, 0, hh)                
-                
+            put_h (ket, apket, nelec, 0, get_bras (0, ket, [-1,0]))
+            # <j|b'_q a_p|i> = <j|s-|i>
+            for bra in get_bras (0, ket, [-1,1]):
+                bqbra = bpvec_list[bra].reshape (norb, -1).conj ()
+                self.set_sm (bra, ket, np.dot (bqbra, apket.reshape (norb, -1).T))
+            # <j|b_q a_p|i>
+            put_hh (ket, apket, nelec, 1, get_bras (0, ket, [-1,-1]), 1)
+            # <j|a_q a_p|i>
+            put_hh (ket, apket, nelec, 0, get_bras (0, ket, [-2,0]), 0)
+
         # b_p|i>
         for ket in hidx_ket_b:
             nelec = self.nelec_r[ket]
-            bpket = np.stack ([des_b (ci[ket], norb, nelec, p)
-                for p in range (norb)], axis=0) if bpvec_list[ket] is None else bpvec_list[ket]
+            bpket = des_all (ci[ket], norb, nelec, 1) if bpvec_list[ket] is None else bpvec_list[ket]
             nelec = (nelec[0], nelec[1]-1)
-            for bra in np.where (hopping_index[1,:,ket] < 0)[0]:
-                bravec = ci[bra].ravel ()
-                # <j|b_p|i>
-                if np.all (hopping_index[:,bra,ket] == [0,-1]):
-                    self.set_h (bra, ket, 1, bravec.dot (bpket.reshape (norb,-1).T))
-                    # <j|a'_q a_r b_p|i>, <j|b'_q b_r b_p|i> - how do I tell if I have a consistent sign rule...?
-                    if onep_index[bra,ket]:
-                        solver = self.fcisolvers[bra]
-                        linkstr = self.linkstr[bra]
-                        phh = np.stack ([solver.trans_rdm12s (ketmat, ci[bra], norb,
-                            self.nelec_r[bra], link_index=linkstr)[0] for ketmat in bpket],
-                            axis=-1) # Arg order switched based on docstring of direct_spin1.trans_rdm12s
-                        err = np.abs (phh[1] + phh[1].transpose (0,2,1))
-                        assert (np.amax (err) < 1e-8), '{}'.format (np.amax (err))
-                        # ^ Passing this assert proves that I have the correct index
-                        # and argument ordering for the call and return of trans_rdm12s
-                        self.set_phh (bra, ket, 1, phh)
-                # <j|b_q b_p|i>
-                elif np.all (hopping_index[:,bra,ket] == [0,-2]):
-                    hh_triu = [bravec.dot (des_b (bpket[p], norb, nelec, q).ravel ())
-                        for q, p in combinations (range (norb), 2)]
-                    hh = np.zeros ((norb, norb), dtype = bpket.dtype)
-                    hh[np.triu_indices (norb, k=1)] = hh_triu
-                    hh -= hh.T
-                    self.set_hh (bra, ket, 2, hh)                
-        
+            put_h (ket, bpket, nelec, 1, get_bras (1, ket, [0,-1]))
+            # <j|b_q b_p|i>
+            put_hh (ket, bpket, nelec, 1, get_bras (1, ket, [0,-2]), 2)
+
         return t0
 
 class LSTDMint2 (object):
     ''' Intermediate-storage convenience object for second pass of LAS-state tdm12s calculations
         Subclass the __init__, __??t_D?_, __add_transpose__, and kernel methods to do various
         different things which rely on LAS-state tdm12s as intermediates without cacheing the whole
-        things (i.e. operators or DMs in different basis)'''
-    # TODO: at some point, if it ever becomes rate-limiting, make this multithread better
+        things (i.e. operators or DMs in different basis)
+
+        Interactions are grouped by type and by the fragments and spins involved, and each group is
+        crunched in batches of bra/ket pairs: the cruncher, _get_D?_, and _put_D?_ methods take
+        integer arrays bra and ket and work on D1 and D2 arrays with a leading batch dimension.
+        Batches are distributed over nworkers threads. Every bra/ket pair belongs to exactly one
+        batch.'''
 
-    def __init__(self, ints, nlas, hopping_index, dtype=np.float64):
+    def __init__(self, ints, nlas, hopping_index, dtype=np.float64, max_memory=2000, nworkers=1):
         self.ints = ints
         self.nlas = nlas
         self.norb = sum (nlas)
         self.hopping_index = hopping_index
         self.nfrags, _, self.nroots, _ = hopping_index.shape
         self.dtype = dtype
+        self.max_memory = max_memory
+        self.nworkers = max (1, nworkers)
         self.tdm1s = self.tdm2s = None
+        self._lock = threading.Lock ()
         # Process connectivity data to quickly distinguish interactions
 
         # Should probably be all == true anyway if I call this by symmetry blocks
@@ -398,7 +437,7 @@ class LSTDMint2 (object):
         self.ovlp = np.stack ([i.ovlp for i in ints], axis=-1)
         # spin-shuffle sign vector
         self.nelec_rf = np.asarray ([[list (i.nelec_r[ket]) for i in ints] for ket in range (self.nroots)]).transpose (0,2,1)
-        self.spin_shuffle = [fermion_spin_shuffle (nelec_sf[0], nelec_sf[1]) for nelec_sf in self.nelec_rf]
+        self.spin_shuffle = np.asarray ([fermion_spin_shuffle (nelec_sf[0], nelec_sf[1]) for nelec_sf in self.nelec_rf])
         self.nelec_rf = self.nelec_rf.sum (1)
 
     def get_range (self, i):
@@ -409,24 +448,34 @@ class LSTDMint2 (object):
     def get_ovlp_fac (self, bra, ket, *inv):
         idx = np.ones (self.nfrags, dtype=np.bool_)
         idx[list (inv)] = False
-        wgt = np.prod (self.ovlp[bra,ket,idx])
+        wgt = np.prod (self.ovlp[bra,ket][...,idx], axis=-1)
         uniq_frags = list (set (inv))
         wgt *= self.spin_shuffle[bra] * self.spin_shuffle[ket]
         wgt *= fermion_frag_shuffle (self.nelec_rf[bra], uniq_frags)
         wgt *= fermion_frag_shuffle (self.nelec_rf[ket], uniq_frags)
         return wgt
 
+    def get_des_fac (self, bra, ket, frag_list, i, j):
+        ''' Product of fermion_des_shuffle factors for fragment i in the bra and fragment j in the
+            ket '''
+        return (fermion_des_shuffle (self.nelec_rf[bra], frag_list, i)
+              * fermion_des_shuffle (self.nelec_rf[ket], frag_list, j))
+
+    def _gather (self, get, bra, ket, *args):
+        ''' Stack a single-fragment intermediate over a batch of bra/ket pairs '''
+        return np.stack ([np.asarray (get (b, k, *args)) for b, k in zip (bra, ket)], axis=0)
+
     def _get_D1_(self, bra, ket):
         return self.tdm1s[bra,ket]
 
     def _put_D1_(self, bra, ket, D1):
-        pass
+        self.tdm1s[bra,ket] = D1
 
     def _get_D2_(self, bra, ket):
         return self.tdm2s[bra,ket]
 
     def _put_D2_(self, bra, ket, D2):
-        pass
+        self.tdm2s[bra,ket] = D2
 
     # Cruncher functions
     def _crunch_null_(self, bra, ket):
@@ -436,23 +485,23 @@ class LSTDMint2 (object):
         for i, inti in enumerate (self.ints):
             p = sum (nlas[:i])
             q = p + nlas[i]
-            d1_s_ii = inti.get_dm1 (bra, ket)
+            d1_s_ii = self._gather (inti.get_dm1, bra, ket)
             fac = self.get_ovlp_fac (bra, ket, i)
-            d1[:,p:q,p:q] = fac * np.asarray (d1_s_ii)
-            d2[:,p:q,p:q,p:q,p:q] = fac * np.asarray (inti.get_dm2 (bra, ket))
+            d1[:,:,p:q,p:q] = fac[:,None,None,None] * d1_s_ii
+            d2[:,:,p:q,p:q,p:q,p:q] = fac[:,None,None,None,None,None] * self._gather (inti.get_dm2, bra, ket)
             for j, intj in enumerate (self.ints[:i]):
                 assert (i>j)
                 r = sum (nlas[:j])
                 s = r + nlas[j]
-                d1_s_jj = intj.get_dm1 (bra, ket)
-                d2_s_iijj = np.multiply.outer (d1_s_ii, d1_s_jj).transpose (0,3,1,2,4,5)
-                d2_s_iijj = d2_s_iijj.reshape (4, q-p, q-p, s-r, s-r)
-                d2_s_iijj *= self.get_ovlp_fac (bra, ket, i, j)
-                d2[:,p:q,p:q,r:s,r:s] = d2_s_iijj
-                d2[(0,3),r:s,r:s,p:q,p:q] = d2_s_iijj[(0,3),...].transpose (0,3,4,1,2)
-                d2[(1,2),r:s,r:s,p:q,p:q] = d2_s_iijj[(2,1),...].transpose (0,3,4,1,2)
-                d2[(0,3),p:q,r:s,r:s,p:q] = -d2_s_iijj[(0,3),...].transpose (0,1,4,3,2)
-                d2[(0,3),r:s,p:q,p:q,r:s] = -d2_s_iijj[(0,3),...].transpose (0,3,2,1,4)
+                d1_s_jj = self._gather (intj.get_dm1, bra, ket)
+                d2_s_iijj = d1_s_ii[:,:,None,:,:,None,None] * d1_s_jj[:,None,:,None,None,:,:]
+                d2_s_iijj = d2_s_iijj.reshape (-1, 4, q-p, q-p, s-r, s-r)
+                d2_s_iijj *= self.get_ovlp_fac (bra, ket, i, j)[:,None,None,None,None,None]
+                d2[:,:,p:q,p:q,r:s,r:s] = d2_s_iijj
+                d2[:,(0,3),r:s,r:s,p:q,p:q] = d2_s_iijj[:,(0,3),...].transpose (0,1,4,5,2,3)
+                d2[:,(1,2),r:s,r:s,p:q,p:q] = d2_s_iijj[:,(2,1),...].transpose (0,1,4,5,2,3)
+                d2[:,(0,3),p:q,r:s,r:s,p:q] = -d2_s_iijj[:,(0,3),...].transpose (0,1,2,5,4,3)
+                d2[:,(0,3),r:s,p:q,p:q,r:s] = -d2_s_iijj[:,(0,3),...].transpose (0,1,4,3,2,5)
         self._put_D1_(bra, ket, d1)
         self._put_D2_(bra, ket, d2)
 
@@ -462,37 +511,39 @@ class LSTDMint2 (object):
         inti, intj = self.ints[i], self.ints[j]
         p, q = self.get_range (i)
         r, s = self.get_range (j)
-        fac = 1
         fac = self.get_ovlp_fac (bra, ket, i, j)
-        fac *= fermion_des_shuffle (self.nelec_rf[bra], (i, j), i)
-        fac *= fermion_des_shuffle (self.nelec_rf[ket], (i, j), j)
-        d1_ij = np.multiply.outer (self.ints[i].get_p (bra, ket, s1), self.ints[j].get_h (bra, ket, s1))
-        d1[s1,p:q,r:s] = fac * d1_ij
+        fac *= self.get_des_fac (bra, ket, (i, j), i, j)
+        d1_ij = (self._gather (inti.get_p, bra, ket, s1)[:,:,None]
+               * self._gather (intj.get_h, bra, ket, s1)[:,None,:])
+        d1[:,s1,p:q,r:s] = fac[:,None,None] * d1_ij
         s12l = s1 * 2   # aa: 0 OR ba: 2
-        s12h = s12l + 1 # ab: 1 OR bb: 3 
+        s12h = s12l + 1 # ab: 1 OR bb: 3
         s21l = s1       # aa: 0 OR ab: 1
         s21h = s21l + 2 # ba: 2 OR bb: 3
         s1s1 = s1 * 3   # aa: 0 OR bb: 3
         def _crunch_1c_tdm2 (d2_ijkk, i0, i1, j0, j1, k0, k1):
-            d2[(s12l,s12h), i0:i1, j0:j1, k0:k1, k0:k1] = d2_ijkk
-            d2[(s21l,s21h), k0:k1, k0:k1, i0:i1, j0:j1] = d2_ijkk.transpose (0,3,4,1,2)
-            d2[s1s1, i0:i1, k0:k1, k0:k1, j0:j1] = -d2_ijkk[s1,...].transpose (0,3,2,1)
-            d2[s1s1, k0:k1, j0:j1, i0:i1, k0:k1] = -d2_ijkk[s1,...].transpose (2,1,0,3)
+            d2[:,(s12l,s12h), i0:i1, j0:j1, k0:k1, k0:k1] = d2_ijkk
+            d2[:,(s21l,s21h), k0:k1, k0:k1, i0:i1, j0:j1] = d2_ijkk.transpose (0,1,4,5,2,3)
+            d2[:,s1s1, i0:i1, k0:k1, k0:k1, j0:j1] = -d2_ijkk[:,s1,...].transpose (0,1,4,3,2)
+            d2[:,s1s1, k0:k1, j0:j1, i0:i1, k0:k1] = -d2_ijkk[:,s1,...].transpose (0,3,2,1,4)
+        fac6 = fac[:,None,None,None,None,None]
         # pph (transpose is from Dirac order to Mulliken order)
-        d2_ijii = fac * np.multiply.outer (self.ints[i].get_pph (bra, ket, s1), self.ints[j].get_h (bra, ket, s1)).transpose (0,1,4,2,3)
+        d2_ijii = fac6 * (self._gather (inti.get_pph, bra, ket, s1)[...,None]
+            * self._gather (intj.get_h, bra, ket, s1)[:,None,None,None,None,:]).transpose (0,1,2,5,3,4)
         _crunch_1c_tdm2 (d2_ijii, p, q, r, s, p, q)
         # phh (transpose is to bring spin onto the outside and then from Dirac order to Mulliken order)
-        d2_ijjj = fac * np.multiply.outer (self.ints[i].get_p (bra, ket, s1), self.ints[j].get_phh (bra, ket, s1)).transpose (1,0,4,2,3)
+        d2_ijjj = fac6 * (self._gather (inti.get_p, bra, ket, s1)[:,:,None,None,None,None]
+            * self._gather (intj.get_phh, bra, ket, s1)[:,None,...]).transpose (0,2,1,5,3,4)
         _crunch_1c_tdm2 (d2_ijjj, p, q, r, s, r, s)
         # spectator fragment mean-field (should automatically be in Mulliken order)
         for k in range (self.nfrags):
             if k in (i, j): continue
             fac = self.get_ovlp_fac (bra, ket, i, j, k)
-            fac *= fermion_des_shuffle (self.nelec_rf[bra], (i, j, k), i)
-            fac *= fermion_des_shuffle (self.nelec_rf[ket], (i, j, k), j)
+            fac *= self.get_des_fac (bra, ket, (i, j, k), i, j)
             t, u = self.get_range (k)
-            d1_skk = self.ints[k].get_dm1 (bra, ket)
-            d2_ijkk = fac * np.multiply.outer (d1_ij, d1_skk).transpose (2,0,1,3,4)
+            d1_skk = self._gather (self.ints[k].get_dm1, bra, ket)
+            d2_ijkk = (d1_ij[:,:,:,None,None,None] * d1_skk[:,None,None,:,:,:]).transpose (0,3,1,2,4,5)
+            d2_ijkk *= fac[:,None,None,None,None,None]
             _crunch_1c_tdm2 (d2_ijkk, p, q, r, s, t, u)
         self._put_D1_(bra, ket, d1)
         self._put_D2_(bra, ket, d2)
@@ -501,11 +552,12 @@ class LSTDMint2 (object):
         d2 = self._get_D2_(bra, ket) # aa, ab, ba, bb -> 0, 1, 2, 3
         p, q = self.get_range (i)
         r, s = self.get_range (j)
-        y, z = min (i, j), max (i, j)
         fac = -1 * self.get_ovlp_fac (bra, ket, i, j)
-        d2_spsm = fac * np.multiply.outer (self.ints[i].get_sp (bra, ket), self.ints[j].get_sm (bra, ket))
-        d2[1,p:q,r:s,r:s,p:q] = d2_spsm.transpose (0,3,2,1)
-        d2[2,r:s,p:q,p:q,r:s] = d2_spsm.transpose (2,1,0,3)
+        d2_spsm = (self._gather (self.ints[i].get_sp, bra, ket)[:,:,:,None,None]
+                 * self._gather (self.ints[j].get_sm, bra, ket)[:,None,None,:,:])
+        d2_spsm *= fac[:,None,None,None,None]
+        d2[:,1,p:q,r:s,r:s,p:q] = d2_spsm.transpose (0,1,4,3,2)
+        d2[:,2,r:s,p:q,p:q,r:s] = d2_spsm.transpose (0,3,2,1,4)
         self._put_D2_(bra, ket, d2)
 
     def _crunch_1s1c_(self, bra, ket, i, j, k):
@@ -514,13 +566,14 @@ class LSTDMint2 (object):
         r, s = self.get_range (j)
         t, u = self.get_range (k)
         fac = -1 * self.get_ovlp_fac (bra, ket, i, j, k) # a'bb'a -> a'ab'b sign
-        fac *= fermion_des_shuffle (self.nelec_rf[bra], (i, j, k), i)
-        fac *= fermion_des_shuffle (self.nelec_rf[ket], (i, j, k), j)
-        sp = np.multiply.outer (self.ints[i].get_p (bra, ket, 0), self.ints[j].get_h (bra, ket, 1))
-        sm = self.ints[k].get_sm (bra, ket)
-        d2_ikkj = fac * np.multiply.outer (sp, sm).transpose (0,3,2,1) # a'bb'a -> a'ab'b transpose
-        d2[1,p:q,t:u,t:u,r:s] = d2_ikkj
-        d2[2,t:u,r:s,p:q,t:u] = d2_ikkj.transpose (2,3,0,1)
+        fac *= self.get_des_fac (bra, ket, (i, j, k), i, j)
+        sp = (self._gather (self.ints[i].get_p, bra, ket, 0)[:,:,None]
+            * self._gather (self.ints[j].get_h, bra, ket, 1)[:,None,:])
+        sm = self._gather (self.ints[k].get_sm, bra, ket)
+        d2_ikkj = (sp[:,:,:,None,None] * sm[:,None,None,:,:]).transpose (0,1,4,3,2) # a'bb'a -> a'ab'b transpose
+        d2_ikkj *= fac[:,None,None,None,None]
+        d2[:,1,p:q,t:u,t:u,r:s] = d2_ikkj
+        d2[:,2,t:u,r:s,p:q,t:u] = d2_ikkj.transpose (0,3,4,1,2)
         self._put_D2_(bra, ket, d2)
 
     def _crunch_2c_(self, bra, ket, i, j, k, l, s2lt):
@@ -533,41 +586,91 @@ class LSTDMint2 (object):
         d2 = self._get_D2_(bra, ket)
         fac = self.get_ovlp_fac (bra, ket, i, j, k, l)
         if i == k:
-            pp = self.ints[i].get_pp (bra, ket, s2lt)
-            if s2lt != 1: assert (np.all (np.abs (pp + pp.T)) < 1e-8), '{}'.format (np.amax (np.abs (pp + pp.T)))
+            pp = self._gather (self.ints[i].get_pp, bra, ket, s2lt)
+            if s2lt != 1:
+                err = np.amax (np.abs (pp + pp.transpose (0,2,1)))
+                assert (err < 1e-8), '{}'.format (err)
         else:
-            pp = np.multiply.outer (self.ints[i].get_p (bra, ket, s11), self.ints[k].get_p (bra, ket, s12))
+            pp = (self._gather (self.ints[i].get_p, bra, ket, s11)[:,:,None]
+                * self._gather (self.ints[k].get_p, bra, ket, s12)[:,None,:])
             fac *= (1,-1)[int (i>k)]
             fac *= fermion_des_shuffle (self.nelec_rf[bra], (i, j, k, l), i)
             fac *= fermion_des_shuffle (self.nelec_rf[bra], (i, j, k, l), k)
         if j == l:
-            hh = self.ints[j].get_hh (bra, ket, s2lt)
-            if s2lt != 1: assert (np.all (np.abs (hh + hh.T)) < 1e-8), '{}'.format (np.amax (np.abs (hh + hh.T)))
+            hh = self._gather (self.ints[j].get_hh, bra, ket, s2lt)
+            if s2lt != 1:
+                err = np.amax (np.abs (hh + hh.transpose (0,2,1)))
+                assert (err < 1e-8), '{}'.format (err)
         else:
-            hh = np.multiply.outer (self.ints[l].get_h (bra, ket, s12), self.ints[j].get_p (bra, ket, s11))
+            hh = (self._gather (self.ints[l].get_h, bra, ket, s12)[:,:,None]
+                * self._gather (self.ints[j].get_p, bra, ket, s11)[:,None,:])
             fac *= (1,-1)[int (j>l)]
             fac *= fermion_des_shuffle (self.nelec_rf[ket], (i, j, k, l), j)
             fac *= fermion_des_shuffle (self.nelec_rf[ket], (i, j, k, l), l)
-        d2_ijkl = fac * np.multiply.outer (pp, hh).transpose (0,3,1,2) # Dirac -> Mulliken transpose
+        d2_ijkl = (pp[:,:,:,None,None] * hh[:,None,None,:,:]).transpose (0,1,4,2,3) # Dirac -> Mulliken transpose
+        d2_ijkl *= fac[:,None,None,None,None]
         p, q = self.get_range (i)
         r, s = self.get_range (j)
-        t, u = self.get_range (k) 
+        t, u = self.get_range (k)
         v, w = self.get_range (l)
-        d2[s2, p:q,r:s,t:u,v:w] = d2_ijkl
-        d2[s2T,t:u,v:w,p:q,r:s] = d2_ijkl.transpose (2,3,0,1)
+        d2[:,s2, p:q,r:s,t:u,v:w] = d2_ijkl
+        d2[:,s2T,t:u,v:w,p:q,r:s] = d2_ijkl.transpose (0,3,4,1,2)
         if s2 == s2T: # same-spin only: exchange happens
-            d2[s2,p:q,v:w,t:u,r:s] = -d2_ijkl.transpose (0,3,2,1)
-            d2[s2,t:u,r:s,p:q,v:w] = -d2_ijkl.transpose (2,1,0,3)
+            d2[:,s2,p:q,v:w,t:u,r:s] = -d2_ijkl.transpose (0,1,4,3,2)
+            d2[:,s2,t:u,r:s,p:q,v:w] = -d2_ijkl.transpose (0,3,2,1,4)
         self._put_D2_(bra, ket, d2)
 
+    def _get_blksize (self):
+        ''' Number of bra/ket pairs per batch such that all workers together, each holding a few
+            D2-sized temporaries per pair, stay within max_memory '''
+        norb = self.norb
+        pair_size = (4*norb**4 + 2*norb**2) * np.dtype (self.dtype).itemsize
+        return max (1, int (self.max_memory*1e6 / (4*pair_size*self.nworkers)))
+
+    def _make_batches (self, crunch, exc):
+        ''' Split the rows of an interaction list into batches of bra/ket pairs which share the
+            remaining arguments of crunch (fragment and spin indices) '''
+        if len (exc) == 0: return []
+        blksize = self._get_blksize ()
+        if exc.shape[1] > 2:
+            keys, inv = np.unique (exc[:,2:], axis=0, return_inverse=True)
+            inv = inv.ravel ()
+        else:
+            keys, inv = np.zeros ((1,0), dtype=exc.dtype), np.zeros (len (exc), dtype=int)
+        batches = []
+        for ikey, key in enumerate (keys):
+            rows = exc[inv==ikey]
+            args = tuple (int (x) for x in key)
+            for i0 in range (0, len (rows), blksize):
+                i1 = min (len (rows), i0+blksize)
+                batches.append ((crunch, rows[i0:i1,0], rows[i0:i1,1], args))
+        return batches
+
+    def _crunch_batches_(self, batches):
+        def crunch_batch (batch):
+            crunch, bra, ket, args = batch
+            crunch (bra, ket, *args)
+        nworkers = min (self.nworkers, len (batches))
+        if nworkers > 1:
+            nthreads = max (1, lib.num_threads () // nworkers)
+            def crunch_batch_threaded (batch):
+                with lib.with_omp_threads (nthreads):
+                    crunch_batch (batch)
+            with ThreadPoolExecutor (max_workers=nworkers) as executor:
+                list (executor.map (crunch_batch_threaded, batches))
+        else:
+            for batch in batches: crunch_batch (batch)
+
     def _crunch_all_(self):
-        for row in self.exc_null: self._crunch_null_(*row)
-        for row in self.exc_1c: self._crunch_1c_(*row)
-        for row in self.exc_1s: self._crunch_1s_(*row)
-        for row in self.exc_1s1c: self._crunch_1s1c_(*row)
-        for row in self.exc_2c: self._crunch_2c_(*row)
+        batches = (self._make_batches (self._crunch_null_, self.exc_null)
+                 + self._make_batches (self._crunch_1c_, self.exc_1c)
+                 + self._make_batches (self._crunch_1s_, self.exc_1s)
+                 + self._make_batches (self._crunch_1s1c_, self.exc_1s1c)
+                 + self._make_batches (self._crunch_2c_, self.exc_2c))
+        self._crunch_batches_(batches)
         self._add_transpose_()
-        for state in range (self.nroots): self._crunch_null_(state, state)
+        diag = np.repeat (np.arange (self.nroots)[:,None], 2, axis=1)
+        self._crunch_batches_(self._make_batches (self._crunch_null_, diag))
 
     def _add_transpose_(self):
         self.tdm1s += self.tdm1s.conj ().transpose (1,0,2,4,3)
@@ -580,32 +683,116 @@ class LSTDMint2 (object):
         self._crunch_all_()
         return self.tdm1s, self.tdm2s, t0
 
+class LSTDMint2Sparse (LSTDMint2):
+    ''' LSTDMint2 which keeps the LAS-state tdm12s of only the interacting bra/ket pairs, each in
+        its own (2,norb,norb) or (4,norb,norb,norb,norb) block, in dict-like stores keyed by
+        (bra, ket): plain dicts by default, or, e.g., H5PairStore to stream them to disk '''
+
+    def __init__(self, ints, nlas, hopping_index, dtype=np.float64, store1=None, store2=None, **kwargs):
+        LSTDMint2.__init__(self, ints, nlas, hopping_index, dtype=dtype, **kwargs)
+        self.store1 = {} if store1 is None else store1
+        self.store2 = {} if store2 is None else store2
+
+    def _get_D1_(self, bra, ket):
+        return np.zeros ([len (bra),2]+[self.norb,]*2, dtype=self.dtype)
+
+    def _get_D2_(self, bra, ket):
+        return np.zeros ([len (bra),4]+[self.norb,]*4, dtype=self.dtype)
+
+    def _put_D1_(self, bra, ket, D1):
+        with self._lock:
+            for b, k, d in zip (bra, ket, D1): self.store1[(b,k)] = d
+
+    def _put_D2_(self, bra, ket, D2):
+        with self._lock:
+            for b, k, d in zip (bra, ket, D2): self.store2[(b,k)] = d
+
+    def _add_transpose_(self):
+        for store, axes in ((self.store1, (0,2,1)), (self.store2, (0,2,1,4,3))):
+            for bra, ket in [key for key in store.keys () if key[0] > key[1] or (key[::-1] not in store)]:
+                d_bk = store[(bra,ket)]
+                d_kb = store[(ket,bra)] if (ket,bra) in store else None
+                if d_kb is None:
+                    store[(ket,bra)] = d_bk.conj ().transpose (*axes)
+                else:
+                    d_bk, d_kb = d_bk + d_kb.conj ().transpose (*axes), d_kb + d_bk.conj ().transpose (*axes)
+                    store[(bra,ket)] = d_bk
+                    store[(ket,bra)] = d_kb
+
+    def kernel (self):
+        t0 = (time.clock (), time.time ())
+        self._crunch_all_()
+        return self.store1, self.store2, t0
+
+class H5PairStore (object):
+    ''' Dict-like access, by (bra, ket) within a symmetry block, to the blocks of an HDF5 dataset
+        of LAS-state tdm1s or tdm2s in the layout returned by make_stdm12s, i.e., of shape
+        (nroots,2,norb,norb,nroots) or (nroots,2,norb,norb,2,norb,norb,nroots). Values are in the
+        layout used internally by LSTDMint2. '''
+
+    def __init__(self, ds, idx_root):
+        self.ds = ds
+        self.idx_root = idx_root
+        self.norb = ds.shape[2]
+        self._keys = set ()
+
+    def _to_ds (self, x):
+        if self.ds.ndim == 5: return x
+        n = self.norb
+        return x.reshape (2,2,n,n,n,n).transpose (0,2,3,1,4,5)
+
+    def _from_ds (self, x):
+        if self.ds.ndim == 5: return x
+        n = self.norb
+        return x.transpose (0,3,1,2,4,5).reshape (4,n,n,n,n)
+
+    def __setitem__(self, key, x):
+        bra, ket = key
+        self.ds[self.idx_root[bra],...,self.idx_root[ket]] = self._to_ds (x)
+        self._keys.add ((bra, ket))
+
+    def __getitem__(self, key):
+        if key not in self._keys: raise KeyError (key)
+        bra, ket = key
+        return self._from_ds (self.ds[self.idx_root[bra],...,self.idx_root[ket]])
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def keys (self):
+        return list (self._keys)
+
 class HamS2ovlpint (LSTDMint2):
     ''' For computing the Hamiltonian, S^2, and overlap matrices without storing
         the entire stdm12s arrays '''
 
-    def __init__(self, ints, nlas, hopping_index, h1, h2, dtype=np.float64):
-        LSTDMint2.__init__(self, ints, nlas, hopping_index, dtype=dtype)
+    def __init__(self, ints, nlas, hopping_index, h1, h2, dtype=np.float64, **kwargs):
+        LSTDMint2.__init__(self, ints, nlas, hopping_index, dtype=dtype, **kwargs)
         self.h1 = h1.ravel ()
         self.h2 = h2.ravel ()
 
     def _get_D1_(self, bra, ket):
-        self.d1[:] = 0.0
-        return self.d1
+        return np.zeros ([len (bra),2]+[self.norb,]*2, dtype=self.dtype)
 
     def _get_D2_(self, bra, ket):
-        self.d2[:] = 0.0
-        return self.d2
+        return np.zeros ([len (bra),4]+[self.norb,]*4, dtype=self.dtype)
 
     def _put_D1_(self, bra, ket, D1):
-        M1 = D1[0] - D1[1]
-        D1 = D1.sum (0)
-        self.ham[bra,ket] += np.dot (self.h1, D1.ravel ())
-        self.s2[bra,ket] += (np.trace (M1)/2)**2 + np.trace (D1)/2
+        M1 = D1[:,0] - D1[:,1]
+        D1 = D1.sum (1)
+        ham = np.dot (D1.reshape (len (bra), -1), self.h1)
+        s2 = (np.einsum ('npp->n', M1)/2)**2 + np.einsum ('npp->n', D1)/2
+        self._put_ham_s2_(bra, ket, ham, s2)
 
     def _put_D2_(self, bra, ket, D2):
-        self.ham[bra,ket] += np.dot (self.h2, D2.sum (0).ravel ()) / 2
-        self.s2[bra,ket] -= np.einsum ('pqqp->', D2[1] + D2[2]) / 2
+        ham = np.dot (D2.sum (1).reshape (len (bra), -1), self.h2) / 2
+        s2 = -np.einsum ('npqqp->n', D2[:,1] + D2[:,2]) / 2
+        self._put_ham_s2_(bra, ket, ham, s2)
+
+    def _put_ham_s2_(self, bra, ket, ham, s2):
+        # No two batches share a bra/ket pair, so no lock is needed here
+        self.ham[bra,ket] += ham
+        self.s2[bra,ket] += s2
 
     def _add_transpose_(self):
         self.ham += self.ham.T
@@ -613,8 +800,6 @@ class HamS2ovlpint (LSTDMint2):
 
     def kernel (self):
         t0 = (time.clock (), time.time ())
-        self.d1 = np.zeros ([2,]+[self.norb,]*2, dtype=self.dtype)
-        self.d2 = np.zeros ([4,]+[self.norb,]*4, dtype=self.dtype)
         self.ham = np.zeros ([self.nroots,]*2, dtype=self.dtype)
         self.s2 = np.zeros ([self.nroots,]*2, dtype=self.dtype)
         self._crunch_all_()
@@ -622,29 +807,91 @@ class HamS2ovlpint (LSTDMint2):
         ovlp *= np.multiply.outer (self.spin_shuffle, self.spin_shuffle)
         return self.ham, self.s2, ovlp, t0
 
+class HamS2ovlpSigma (HamS2ovlpint):
+    ''' For applying the Hamiltonian, S^2, and overlap matrices to a block of vectors in the basis
+        of LAS states without assembling any of those matrices (or the stdm12s arrays).
+
+        This does not make the storage O(nroots): the connectivity data of LSTDMint2 (the
+        hopping_index of shape (nfrags,2,nroots,nroots), the per-fragment overlaps self.ovlp of
+        shape (nroots,nroots,nfrags), and the exc_* lists of interacting pairs) and the
+        single-fragment intermediates of every LSTDMint1 (including its own (nroots,nroots) ovlp)
+        are kept, so memory is still O(nfrags*nroots**2). What is saved is the dense ham, s2, and
+        ovlp and their eigendecomposition. Every call to sigma crunches all interactions again,
+        so one Davidson iteration costs about as much as one full call to ham. '''
+
+    def _put_ham_s2_(self, bra, ket, ham, s2):
+        # Lower triangle -> hx, upper triangle -> hxT; the two meet in _add_transpose_
+        x = self.x
+        with self._lock:
+            np.add.at (self.hx, bra, ham[:,None] * x[ket])
+            np.add.at (self.hxT, ket, ham.conj ()[:,None] * x[bra])
+            np.add.at (self.s2x, bra, s2[:,None] * x[ket])
+            np.add.at (self.s2xT, ket, s2.conj ()[:,None] * x[bra])
+
+    def _add_transpose_(self):
+        # The diagonal elements are crunched after this, and hxT, s2xT are not read again
+        self.hx += self.hxT
+        self.s2x += self.s2xT
+
+    def get_ovlp (self, i0=0, i1=None):
+        ''' Rows i0:i1 of the overlap matrix '''
+        if i1 is None: i1 = self.nroots
+        ovlp = np.prod (self.ovlp[i0:i1], axis=-1)
+        ovlp *= np.multiply.outer (self.spin_shuffle[i0:i1], self.spin_shuffle)
+        return ovlp
+
+    def get_ovlp_diag (self):
+        idx = np.arange (self.nroots)
+        return np.prod (self.ovlp[idx,idx], axis=-1)
+
+    def sigma (self, x):
+        ''' Apply the Hamiltonian, S^2, and overlap matrices to x
+
+            Args:
+                x : ndarray of shape (nroots,) or (nroots,nvecs)
+
+            Returns:
+                hx, s2x, ovlpx : ndarrays of the same shape as x
+        '''
+        x = np.asarray (x)
+        x_shape = x.shape
+        self.x = x = x.reshape (self.nroots, -1)
+        self.hx = np.zeros (x.shape, dtype=np.result_type (self.dtype, x.dtype))
+        self.hxT = np.zeros_like (self.hx)
+        self.s2x = np.zeros_like (self.hx)
+        self.s2xT = np.zeros_like (self.hx)
+        self._crunch_all_()
+        ovlpx = np.zeros_like (self.hx)
+        blksize = max (1, int (self.max_memory*1e6 / (8*self.nfrags*self.nroots*self.nworkers)))
+        for i0 in range (0, self.nroots, blksize):
+            i1 = min (self.nroots, i0+blksize)
+            ovlpx[i0:i1] = np.dot (self.get_ovlp (i0, i1), x)
+        hx, s2x = self.hx, self.s2x
+        self.x = self.hx = self.hxT = self.s2x = self.s2xT = None
+        return hx.reshape (x_shape), s2x.reshape (x_shape), ovlpx.reshape (x_shape)
+
 class LRRDMint (LSTDMint2):
     ''' For computing RDMs of LASSI roots without cacheing the whole damn STDM12s array '''
-    # TODO: at some point, if it ever becomes rate-limiting, make this multithread better
 
-    def __init__(self, ints, nlas, hopping_index, si, dtype=np.float64):
-        LSTDMint2.__init__(self, ints, nlas, hopping_index, dtype=dtype)
+    def __init__(self, ints, nlas, hopping_index, si, dtype=np.float64, **kwargs):
+        LSTDMint2.__init__(self, ints, nlas, hopping_index, dtype=dtype, **kwargs)
         self.nroots_si = si.shape[-1]
         self.si_dm = np.stack ([np.dot (si[:,i:i+1],si[:,i:i+1].conj ().T)
             for i in range (self.nroots_si)], axis=-1)
 
     def _get_D1_(self, bra, ket):
-        self.d1[:] = 0.0
-        return self.d1
+        return np.zeros ([len (bra),2]+[self.norb,]*2, dtype=self.dtype)
 
     def _get_D2_(self, bra, ket):
-        self.d2[:] = 0.0
-        return self.d2
+        return np.zeros ([len (bra),4]+[self.norb,]*4, dtype=self.dtype)
 
     def _put_D1_(self, bra, ket, D1):
-        self.rdm1s[:] += np.multiply.outer (self.si_dm[bra,ket,:], D1)
+        D1 = np.tensordot (self.si_dm[bra,ket,:], D1, axes=((0),(0)))
+        with self._lock: self.rdm1s[:] += D1
 
     def _put_D2_(self, bra, ket, D2):
-        self.rdm2s[:] += np.multiply.outer (self.si_dm[bra,ket,:], D2)
+        D2 = np.tensordot (self.si_dm[bra,ket,:], D2, axes=((0),(0)))
+        with self._lock: self.rdm2s[:] += D2
 
     def _add_transpose_(self):
         self.rdm1s += self.rdm1s.conj ().transpose (0,1,3,2)
@@ -652,20 +899,45 @@ class LRRDMint (LSTDMint2):
 
     def kernel (self):
         t0 = (time.clock (), time.time ())
-        self.d1 = np.zeros ([2,]+[self.norb,]*2, dtype=self.dtype)
-        self.d2 = np.zeros ([4,]+[self.norb,]*4, dtype=self.dtype)
-        self.rdm1s = np.zeros ([self.nroots_si,] + list (self.d1.shape), dtype=self.dtype)
-        self.rdm2s = np.zeros ([self.nroots_si,] + list (self.d2.shape), dtype=self.dtype)
+        self.rdm1s = np.zeros ([self.nroots_si,2] + [self.norb,]*2, dtype=self.dtype)
+        self.rdm2s = np.zeros ([self.nroots_si,4] + [self.norb,]*4, dtype=self.dtype)
         self._crunch_all_()
         return self.rdm1s, self.rdm2s, t0
 
 
-def make_ints (las, ci, idx_root):
+def _ci_fingerprint (ci):
+    return tuple ((c.shape, c.dtype.str, lib.fp (c)) for ci_r in ci for c in ci_r)
+
+def make_ints (las, ci, idx_root, ints_cache=None):
+    ''' First pass of the LASSI TDM algorithm: the single-fragment intermediates.
+
+        Args:
+            las: LASCI object
+            ci: list of list of ci vectors of this symmetry block
+            idx_root: integer indices of roots in this symmetry block
+
+        Kwargs:
+            ints_cache: dict
+                If given, the result is memoized in it, one entry per symmetry block (idx_root),
+                and reused by later calls given the same dict as long as the CI vectors of that
+                block are unchanged (i.e., for ham followed by roots_make_rdm12s). The caller
+                owns it; discard or clear it to release the intermediates.
+
+        Returns:
+            hopping_index: ndarray of ints of shape (nfrags, 2, nroots, nroots)
+            ints: list of LSTDMint1 of length nfrags
+    '''
     fciboxes = las.fciboxes
     nfrags = len (fciboxes)
     nroots = idx_root.size
     nlas = las.ncas_sub
     nelelas = [sum (_unpack_nelec (ne)) for ne in las.nelecas_sub]
+    if ints_cache is not None:
+        key = (tuple (idx_root), tuple (nlas), tuple (nelelas))
+        fingerprint = _ci_fingerprint (ci)
+        if key in ints_cache and ints_cache[key][0] == fingerprint:
+            lib.logger.debug (las, 'LAS-state TDM12s reusing cached intermediates for roots %s', idx_root)
+            return ints_cache[key][1:]
     hopping_index, zerop_index, onep_index = lst_hopping_index (fciboxes, nlas, nelelas, idx_root)
     ints = []
     for ifrag in range (nfrags):
@@ -673,54 +945,112 @@ def make_ints (las, ci, idx_root):
         t0 = tdmint.kernel (ci[ifrag], hopping_index[ifrag], zerop_index, onep_index)
         lib.logger.timer (las, 'LAS-state TDM12s fragment {} intermediate crunching'.format (ifrag), *t0)        
         ints.append (tdmint)
+    if ints_cache is not None:
+        ints_cache[key] = (fingerprint, hopping_index, ints)
     return hopping_index, ints
 
-def make_stdm12s (las, ci, idx_root, **kwargs):
+def make_stdm12s (las, ci, idx_root, ints_cache=None, **kwargs):
     nlas = las.ncas_sub
     ncas = las.ncas
     nroots = np.count_nonzero (idx_root)
     idx_root = np.where (idx_root)[0]
 
     # First pass: single-fragment intermediates
-    hopping_index, ints = make_ints (las, ci, idx_root)
+    hopping_index, ints = make_ints (las, ci, idx_root, ints_cache=ints_cache)
 
     # Second pass: upper-triangle
     t0 = (time.clock (), time.time ())
-    outerprod = LSTDMint2 (ints, nlas, hopping_index, dtype=ci[0][0].dtype)
+    outerprod = LSTDMint2 (ints, nlas, hopping_index, dtype=ci[0][0].dtype,
+        max_memory=las.max_memory, nworkers=getattr (las, 'nworkers', 1))
     lib.logger.timer (las, 'LAS-state TDM12s second intermediate indexing setup', *t0)        
     tdm1s, tdm2s, t0 = outerprod.kernel ()
     lib.logger.timer (las, 'LAS-state TDM12s second intermediate crunching', *t0)        
 
     return tdm1s.transpose (0,2,3,4,1), tdm2s.reshape (nroots, nroots, 2, 2, ncas, ncas, ncas, ncas).transpose (0,2,4,5,3,6,7,1)
 
-def ham (las, h1, h2, ci, idx_root, **kwargs):
+def make_stdm12s_sparse (las, ci, idx_root, store1=None, store2=None, ints_cache=None, **kwargs):
+    ''' LAS-state tdm12s of the interacting pairs of LAS states in one symmetry block
+
+        Kwargs:
+            store1, store2 : dict-like or None
+                Where to put the tdm1s and tdm2s blocks, keyed by (bra, ket) within idx_root. If
+                not given, new dicts are made and returned with values in the layout of the
+                pairs of make_stdm12s, i.e., of shape (2,ncas,ncas) and (2,ncas,ncas,2,ncas,ncas).
+                Otherwise, the stores receive the values in the layout of LSTDMint2.
+            ints_cache : dict or None
+                See make_ints
+
+        Returns:
+            store1, store2
+    '''
     nlas = las.ncas_sub
+    ncas = las.ncas
     idx_root = np.where (idx_root)[0]
+    convert = store2 is None
 
     # First pass: single-fragment intermediates
-    hopping_index, ints = make_ints (las, ci, idx_root)
+    hopping_index, ints = make_ints (las, ci, idx_root, ints_cache=ints_cache)
+
+    # Second pass: interacting pairs only
+    t0 = (time.clock (), time.time ())
+    outerprod = LSTDMint2Sparse (ints, nlas, hopping_index, dtype=ci[0][0].dtype, store1=store1,
+        store2=store2, max_memory=las.max_memory, nworkers=getattr (las, 'nworkers', 1))
+    lib.logger.timer (las, 'LAS-state TDM12s second intermediate indexing setup', *t0)        
+    store1, store2, t0 = outerprod.kernel ()
+    lib.logger.timer (las, 'LAS-state TDM12s second intermediate crunching', *t0)        
+
+    if convert:
+        for key, d2 in store2.items ():
+            store2[key] = d2.reshape (2, 2, ncas, ncas, ncas, ncas).transpose (0,2,3,1,4,5)
+    return store1, store2
+
+def ham (las, h1, h2, ci, idx_root, ints_cache=None, **kwargs):
+    nlas = las.ncas_sub
+    idx_root = np.where (idx_root)[0]
+
+    # First pass: single-fragment intermediates
+    hopping_index, ints = make_ints (las, ci, idx_root, ints_cache=ints_cache)
 
     # Second pass: upper-triangle
     t0 = (time.clock (), time.time ())
-    outerprod = HamS2ovlpint (ints, nlas, hopping_index, h1, h2, dtype=ci[0][0].dtype)
+    outerprod = HamS2ovlpint (ints, nlas, hopping_index, h1, h2, dtype=ci[0][0].dtype,
+        max_memory=las.max_memory, nworkers=getattr (las, 'nworkers', 1))
     lib.logger.timer (las, 'LASSI Hamiltonian second intermediate indexing setup', *t0)        
     ham, s2, ovlp, t0 = outerprod.kernel ()
     lib.logger.timer (las, 'LASSI Hamiltonian second intermediate crunching', *t0)        
     return ham, s2, ovlp
 
 
-def roots_make_rdm12s (las, ci, idx_root, si, **kwargs):
+def ham_sigma (las, h1, h2, ci, idx_root, ints_cache=None, **kwargs):
+    ''' Build an object whose sigma method applies the Hamiltonian, S^2, and overlap matrices of
+        the LAS states in idx_root to vectors; see HamS2ovlpSigma for its O(nfrags*nroots**2)
+        storage and per-call cost '''
+    nlas = las.ncas_sub
+    idx_root = np.where (idx_root)[0]
+
+    # First pass: single-fragment intermediates
+    hopping_index, ints = make_ints (las, ci, idx_root, ints_cache=ints_cache)
+
+    # Second pass: deferred to the sigma method
+    t0 = (time.clock (), time.time ())
+    sigma_op = HamS2ovlpSigma (ints, nlas, hopping_index, h1, h2, dtype=ci[0][0].dtype,
+        max_memory=las.max_memory, nworkers=getattr (las, 'nworkers', 1))
+    lib.logger.timer (las, 'LASSI sigma second intermediate indexing setup', *t0)        
+    return sigma_op
+
+def roots_make_rdm12s (las, ci, idx_root, si, ints_cache=None, **kwargs):
     nlas = las.ncas_sub
     ncas = las.ncas
     nroots_si = si.shape[-1]
     idx_root = np.where (idx_root)[0]
 
     # First pass: single-fragment intermediates
-    hopping_index, ints = make_ints (las, ci, idx_root)
+    hopping_index, ints = make_ints (las, ci, idx_root, ints_cache=ints_cache)
 
     # Second pass: upper-triangle
     t0 = (time.clock (), time.time ())
-    outerprod = LRRDMint (ints, nlas, hopping_index, si, dtype=ci[0][0].dtype)
+    outerprod = LRRDMint (ints, nlas, hopping_index, si, dtype=ci[0][0].dtype,
+        max_memory=las.max_memory, nworkers=getattr (las, 'nworkers', 1))
     lib.logger.timer (las, 'LASSI root RDM12s second intermediate indexing setup', *t0)        
     rdm1s, rdm2s, t0 = outerprod.kernel ()
     lib.logger.timer (las, 'LASSI root RDM12s second intermediate crunching', *t0)        
@@ -0,0 +1,116 @@
+import unittest
+import numpy as np
+from scipy import linalg
+from pyscf import gto, scf
+from mrh.my_dmet import localintegrals
+from mrh.my_dmet.qcdmethelper import sparse_H1, qcdmethelper
+from mrh.util.basis import represent_operator_in_basis
+
+mol = gto.M (atom = 'H 0 0 0; H 0 0 1.2; H 0 0 2.4; H 0 0 3.6; H 0 0 4.8; H 0 0 6.0', basis = '6-31g',
+    output = '/dev/null', verbose = 0)
+mf = scf.RHF (mol).run ()
+ints = localintegrals.localintegrals (mf, range (mol.nao_nr ()), 'meta_lowdin')
+
+def tearDownModule():
+    global mol, mf, ints
+    mol.stdout.close ()
+    del mol, mf, ints
+
+def makelist_H1_dense (norbs_tot, norbs_frag, doDET, TransInv):
+    ''' The (H1start, H1row, H1col) of the original dmet.makelist_H1: one dense 0/1 matrix per umat
+    parameter, sparsified with np.where '''
+    H1start, H1row, H1col = [0], [], []
+    def sparsify (H1):
+        rowco, colco = np.where (H1 == 1)
+        H1start.append (H1start[-1] + len (rowco))
+        H1row.extend (rowco)
+        H1col.extend (colco)
+    if TransInv:
+        nf = norbs_frag[0]
+        for row in range (nf):
+            for col in ((row,) if doDET else range (row, nf)):
+                H1 = np.zeros ([norbs_tot, norbs_tot], dtype=int)
+                for jumper in range (norbs_tot // nf):
+                    jumpsquare = nf * jumper
+                    H1[jumpsquare + row, jumpsquare + col] = 1
+                    H1[jumpsquare + col, jumpsquare + row] = 1
+                sparsify (H1)
+    else:
+        jumpsquare = 0
+        for nf in norbs_frag:
+            for row in range (nf):
+                for col in ((row,) if doDET else range (row, nf)):
+                    H1 = np.zeros ([norbs_tot, norbs_tot], dtype=int)
+                    H1[jumpsquare + row, jumpsquare + col] = 1
+                    H1[jumpsquare + col, jumpsquare + row] = 1
+                    sparsify (H1)
+            jumpsquare += nf
+    return H1start, H1row, H1col
+
+class KnownValues(unittest.TestCase):
+
+    def test_sparse_H1_from_fragments (self):
+        cases = []
+        for norbs_frag in ([1], [4], [2,3,4], [5,1,2]):
+            cases.append ((sum (norbs_frag) + 2, norbs_frag, False))
+        for nf in (1, 2, 3):
+            for nimg in (1, 3):
+                cases.append ((nf*nimg, [nf], True))
+        for norbs_tot, norbs_frag, TransInv in cases:
+            for doDET in (False, True):
+                with self.subTest (norbs_tot=norbs_tot, norbs_frag=norbs_frag, TransInv=TransInv, doDET=doDET):
+                    ref = makelist_H1_dense (norbs_tot, norbs_frag, doDET, TransInv)
+                    images = np.arange (norbs_tot // norbs_frag[0]) * norbs_frag[0] if TransInv else None
+                    test = sparse_H1.from_fragments (norbs_tot, norbs_frag, diag=doDET, images=images)
+                    for lbl, r, t in zip (('H1start', 'H1row', 'H1col'), ref, test):
+                        self.assertEqual (t.dtype, np.intc, lbl)
+                        self.assertEqual (t.tolist (), list (r), lbl)
+                    self.assertEqual (test.Nterms, len (ref[0]) - 1)
+
+    def test_response_blocks (self):
+        norbs_tot = ints.norbs_tot
+        norbs_frag = [4, 4, 4]
+        frag_orb_lists = [list (range (4*i, 4*(i+1))) for i in range (3)]
+        rng = np.random.RandomState (1)
+        umat = rng.rand (norbs_tot, norbs_tot) * 0.05
+        umat += umat.T
+        NOrot = linalg.qr (rng.rand (norbs_tot, norbs_tot))[0]
+        def loc2imp (orbs):
+            # Fragment orbitals and as many orthonormal 'bath' orbitals in the rest of the space
+            env = np.ones (norbs_tot, dtype=bool)
+            env[orbs] = False
+            loc2imp = np.zeros ((norbs_tot, 2*len (orbs)))
+            loc2imp[orbs,np.arange (len (orbs))] = 1
+            loc2imp[env,len (orbs):] = linalg.qr (rng.rand (np.count_nonzero (env), len (orbs)), mode='economic')[0]
+            return loc2imp
+        # The bases and diagonal flags of fragments.get_rsp_1RDM_basis
+        variants = {'incl_bath_errvec': (False, None, [(loc2imp (o), False) for o in frag_orb_lists]),
+                    'doDET': (True, None, [(np.eye (norbs_tot)[:,o], True) for o in frag_orb_lists]),
+                    'doDET_NO': (True, NOrot, [(np.eye (norbs_tot)[:,o], True) for o in frag_orb_lists])}
+        for lbl, (doDET, NOrotation, bases) in variants.items ():
+            H1 = sparse_H1.from_fragments (norbs_tot, norbs_frag, diag=doDET)
+            helper = qcdmethelper (ints, H1, False, 'FOCK_INIT')
+            rsp = helper.construct1RDM_response (False, umat, NOrotation)
+            ref = [np.stack ([represent_operator_in_basis (r, l2b) for r in rsp], axis=0) for l2b, d in bases]
+            ref = np.concatenate ([np.stack ([np.diag (r) for r in rb], axis=0) if d
+                else rb.reshape (H1.Nterms, -1, order='F') for rb, (l2b, d) in zip (ref, bases)], axis=1)
+            # One batch, batches that don't divide Nterms, and batches of one parameter
+            nvirt = norbs_tot - helper.numPairs
+            mem_per_term = 8 * (np.amax (np.diff (H1.H1start)) + 2) * nvirt * helper.numPairs / 1e6
+            for blksize in (H1.Nterms, 5, 1):
+                with self.subTest (lbl, blksize=blksize):
+                    test = []
+                    nbatch = 0
+                    for rsp_blocks in helper.construct1RDM_response_blocks (False, umat, NOrotation,
+                            [l2b for l2b, d in bases], max_memory=(blksize+0.5)*mem_per_term):
+                        nbatch += 1
+                        for rsp_bas in zip (*rsp_blocks):
+                            test.append (np.concatenate ([np.diag (r) if d else r.flatten (order='F')
+                                for r, (l2b, d) in zip (rsp_bas, bases)]))
+                    self.assertEqual (nbatch, (H1.Nterms + blksize - 1) // blksize)
+                    self.assertLessEqual (np.amax (np.abs (np.asarray (test) - ref)), 1e-8)
+
+
+if __name__ == "__main__":
+    print("Full Tests for qcdmethelper")
+    unittest.main()
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import copy
+import tempfile
 import unittest
 import numpy as np
 from pyscf import lib, gto, scf, dft, fci, mcscf, df
@@ -50,6 +51,47 @@ class KnownValues(unittest.TestCase):
         las.kernel (mo_coeff)
         self.assertAlmostEqual (las.e_tot, -295.44779578419946, 7)
 
+    def test_dia_full_veff (self):
+        las = LASSCF (mf, (4,4), (4,4), spin_sub=(1,1))
+        las.veff_rebuild_cycle = 1
+        mo_coeff = las.localize_init_guess (frags)
+        las.kernel (mo_coeff)
+        self.assertAlmostEqual (las.e_tot, -295.44779578419946, 7)
+
+    def test_dia_restart (self):
+        chkfile = tempfile.NamedTemporaryFile (dir=lib.param.TMPDIR)
+        las = LASSCF (mf, (4,4), (4,4), spin_sub=(1,1))
+        las.chkfile_las = chkfile.name
+        las.max_cycle_macro = 2
+        mo_coeff = las.localize_init_guess (frags)
+        las.kernel (mo_coeff)
+        mo_chk, ci_chk = las.mo_coeff.copy (), copy.deepcopy (las.ci)
+        # One macrocycle from the checkpoint, with nothing else to start from but mf.mo_coeff...
+        las = LASSCF (mf, (4,4), (4,4), spin_sub=(1,1))
+        las.chkfile_las = chkfile.name
+        las.restart = True
+        las.max_cycle_macro = 1
+        las.kernel ()
+        # ...must be the same as one macrocycle explicitly started from the checkpointed state
+        las_ref = LASSCF (mf, (4,4), (4,4), spin_sub=(1,1))
+        las_ref.max_cycle_macro = 1
+        las_ref.kernel (mo_chk, ci0=ci_chk)
+        self.assertAlmostEqual (las.e_tot, las_ref.e_tot, 8)
+        # and finishing the calculation from the checkpoint converges to the right answer
+        las.max_cycle_macro = 50
+        las.kernel ()
+        self.assertTrue (las.converged)
+        self.assertAlmostEqual (las.e_tot, -295.44779578419946, 7)
+
+    def test_dia_nworkers (self):
+        las = [LASSCF (mf, (4,4), (4,4), spin_sub=(1,1)).set (nworkers=n) for n in (1, 2)]
+        mo_coeff = las[0].localize_init_guess (frags)
+        for l in las: l.kernel (mo_coeff)
+        self.assertAlmostEqual (las[1].e_tot, las[0].e_tot, 9)
+        for ifrag, (c0, c1) in enumerate (zip (las[0].ci, las[1].ci)):
+            with self.subTest (frag=ifrag):
+                self.assertAlmostEqual (abs (c0[0].ravel ().dot (c1[0].ravel ())), 1.0, 8)
+
     def test_dia_df (self):
         las = LASSCF (mf_df, (4,4), (4,4), spin_sub=(1,1))
         mo_coeff = las.localize_init_guess (frags)
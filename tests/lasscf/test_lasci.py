@@ -17,12 +17,13 @@ import copy
 import unittest
 import numpy as np
 from scipy import linalg
-from pyscf import lib, gto, scf, dft, fci, mcscf, df
+from pyscf import lib, gto, scf, dft, fci, mcscf, df, ao2mo
 from pyscf.tools import molden
 from c2h4n4_struct import structure as struct
 from mrh.my_dmet import localintegrals, dmet, fragments
 from mrh.my_dmet.fragments import make_fragment_atom_list, make_fragment_orb_list
-from mrh.my_pyscf.mcscf.lasci import LASCI_HessianOperator, LASCI_UnitaryGroupGenerators
+from mrh.my_pyscf.mcscf.lasci import LASCI_HessianOperator, LASCI_UnitaryGroupGenerators, LASCI, rotate_h2eff_sub
+from mrh.my_pyscf.mcscf.lasscf_testing import LASSCF
 
 def build (mf, m1=0, m2=0, ir1=0, ir2=0, CASlist=None, active_first=False, calcname='c2h4n4', **kwargs):
     # I/O
@@ -146,6 +147,65 @@ class KnownValues(unittest.TestCase):
         hx = h_op._matvec (xp)[:-32]
         self.assertAlmostEqual (lib.fp (hx), 182.07818989609675, 8)
 
+    def test_hessian_fd (self):
+        # Central differences of the gradient along a random step at a converged LASCI solution.
+        # The orbital gradient is half the derivative of the energy, the CI gradient is the full one.
+        frags = (list (range (3)), list (range (7,10)))
+        mo0 = LASSCF (mf, (4,4), (4,4), spin_sub=(1,1)).localize_init_guess (frags)
+        mf_df = mf.density_fit (auxbasis = df.aug_etb (mol)).run ()
+        for lbl, my_mf in (('conv', mf), ('DF', mf_df)):
+            las = LASCI (my_mf, (4,4), (4,4), spin_sub=(1,1)).set (conv_tol_grad=1e-8)
+            las.kernel (mo0)
+            ugg = las.get_ugg ()
+            hop = las.get_hop (ugg=ugg)
+            np.random.seed (1)
+            xp = np.random.rand (ugg.nvar_tot) - 0.5
+            hx = hop._matvec (xp)
+            h2eff_sub = las.ao2mo (las.mo_coeff)
+            def grad (step):
+                mo1, ci1 = hop.update_mo_ci_eri (step*xp, h2eff_sub)[:2]
+                return np.append (*las.get_grad (ugg=ugg, mo_coeff=mo1, ci=ci1)[:2])
+            hx_fd = (grad (1e-4) - grad (-1e-4)) / 2e-4
+            nvar_orb = ugg.nvar_orb
+            with self.subTest (eri=lbl, block='orb'):
+                self.assertTrue (las.converged)
+                err = linalg.norm (2*hx_fd[:nvar_orb] - hx[:nvar_orb]) / linalg.norm (hx[:nvar_orb])
+                self.assertLess (err, 2e-4)
+            with self.subTest (eri=lbl, block='ci'):
+                self.assertLess (linalg.norm (hx_fd[nvar_orb:] - hx[nvar_orb:]), 1e-6)
+
+    def test_h2eff_slice (self):
+        # Unequal fragments, so that the offsets of the middle one are nontrivial
+        las = LASCI (mf, (2,4,3), (2,4,2), spin_sub=(1,1,1))
+        ncore, ncas = las.ncore, las.ncas
+        h2eff = las.ao2mo (mf.mo_coeff)
+        eri_cas = lib.numpy_helper.unpack_tril (h2eff[ncore:ncore+ncas].reshape (ncas*ncas, -1))
+        eri_cas = eri_cas.reshape (ncas, ncas, ncas, ncas)
+        for idx, (i, j) in enumerate (zip ([0,2,6], [2,6,9])):
+            eri_ref = eri_cas[i:j,i:j,i:j,i:j]
+            for compact in (None, 1, 4, 8):
+                with self.subTest (frag=idx, compact=compact):
+                    ref = eri_ref if compact is None else ao2mo.restore (compact, eri_ref, j-i)
+                    test = las.get_h2eff_slice (h2eff, idx, compact=compact)
+                    self.assertEqual (test.shape, ref.shape)
+                    self.assertAlmostEqual (lib.fp (test), lib.fp (ref), 12)
+
+    def test_rotate_h2eff_sub (self):
+        # Exact for rotations which don't mix the active orbitals with the others
+        las = LASCI (mf, (4,4), (4,4), spin_sub=(1,1))
+        ncore, ncas, nmo = las.ncore, las.ncas, mf.mo_coeff.shape[1]
+        np.random.seed (2)
+        umat = linalg.block_diag (*[linalg.qr (np.random.rand (n, n))[0]
+            for n in (ncore, ncas, nmo-ncore-ncas)])
+        h2eff = las.ao2mo (mf.mo_coeff)
+        h2eff_ref = las.ao2mo (mf.mo_coeff @ umat)
+        h2eff_test = rotate_h2eff_sub (las, h2eff, umat)
+        self.assertFalse (np.shares_memory (h2eff_test, h2eff))
+        self.assertAlmostEqual (lib.fp (h2eff_test), lib.fp (h2eff_ref), 9)
+        h2eff_test = rotate_h2eff_sub (las, h2eff, umat, out=h2eff)
+        self.assertTrue (np.shares_memory (h2eff_test, h2eff))
+        self.assertAlmostEqual (lib.fp (h2eff_test), lib.fp (h2eff_ref), 9)
+
     def test_prec (self):
         M_op = h_op.get_prec ()
         Mx = M_op._matvec (x)
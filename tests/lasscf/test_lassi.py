@@ -21,7 +21,7 @@ from pyscf import lib, gto, scf, dft, fci, mcscf, df
 from pyscf.tools import molden
 from c2h4n4_struct import structure as struct
 from mrh.my_pyscf.mcscf.lasscf_testing import LASSCF
-from mrh.my_pyscf.mcscf.lassi import roots_make_rdm12s, make_stdm12s, ham_2q
+from mrh.my_pyscf.mcscf.lassi import roots_make_rdm12s, make_stdm12s, ham_2q, davidson_si
 
 dr_nn = 2.0
 mol = struct (dr_nn, dr_nn, '6-31g', symmetry=False)
@@ -101,6 +101,49 @@ class KnownValues(unittest.TestCase):
         for e1, e0 in zip (e_roots_test, e_roots):
             self.assertAlmostEqual (e1, e0, 8)
 
+    def test_nworkers (self):
+        e_roots1, si1 = las.lassi (nworkers=3)
+        self.assertAlmostEqual (lib.fp (e_roots1), lib.fp (e_roots), 9)
+        self.assertAlmostEqual (lib.fp (np.abs (si1)), lib.fp (np.abs (si)), 9)
+        self.assertAlmostEqual (lib.fp (si1.s2_mat), lib.fp (si.s2_mat), 9)
+
+    def test_ints_cache (self):
+        ints_cache = {}
+        e_roots1, si1 = las.lassi (nworkers=3, ints_cache=ints_cache)
+        ints0 = {key: val[2] for key, val in ints_cache.items ()}
+        self.assertGreater (len (ints0), 0)
+        self.assertFalse (hasattr (las, '_lstdmint1_cache'))
+        # roots_make_rdm12s reuses the intermediates of every block that lassi diagonalized
+        d1s, d2s = roots_make_rdm12s (las, las.ci, si1, ints_cache=ints_cache)
+        for key, ints in ints0.items ():
+            self.assertIs (ints_cache[key][2], ints)
+        d1s_ref, d2s_ref = roots_make_rdm12s (las, las.ci, si1)
+        self.assertAlmostEqual (lib.fp (d1s), lib.fp (d1s_ref), 9)
+        self.assertAlmostEqual (lib.fp (d2s), lib.fp (d2s_ref), 9)
+
+    def test_davidson (self):
+        e_dav, si_dav = las.lassi (davidson_only=True, nroots_si=1)
+        rootsym = list (zip (si.nelec, si.wfnsym))
+        for e, sym in zip (e_dav, zip (si_dav.nelec, si_dav.wfnsym)):
+            e_ref = min ([e1 for e1, sym1 in zip (e_roots, rootsym) if sym1 == sym])
+            with self.subTest (rootsym=sym):
+                self.assertAlmostEqual (e, e_ref, 8)
+
+    def test_davidson_small (self):
+        np.random.seed (0)
+        for n in (2, 3, 5, 40):
+            ham = np.random.rand (n, n) - 0.5
+            ham = ham + ham.T + np.diag (np.arange (n))
+            ovlp = np.random.rand (n, n) * 0.1
+            ovlp = np.eye (n) + ovlp @ ovlp.T
+            sigma = lambda x: (ham @ x, ovlp @ x, ovlp @ x)
+            nroots = min (2, n)
+            conv, e, c, s2 = davidson_si (las, sigma, np.diag (ham), np.diag (ovlp), nroots=nroots)
+            e_ref = linalg.eigh (ham, b=ovlp)[0][:nroots]
+            with self.subTest (n=n):
+                self.assertTrue (conv)
+                self.assertAlmostEqual (lib.fp (e), lib.fp (e_ref), 8)
+
 if __name__ == "__main__":
     print("Full Tests for SA-LASSI")
     unittest.main()
@@ -108,6 +108,21 @@ class KnownValues(unittest.TestCase):
                     self.assertAlmostEqual (lib.fp (d12_o0[r][i,...,j]),
                         lib.fp (d12_o1[r][i,...,j]), 9)
 
+    def test_stdm12s_sparse (self):
+        d12_dense = make_stdm12s (las, opt=1)
+        d12_sparse = make_stdm12s (las, storage='sparse')
+        h5file = lib.H5TmpFile ()
+        d12_h5 = make_stdm12s (las, storage='h5', h5file=h5file)
+        for r in range (2):
+            for i, j in product (range (nroots), repeat=2):
+                with self.subTest (rank=r+1, bra=i, ket=j):
+                    ref = d12_dense[r][i,...,j]
+                    test = d12_sparse[r].get ((i,j), np.zeros_like (ref))
+                    self.assertAlmostEqual (lib.fp (test), lib.fp (ref), 9)
+                    self.assertAlmostEqual (lib.fp (d12_h5[r][i,...,j]), lib.fp (ref), 9)
+        with self.assertRaises (RuntimeError):
+            make_stdm12s (las, storage='h5', h5file=h5file.filename)
+
     def test_ham_s2_ovlp (self):
         h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
         lbls = ('ham','s2','ovlp')
@@ -118,6 +133,58 @@ class KnownValues(unittest.TestCase):
             with self.subTest(matrix=lbl):
                 self.assertAlmostEqual (lib.fp (mat), fp, 9)
 
+    def test_ham_s2_ovlp_factorized (self):
+        h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
+        lbls = ('ham','s2','ovlp')
+        mats_o0 = op_o0.ham (las, h1, h2, las.ci, idx_all, orbsym=orbsym, wfnsym=wfnsym)
+        mats_o0f = op_o0.ham_factorized (las, h1, h2, las.ci, idx_all, orbsym=orbsym, wfnsym=wfnsym)
+        for lbl, mat0, mat1 in zip (lbls, mats_o0, mats_o0f):
+            with self.subTest(matrix=lbl):
+                self.assertAlmostEqual (lib.fp (mat1), lib.fp (mat0), 9)
+
+    def test_ham_s2_ovlp_nworkers (self):
+        h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
+        lbls = ('ham','s2','ovlp')
+        mats_o0 = op_o0.ham (las, h1, h2, las.ci, idx_all, orbsym=orbsym, wfnsym=wfnsym)
+        las1 = copy.copy (las)
+        las1.nworkers = 2
+        las1.max_memory = 1 # many small batches
+        mats_o1 = op_o1.ham (las1, h1, h2, las.ci, idx_all, orbsym=orbsym, wfnsym=wfnsym)
+        for lbl, mat0, mat1 in zip (lbls, mats_o0, mats_o1):
+            with self.subTest(matrix=lbl):
+                self.assertAlmostEqual (lib.fp (mat1), lib.fp (mat0), 9)
+
+    def test_ints_cache (self):
+        h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
+        # No cache unless one is passed; nothing is left on las
+        ham_ref = op_o1.ham (las, h1, h2, las.ci, idx_all, orbsym=orbsym, wfnsym=wfnsym)[0]
+        self.assertFalse (hasattr (las, '_lstdmint1_cache'))
+        ints_cache = {}
+        ham0 = op_o1.ham (las, h1, h2, las.ci, idx_all, orbsym=orbsym, wfnsym=wfnsym, ints_cache=ints_cache)[0]
+        ints0 = [v[2] for v in ints_cache.values ()]
+        self.assertAlmostEqual (lib.fp (ham0), lib.fp (ham_ref), 12)
+        ham1 = op_o1.ham (las, h1, h2, las.ci, idx_all, orbsym=orbsym, wfnsym=wfnsym, ints_cache=ints_cache)[0]
+        ints1 = [v[2] for v in ints_cache.values ()]
+        self.assertEqual (len (ints1), 1)
+        self.assertIs (ints1[0], ints0[0])
+        self.assertAlmostEqual (lib.fp (ham1), lib.fp (ham0), 12)
+        ci1 = [[c.copy () for c in ci_r] for ci_r in las.ci]
+        ci1[0][0] = -ci1[0][0]
+        ham2 = op_o1.ham (las, h1, h2, ci1, idx_all, orbsym=orbsym, wfnsym=wfnsym, ints_cache=ints_cache)[0]
+        ints2 = [v[2] for v in ints_cache.values ()]
+        self.assertEqual (len (ints2), 1)
+        self.assertIsNot (ints2[0], ints0[0])
+        self.assertAlmostEqual (lib.fp (ham2[0,1:]), -lib.fp (ham0[0,1:]), 9)
+        self.assertFalse (hasattr (las, '_lstdmint1_cache'))
+
+    def test_des_all (self):
+        norb, nelec = 5, (3,2)
+        ci0 = np.random.rand (fci.cistring.num_strings (norb, 3), fci.cistring.num_strings (norb, 2))
+        for spin, des in enumerate ((fci.addons.des_a, fci.addons.des_b)):
+            ref = np.stack ([des (ci0, norb, nelec, p) for p in range (norb)], axis=0)
+            with self.subTest (spin=spin):
+                self.assertAlmostEqual (lib.fp (op_o1.des_all (ci0, norb, nelec, spin)), lib.fp (ref), 12)
+
     def test_rdm12s (self):
         d12_o0 = op_o0.roots_make_rdm12s (las, las.ci, idx_all, si, orbsym=orbsym, wfnsym=wfnsym)
         d12_o1 = op_o1.roots_make_rdm12s (las, las.ci, idx_all, si, orbsym=orbsym, wfnsym=wfnsym)
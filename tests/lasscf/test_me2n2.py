@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import copy
+import tempfile
 import unittest
 import numpy as np
 from pyscf import lib, gto, scf, dft, fci, mcscf, df
@@ -61,6 +62,30 @@ class KnownValues(unittest.TestCase):
         las = LASSCF (mf_hs_df, (4,), ((4,0),), spin_sub=(5,)).set (conv_tol_grad=1e-5).run ()
         self.assertAlmostEqual (las.e_tot, mf_hs_df.e_tot, 8)
 
+    def test_h2eff_out (self):
+        for lbl, my_mf in (('conv', mf), ('DF', mf_df)):
+            las = LASSCF (my_mf, (4,), (4,), spin_sub=(1,)).set (conv_tol_grad=1e-5)
+            h2eff_ref = las.ao2mo (my_mf.mo_coeff)
+            e_ref = las.run ().e_tot
+            with self.subTest (eri=lbl):
+                out = np.empty_like (h2eff_ref)
+                h2eff_test = las.ao2mo (my_mf.mo_coeff, out=out)
+                self.assertTrue (np.shares_memory (h2eff_test, out))
+                self.assertAlmostEqual (lib.fp (h2eff_test), lib.fp (h2eff_ref), 9)
+                with tempfile.NamedTemporaryFile () as f:
+                    las.h2eff_out = np.memmap (f, dtype=h2eff_ref.dtype,
+                        mode='w+', shape=h2eff_ref.shape)
+                    # Only kernel writes into h2eff_out; a held h2eff_sub must not be clobbered
+                    h2eff_test = las.ao2mo (my_mf.mo_coeff)
+                    self.assertFalse (np.shares_memory (h2eff_test, las.h2eff_out))
+                    self.assertFalse (np.any (las.h2eff_out))
+                    las.run (my_mf.mo_coeff)
+                    self.assertAlmostEqual (las.e_tot, e_ref, 9)
+                    # kernel keeps h2eff_sub in the buffer through the macrocycles and canonicalize
+                    self.assertAlmostEqual (lib.fp (las.h2eff_out), lib.fp (las.ao2mo (las.mo_coeff)), 8)
+                    self.assertAlmostEqual (lib.fp (h2eff_test), lib.fp (h2eff_ref), 9)
+                    las.h2eff_out = None
+
     def test_derivatives (self):
         np.random.seed(1)
         las = LASSCF (mf, (4,), (4,), spin_sub=(1,)).set (max_cycle_macro=1, ah_level_shift=0).run ()
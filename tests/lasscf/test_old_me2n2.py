@@ -13,15 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import copy, os, tempfile
 import unittest
 import numpy as np
+import h5py
 from pyscf import lib, gto, scf, dft, fci, mcscf, df
 from me2n2_struct import structure as struct
 from mrh.my_dmet import localintegrals, dmet, fragments
 from mrh.my_dmet.fragments import make_fragment_atom_list, make_fragment_orb_list
+from mrh.my_dmet.main_object import CHECKPOINT_VERSION
+from mrh.util.basis import represent_operator_in_basis
 
-def run (mf, CASlist=None, **kwargs):
+def build (mf, **kwargs):
     # I/O
     # --------------------------------------------------------------------------------------------------------------------
     mol = mf.mol
@@ -47,15 +50,18 @@ def run (mf, CASlist=None, **kwargs):
     N2.bath_tol = Me1.bath_tol = Me2.bath_tol = bath_tol
     fraglist = [N2, Me1, Me2] 
     
+    return dmet (myInts, fraglist, **my_kwargs)
+
+def run (mf, CASlist=None, **kwargs):
     # Generate active orbital guess 
     # --------------------------------------------------------------------------------------------------------------------
-    me2n2_dmet = dmet (myInts, fraglist, **my_kwargs)
+    me2n2_dmet = build (mf, **kwargs)
     me2n2_dmet.generate_frag_cas_guess (mf.mo_coeff, caslst=CASlist, force_imp=True, confine_guess=False)
     
     # Calculation
     # --------------------------------------------------------------------------------------------------------------------
     e = me2n2_dmet.doselfconsistent ()
-    me2n2_dmet.lasci_log.close ()
+    if me2n2_dmet.lasci_log is not None: me2n2_dmet.lasci_log.close ()
     return e
 
 r_nn = 3.0
@@ -84,6 +90,9 @@ class KnownValues(unittest.TestCase):
     def test_lasscf (self):
         self.assertAlmostEqual (run (mf), mc.e_tot, 8)
 
+    def test_lasscf_nworkers (self):
+        self.assertAlmostEqual (run (mf, nworkers=2), mc.e_tot, 8)
+
     def test_lasscf_df (self):
         self.assertAlmostEqual (run (mf_df), mc_df.e_tot, 8)
 
@@ -93,6 +102,70 @@ class KnownValues(unittest.TestCase):
     def test_lasscf_hs_df (self):
         self.assertAlmostEqual (run (mf_hs_df), mf_hs_df.e_tot, 8)
 
+    def test_corrpot_lm (self):
+        e_bfgs = run (mf, doLASSCF=False, SCmethod='BFGS', calcname='me2n2_dmet_bfgs')
+        las = build (mf, doLASSCF=False, SCmethod='LM', calcname='me2n2_dmet_lm')
+        las.generate_frag_cas_guess (mf.mo_coeff, force_imp=True, confine_guess=False)
+        self.assertAlmostEqual (las.doselfconsistent (), e_bfgs, 6)
+        # Jacobian of the error vector against central finite differences, away from the solution
+        x0 = las.square2flat (las.umat)
+        x0 = x0 + 0.01 * np.random.RandomState (0).rand (x0.size)
+        jac = las.rdm_differences_jacobian (x0)
+        self.assertEqual (jac.shape, (las.rdm_differences (x0).size, x0.size))
+        step = 1e-5
+        jac_fd = np.zeros_like (jac)
+        for ix in range (x0.size):
+            dx = np.zeros_like (x0)
+            dx[ix] = step
+            jac_fd[:,ix] = (las.rdm_differences (x0+dx) - las.rdm_differences (x0-dx)) / (2*step)
+        self.assertLessEqual (np.amax (np.abs (jac - jac_fd)), 1e-7)
+
+    def test_checkpoint (self):
+        ref = build (mf)
+        ref.generate_frag_cas_guess (mf.mo_coeff, force_imp=True, confine_guess=False)
+        e_ref = ref.doselfconsistent ()
+        ref.lasci_log.close ()
+        oneRDM_ref = ref.helper.construct1RDM_loc (ref.doSCF, ref.umat)
+        with tempfile.TemporaryDirectory () as tmpdir:
+            for ext in ('.chk.h5', '.chk.npy'):
+                fname = os.path.join (tmpdir, 'me2n2' + ext)
+                ref.save_checkpoint (fname)
+                test = build (mf)
+                test.load_checkpoint (fname)
+                with self.subTest (fmt=ext):
+                    self.assertEqual (h5py.is_hdf5 (fname), ext == '.chk.h5')
+                    self.assertAlmostEqual (test.chempot, ref.chempot, 12)
+                    self.assertLessEqual (np.amax (np.abs (test.ints.oneRDM_loc - oneRDM_ref)), 1e-8)
+                    for f_ref, f_test in zip (ref.fragments, test.fragments):
+                        self.assertEqual (f_test.loc2amo.shape, f_ref.loc2amo.shape)
+                        if not f_ref.norbs_as: continue
+                        # Loading natorbifies the active orbitals, so compare basis-invariant quantities
+                        proj_ref = f_ref.loc2amo @ f_ref.loc2amo.conjugate ().T
+                        proj_test = f_test.loc2amo @ f_test.loc2amo.conjugate ().T
+                        self.assertLessEqual (np.amax (np.abs (proj_test - proj_ref)), 1e-8)
+                        dm1_ref = represent_operator_in_basis (f_ref.oneRDM_loc, f_ref.loc2amo)
+                        dm1_ref = represent_operator_in_basis (dm1_ref, f_ref.loc2amo.conjugate ().T)
+                        self.assertLessEqual (np.amax (np.abs (f_test.oneRDMas_loc - dm1_ref)), 1e-8)
+                        cdm2_ref = represent_operator_in_basis (f_ref.twoCDMimp_amo, f_ref.loc2amo.conjugate ().T)
+                        cdm2_test = represent_operator_in_basis (f_test.twoCDMimp_amo, f_test.loc2amo.conjugate ().T)
+                        self.assertLessEqual (np.amax (np.abs (cdm2_test - cdm2_ref)), 1e-8)
+                    if ext != '.chk.h5': continue
+                    with h5py.File (fname, 'r') as chkfile:
+                        self.assertEqual (chkfile.attrs['version'], CHECKPOINT_VERSION)
+                        self.assertEqual (chkfile['mat'].attrs['kind'], 'oneRDM')
+                        for key, f_ref in zip (ref._get_checkpoint_keys (), ref.fragments):
+                            grp = chkfile['fragments/' + key]
+                            self.assertEqual (grp.attrs['norbs_amo'], f_ref.norbs_as)
+                            self.assertEqual (grp['ao2amo'].compression, 'lzf')
+                            twoCDM = grp['twoCDMimp_amo']
+                            self.assertEqual (twoCDM.compression, 'lzf')
+                            amax = np.amax (np.abs (f_ref.twoCDMimp_amo)) if f_ref.twoCDMimp_amo.size else 0.0
+                            self.assertAlmostEqual (twoCDM.attrs['amax'], amax, 12)
+                            self.assertLessEqual (np.amax (np.abs (twoCDM[()] - f_ref.twoCDMimp_amo), initial=0), 1e-12)
+                    # A restart from the checkpoint lands on the same energy
+                    self.assertAlmostEqual (test.doselfconsistent (), e_ref, 8)
+                    test.lasci_log.close ()
+
 if __name__ == "__main__":
     print("Full Tests for (old) LASSCF me2n2")
     unittest.main()
@@ -1,10 +1,16 @@
 import numpy as np
 from scipy import linalg
 from pyscf import gto, scf, lib, mcscf
+from pyscf.lib import logger
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from mrh.my_pyscf import mcpdft
+from mrh.my_pyscf.mcpdft.mcpdft import get_E_ot, kernel as mcpdft_kernel
+from mrh.my_pyscf.mcpdft import otpd
+from mrh.my_pyscf.mcpdft.otpd import get_ontop_pair_density
+from mrh.util.rdm import get_2CDM_from_2RDM
 from mrh.my_pyscf.fci import csf_solver
 import unittest
+from unittest import mock
 
 Natom = scf.RHF (gto.M (atom = 'N 0 0 0', basis='cc-pvtz', spin=3, symmetry='Dooh', output='/dev/null')).run ()
 Beatom = scf.RHF (gto.M (atom = 'Be 0 0 0', basis='cc-pvtz', spin=2, symmetry=False, output='/dev/null')).run ()
@@ -22,6 +28,14 @@ def get_gap (gs, es, fnal):
         es.mo_coeff, es.ci)[0]
     return (e1-e0)*27.2114
 
+def get_E_ot_threaded (mc, fnal, nworkers):
+    mc_pdft = mcpdft.CASSCF (mc._scf, fnal, mc.ncas, mc.nelecas, grids_level=3)
+    dm1s = np.asarray (mc.make_rdm1s ())
+    adm1s = np.stack (mc.fcisolver.make_rdm1s (mc.ci, mc.ncas, mc.nelecas), axis=0)
+    adm2 = get_2CDM_from_2RDM (mc.fcisolver.make_rdm12 (mc.ci, mc.ncas, mc.nelecas)[1], adm1s)
+    mo_cas = mc.mo_coeff[:,mc.ncore:][:,:mc.ncas]
+    return get_E_ot (mc_pdft.otfnal, dm1s, adm2, mo_cas, max_memory=100, nworkers=nworkers)
+
 def tearDownModule():
     global Natom, Natom_hs, Natom_ls, Beatom, Beatom_ls, Beatom_hs
     Natom.mol.stdout.close ()
@@ -54,6 +68,61 @@ class KnownValues(unittest.TestCase):
     def test_ftblyp_n (self):
         self.assertAlmostEqual (get_gap (Natom_hs, Natom_ls, 'ftblyp'), 1.223835224013092, 5)
 
+    def test_E_ot_nworkers (self):
+        for fnal in ('tpbe', 'ftpbe'):
+            e_ref = get_E_ot_threaded (Natom_ls, fnal, 1)
+            for nworkers in (2, 3):
+                with self.subTest (fnal=fnal, nworkers=nworkers):
+                    self.assertAlmostEqual (get_E_ot_threaded (Natom_ls, fnal, nworkers), e_ref, 10)
+
+    def test_otfnal_settings (self):
+        mc = mcpdft.CASSCF (Natom_ls._scf, 'tpbe', 4, (3,2), grids_level=3)
+        mc.otfnal.nworkers = 3
+        # Rebuilt from a string: runtime settings carried over
+        mc._init_ot_grids ('ftpbe', grids_level=3)
+        self.assertEqual (mc.otfnal.nworkers, 3)
+        # Supplied by the user: left untouched
+        ot = mcpdft.CASSCF (Natom_ls._scf, 'tblyp', 4, (3,2), grids_level=3).otfnal
+        mc._init_ot_grids (ot, grids_level=3)
+        self.assertIs (mc.otfnal, ot)
+        self.assertEqual (ot.nworkers, 1)
+        self.assertIsNone (ot.grid_cache)
+
+    def test_multi_fnal (self):
+        fnals = ('tpbe', 'ftpbe', 'tblyp', 'ftblyp')
+        mc = mcpdft.CASSCF (Beatom_hs._scf, fnals[0], 4, (2,0), grids_level=3).set (
+            fcisolver=Beatom_hs.fcisolver, mo_coeff=Beatom_hs.mo_coeff, ci=Beatom_hs.ci)
+        ots = [mcpdft.CASSCF (Beatom_hs._scf, fnal, 4, (2,0), grids_level=3).otfnal for fnal in fnals]
+        e_tot, e_ot = mcpdft_kernel (mc, ots)
+        for fnal, ot, e_tot_test, e_ot_test in zip (fnals, ots, e_tot, e_ot):
+            e_tot_ref, e_ot_ref = mcpdft_kernel (mc, ot)
+            with self.subTest (fnal=fnal):
+                self.assertAlmostEqual (e_tot_test, e_tot_ref, 10)
+                self.assertAlmostEqual (e_ot_test, e_ot_ref, 10)
+
+    def test_otpd_clib (self):
+        if getattr (otpd.libpdft, 'VOTpair_density', None) is None:
+            self.skipTest ('libpdft was built without VOTpair_density')
+        mc = Natom_ls
+        ot = mcpdft.CASSCF (mc._scf, 'ftpbe', mc.ncas, mc.nelecas, grids_level=3).otfnal
+        # Above DEBUG verbosity get_ontop_pair_density always takes the numpy path
+        ot.verbose = logger.NOTE
+        ot.grids.build ()
+        ao = ot._numint.eval_ao (ot.mol, ot.grids.coords, deriv=1)
+        dm1s = np.asarray (mc.make_rdm1s ())
+        rho = np.stack ([ot._numint.eval_rho (ot.mol, ao, dm, xctype='GGA') for dm in dm1s], axis=0)
+        adm1s = np.stack (mc.fcisolver.make_rdm1s (mc.ci, mc.ncas, mc.nelecas), axis=0)
+        adm2 = get_2CDM_from_2RDM (mc.fcisolver.make_rdm12 (mc.ci, mc.ncas, mc.nelecas)[1], adm1s)
+        mo_cas = mc.mo_coeff[:,mc.ncore:][:,:mc.ncas]
+        for deriv in (0, 1):
+            with self.subTest (deriv=deriv):
+                with mock.patch.object (otpd, '_ontop_cumulant_clib', wraps=otpd._ontop_cumulant_clib) as clib:
+                    Pi_ref = get_ontop_pair_density (ot, rho, ao, dm1s, adm2, mo_cas, deriv=deriv, use_clib=False)
+                    self.assertEqual (clib.call_count, 0)
+                    Pi_test = get_ontop_pair_density (ot, rho, ao, dm1s, adm2, mo_cas, deriv=deriv, use_clib=True)
+                    self.assertEqual (clib.call_count, 1)
+                self.assertAlmostEqual (lib.fp (Pi_test), lib.fp (Pi_ref), 9)
+
 if __name__ == "__main__":
     print("Full Tests for MC-PDFT energies of N and Be atom spin states")
     unittest.main()
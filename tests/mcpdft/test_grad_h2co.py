@@ -1,9 +1,12 @@
 import numpy as np
 from scipy import linalg
-from pyscf import gto, scf, df
+from pyscf import gto, scf, df, lib
 from mrh.my_pyscf import mcpdft
 from mrh.my_pyscf.fci import csf_solver
 from mrh.my_pyscf.df.grad import dfmcpdft as mcpdft_grad
+from mrh.my_pyscf.mcpdft.grid_cache import GridCache
+from mrh.my_pyscf.mcpdft.mcpdft import kernel as mcpdft_kernel
+from mrh.my_pyscf.mcpdft import pdft_veff
 import unittest
 
 h2co_casscf66_631g_xyz = '''C  0.534004  0.000000  0.000000
@@ -59,6 +62,68 @@ class KnownValues(unittest.TestCase):
                     test = mc_grad.kernel (state=1)
                     self.assertLessEqual (linalg.norm (test-ref[1]), 1e-4)
 
+    def test_sa_veff_multi (self):
+        mc, ref = get_mc_ref (mol_nosymm, ri=False, sa2=True)
+        veff1, veff2 = mc.get_pdft_veff_multi (incl_coul=True, paaa_only=True)
+        for state in range (2):
+            with self.subTest (state=state):
+                v1, v2 = mc.get_pdft_veff (ci=mc.ci[state], incl_coul=True, paaa_only=True)
+                self.assertAlmostEqual (lib.fp (veff1[state]), lib.fp (v1), 9)
+                self.assertAlmostEqual (lib.fp (veff2[state].vhf_c), lib.fp (v2.vhf_c), 9)
+                self.assertAlmostEqual (lib.fp (veff2[state].papa), lib.fp (v2.papa), 9)
+
+    def test_pair_screen (self):
+        mc, ref = get_mc_ref (mol_nosymm, ri=False, sa2=True)
+        results = []
+        for thresh in (0, pdft_veff.PAIR_SCREEN_THRESH):
+            with lib.temporary_env (pdft_veff, PAIR_SCREEN_THRESH=thresh):
+                v1, v2 = mc.get_pdft_veff (ci=mc.ci[0], incl_coul=True, paaa_only=False)
+                veff1, veff2 = mc.get_pdft_veff_multi (incl_coul=True, paaa_only=True)
+                de = mc.nuc_grad_method ().kernel (state=1)
+            results.append ([v1, v2.vhf_c, v2.papa, veff1[1], veff2[1].vhf_c, veff2[1].papa, de])
+        lbls = ('veff1', 'vhf_c', 'papa', 'veff1_multi', 'vhf_c_multi', 'papa_multi', 'grad')
+        for lbl, test, ref in zip (lbls, results[1], results[0]):
+            with self.subTest (lbl):
+                self.assertLessEqual (np.amax (np.abs (test-ref)), 1e-10)
+
+    def test_sa_veff_cache (self):
+        mc, ref = get_mc_ref (mol_nosymm, ri=False, sa2=True)
+        mc_grad = mc.nuc_grad_method ()
+        mo, ci = mc.mo_coeff.copy (), [c.copy () for c in mc.ci]
+        v1_ref = mc_grad.get_pdft_veff (mo, ci, 0)[0].copy ()
+        # Modify the arrays in place: the cache must not hand back stale potentials
+        ci[0][:,:] = ci[1]
+        v1 = mc_grad.get_pdft_veff (mo, ci, 0)[0]
+        v1_1 = mc.get_pdft_veff (mo=mo, ci=mc.ci[1], incl_coul=True, paaa_only=True)[0]
+        self.assertGreater (linalg.norm (v1_ref-v1), 1e-4)
+        self.assertAlmostEqual (lib.fp (v1), lib.fp (v1_1), 9)
+
+    def test_grid_cache (self):
+        mc, ref = get_mc_ref (mol_nosymm, ri=False, sa2=False)
+        mc.kernel (mc.mo_coeff, mc.ci)
+        e_tot = mc.e_tot
+        mc.otfnal.grid_cache = cache = GridCache ()
+        mc.kernel (mc.mo_coeff, mc.ci)
+        self.assertAlmostEqual (mc.e_tot, e_tot, 9)
+        # Uncached reference at exactly these orbitals
+        mc.otfnal.grid_cache = None
+        e_ref = mcpdft_kernel (mc, mc.otfnal)[0]
+        de_ref = mc.nuc_grad_method ().kernel ()
+        mc.otfnal.grid_cache = cache
+        # Energy pass fills every block of the grid through the gradient's derivative order;
+        # neither gradient pass may evaluate any more AOs
+        cache.clear ()
+        self.assertAlmostEqual (mcpdft_kernel (mc, mc.otfnal)[0], e_ref, 10)
+        nmiss = cache.nmiss
+        self.assertGreater (nmiss, 0)
+        for i in range (2):
+            with self.subTest (npass=i):
+                nhit = cache.nhit
+                test = mc.nuc_grad_method ().kernel ()
+                self.assertLessEqual (np.amax (np.abs (test-de_ref)), 1e-10)
+                self.assertEqual (cache.nmiss, nmiss)
+                self.assertGreater (cache.nhit, nhit)
+
 
 if __name__ == "__main__":
     print("Full Tests for MC-PDFT gradients of H2CO molecule")
@@ -0,0 +1,90 @@
+import numpy as np
+from pyscf import gto, scf, lib, mcscf
+from mrh.my_pyscf import mcpdft
+from mrh.my_pyscf.mcpdft.otpd import get_ontop_pair_density
+from mrh.my_pyscf.mcpdft.tfnal_derivs import get_dEot_drho_dPi
+from mrh.util.rdm import get_2CDM_from_2RDM
+import unittest
+
+mol = gto.M (atom = 'O 0 0 0; H 1.145 0 0; H -0.38 1.08 0', basis='6-31g', spin=0, symmetry=False,
+    output='/dev/null', verbose=0)
+mf = scf.RHF (mol).run ()
+mc = mcscf.CASSCF (mf, 4, 4).set (conv_tol=1e-10).run ()
+
+def get_rho_Pi (fnal):
+    ot = mcpdft.CASSCF (mf, fnal, 4, 4, grids_level=2).otfnal
+    ot.grids.build ()
+    deriv = int (ot.xctype != 'LDA')
+    xctype = ('LDA', 'GGA')[deriv]
+    ao = ot._numint.eval_ao (ot.mol, ot.grids.coords, deriv=deriv)
+    dm1s = np.asarray (mc.make_rdm1s ())
+    rho = np.stack ([ot._numint.eval_rho (ot.mol, ao, dm, xctype=xctype) for dm in dm1s], axis=0)
+    adm1s = np.stack (mc.fcisolver.make_rdm1s (mc.ci, mc.ncas, mc.nelecas), axis=0)
+    adm2 = get_2CDM_from_2RDM (mc.fcisolver.make_rdm12 (mc.ci, mc.ncas, mc.nelecas)[1], adm1s)
+    mo_cas = mc.mo_coeff[:,mc.ncore:][:,:mc.ncas]
+    Pi = get_ontop_pair_density (ot, rho, ao, dm1s, adm2, mo_cas, deriv=deriv)
+    # The derivative functions always take (2,*,ngrids) and (*,ngrids) arrays
+    if rho.ndim == 2: rho, Pi = rho[:,None,:], Pi[None,:]
+    return ot, rho, Pi
+
+def _dEot_drho_ref (ot, rho, Pi, vxc, Rmax=1):
+    ''' The separate evaluation of dEot/drho that preceded get_dEot_drho_dPi '''
+    nderiv = rho.shape[1]
+    rho_tot = rho.sum (0)
+    R = ot.get_ratio (Pi[0:1,:], rho_tot[0:1,:]/2)
+    vot = vxc.sum (0) / 2
+    vdiff = (vxc[0] - vxc[1]) / 2
+    idx = (rho_tot[0] >= 1e-15) & (Pi[0] >= 1e-15) & (Rmax > R[0])
+    zeta = np.sqrt (1.0 - R[0,idx])
+    vot[:,idx] += vdiff[:,idx] * zeta[None,:]
+    RoZ = R[0,idx] / zeta
+    vot[0,idx] += vdiff[0,idx] * RoZ
+    if nderiv > 1:
+        vot[0,idx] += (vdiff[1:4,idx] * rho_tot[1:4,idx]).sum (0) * RoZ / rho_tot[0,idx]
+    return vot
+
+def _dEot_dPi_ref (ot, rho, Pi, vxc, Rmax=1):
+    ''' The separate evaluation of dEot/dPi that preceded get_dEot_drho_dPi '''
+    nderiv, ngrid = Pi.shape
+    rho_tot = rho.sum (0)
+    R = ot.get_ratio (Pi[0:1,:], rho_tot[0:1,:]/2)
+    vot = np.zeros ((1,ngrid))
+    vdiff = vxc[1] - vxc[0]
+    idx = (rho_tot[0] >= 1e-15) & (Pi[0] >= 1e-15) & (Rmax > R[0])
+    zeta = np.sqrt (1.0 - R[0,idx])
+    rhoZinv = np.reciprocal (rho_tot[0,idx] * zeta)
+    vot[0,idx] += vdiff[0,idx] * rhoZinv
+    if nderiv > 1:
+        vot[0,idx] += (vdiff[1:4,idx] * rho_tot[1:4,idx]).sum (0) * rhoZinv / rho_tot[0,idx]
+    return vot
+
+def tearDownModule():
+    global mol, mf, mc
+    mol.stdout.close ()
+    del mol, mf, mc
+
+class KnownValues(unittest.TestCase):
+
+    def test_dEot_drho_dPi (self):
+        for fnal in ('tLDA', 'tPBE'):
+            ot, rho, Pi = get_rho_Pi (fnal)
+            vxc = ot.get_bare_vxc (rho, Pi)
+            # Also a Pi with fewer derivative rows than rho
+            for nderiv_Pi in sorted (set ((1, Pi.shape[0]))):
+                Pi_test = np.ascontiguousarray (Pi[:nderiv_Pi])
+                vrho_ref = _dEot_drho_ref (ot, rho, Pi_test, vxc)
+                vot_ref = _dEot_dPi_ref (ot, rho, Pi_test, vxc)
+                vrho, vot = get_dEot_drho_dPi (ot, rho, Pi_test, vxc=vxc.copy ())
+                with self.subTest (fnal=fnal, nderiv_Pi=nderiv_Pi):
+                    self.assertEqual (vrho.shape, vrho_ref.shape)
+                    self.assertEqual (vot.shape, vot_ref.shape)
+                    self.assertLessEqual (np.amax (np.abs (vrho-vrho_ref)), 1e-10)
+                    self.assertLessEqual (np.amax (np.abs (vot-vot_ref)), 1e-10)
+                    self.assertAlmostEqual (lib.fp (ot.get_dEot_drho (rho, Pi_test, vxc=vxc)),
+                        lib.fp (vrho_ref), 10)
+                    self.assertAlmostEqual (lib.fp (ot.get_dEot_dPi (rho, Pi_test, vxc=vxc)),
+                        lib.fp (vot_ref), 10)
+
+if __name__ == "__main__":
+    print("Full Tests for translated on-top functional derivatives")
+    unittest.main()